@@ -0,0 +1,193 @@
+"""Бенчмарк общего кеша результатов внешних API.
+
+1. Бэкенды memory, sqlite и redis (сервер-заглушка fakeredis, если он установлен, или --redis-url):
+   проверка времени жизни, пространств имен, сжатия и отказа бэкенда, задержки get/set пачками.
+2. Несколько экземпляров бота подряд (отдельные процессы, как реплики или перезапуски) выполняют
+   одну и ту же работу - погода, крипта, опрос Twitch - против эмулятора; сравнивается число
+   обращений к API без общего кеша и с ним:
+    python benchmarks/cache_bench.py --replicas 3 --keys 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+from emulators import UpstreamEmulator  # noqa: E402
+
+CRYPTO_SYMBOLS = ['btc', 'eth', 'crv', 'sol', 'doge', 'btc.d', 'nasdaq']
+
+def start_in_thread(start):
+    """Запустить корутину-сервер в отдельном потоке со своим event loop"""
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    result = {}
+    
+    def serve():
+        asyncio.set_event_loop(loop)
+        result['value'] = loop.run_until_complete(start())
+        ready.set()
+        loop.run_forever()
+    
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    return result['value']
+
+def start_fake_redis():
+    """Сервер fakeredis по TCP; None, если fakeredis не установлен"""
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        return None
+    
+    server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return f'redis://{host}:{port}/0'
+
+def percentile(values, share):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(share * len(values)))] * 1000, 3) if values else None
+
+async def check_backend(bot, backend, payload, keys):
+    """Проверки и замеры одного бэкенда"""
+    cache = bot.SharedCache(backend, prefix='bench')
+    report = {}
+    
+    # Время жизни и пространства имен
+    await cache.set('openweather', 'ttl', payload, 0.2)
+    await cache.set('coingecko', 'ttl', {'usd': 1}, 60)
+    fresh = await cache.get('openweather', 'ttl')
+    other = await cache.get('coingecko', 'ttl')
+    await asyncio.sleep(0.3)
+    report['roundtrip_ok'] = fresh == payload
+    report['namespaces_ok'] = other == {'usd': 1}
+    report['ttl_ok'] = await cache.get('openweather', 'ttl') is None
+    
+    # Задержка записи и чтения пачками, затем одиночных чтений
+    items = {f'key{i}': dict(payload, index=i) for i in range(keys)}
+    started = time.perf_counter()
+    for i in range(0, keys, 100):
+        await cache.set_many('openweather', dict(list(items.items())[i:i + 100]), 60)
+    report['set_many_per_key_us'] = round((time.perf_counter() - started) / keys * 1e6, 1)
+    
+    started = time.perf_counter()
+    found = 0
+    for i in range(0, keys, 100):
+        found += len(await cache.get_many('openweather', [f'key{j}' for j in range(i, min(keys, i + 100))]))
+    report['get_many_per_key_us'] = round((time.perf_counter() - started) / keys * 1e6, 1)
+    report['get_many_found'] = found
+    
+    latencies = []
+    for i in range(min(keys, 500)):
+        started = time.perf_counter()
+        await cache.get('openweather', f'key{i}')
+        latencies.append(time.perf_counter() - started)
+    report['get_p50_ms'] = percentile(latencies, 0.5)
+    report['get_p99_ms'] = percentile(latencies, 0.99)
+    report['errors'] = sum(stats['errors'] for stats in cache.get_stats().values())
+    await cache.close()
+    return report
+
+async def check_backends(args, bot, emulator_urls, redis_url):
+    # Настоящий ответ прогноза из эмулятора - его размер и сжатие
+    bot.OPENWEATHER_API_URL = emulator_urls['OPENWEATHER_API_URL']
+    payload = await bot.fetch_weather_forecast('bench', 55.75, 37.62)
+    await bot.close_http_session()
+    raw = json.dumps(payload).encode()
+    stored = bot.SharedCache.dumps(payload)
+    report = {'payload': {'json_bytes': len(raw), 'stored_bytes': len(stored), 'ratio': round(len(raw) / len(stored), 1)}}
+    
+    data_dir = tempfile.mkdtemp()
+    backends = {
+        'memory': bot.MemoryCacheBackend(),
+        'sqlite': bot.SQLiteCacheBackend(os.path.join(data_dir, 'cache.db')),
+    }
+    if redis_url:
+        backends['redis'] = bot.RedisCacheBackend(redis_url)
+    for name, backend in backends.items():
+        report[name] = await check_backend(bot, backend, payload, args.keys)
+    
+    # Недоступный бэкенд - промах, а не ошибка команды
+    broken = bot.SharedCache(bot.RedisCacheBackend('redis://127.0.0.1:1/0'), prefix='bench')
+    value = await broken.get_or_fetch('openweather', 'down', 60, lambda: asyncio.sleep(0, result={'ok': True}))
+    report['backend_down'] = {'value_ok': value == {'ok': True}, 'errors': broken.get_stats()['openweather']['errors']}
+    await broken.close()
+    return report
+
+async def run_replica():
+    """Процесс-экземпляр бота: погода, крипта и опрос Twitch; печатает статистику общего кеша"""
+    import bot
+    
+    streamers = int(os.environ['BENCH_STREAMERS'])
+    await asyncio.gather(*(bot.get_weather_forecast('bench', city['lat'], city['lon']) for city in bot.CITIES.values()))
+    await bot.get_crypto_data(CRYPTO_SYMBOLS)
+    await bot.get_twitch_streams([f'streamer{i}' for i in range(streamers)])
+    await bot.SHARED_CACHE.close()
+    await bot.STORE.close()
+    await bot.close_http_session()
+    print(json.dumps(bot.SHARED_CACHE.get_stats()))
+
+def run_replicas(args, emulator, backend, url, data_dir):
+    """Запустить экземпляры бота по очереди; число обращений к каждому API"""
+    env = dict(os.environ, CACHE_BACKEND=backend, CACHE_URL=url, CACHE_PREFIX=f'bench-{time.time_ns()}',
+               BENCH_STREAMERS=str(args.streamers))
+    emulator.reset_calls()
+    stats = []
+    for index in range(args.replicas):
+        # У каждого экземпляра свой каталог данных: общего у них только кеш
+        replica_dir = os.path.join(data_dir, f'{backend or "none"}-{index}')
+        env.update(BOT_DATA_DIR=replica_dir, BOT_DB_FILE=os.path.join(replica_dir, 'bot.db'))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--replica'], env=env,
+                                capture_output=True, text=True, check=True).stdout
+        stats.append(json.loads(output[output.index('{'):]))
+    calls = emulator.snapshot_calls()
+    return {'upstream_calls': calls, 'total_calls': sum(calls.values()), 'shared_cache': stats[-1]}
+
+def main(args):
+    emulator = start_in_thread(lambda: start_emulator(args))
+    redis_url = args.redis_url or start_fake_redis()
+    
+    os.environ.update(emulator.urls())
+    os.environ.update({'TWITCH_CLIENT_ID': 'bench', 'TWITCH_CLIENT_SECRET': 'bench', 'OPENWEATHER_API_KEY': 'bench'})
+    data_dir = tempfile.mkdtemp()
+    os.environ.update({'BOT_DATA_DIR': data_dir, 'BOT_DB_FILE': os.path.join(data_dir, 'bot.db')})
+    import bot
+    
+    report = {'config': vars(args), 'backends': asyncio.run(check_backends(args, bot, emulator.urls(), redis_url))}
+    
+    replicas = {'none': run_replicas(args, emulator, '', '', data_dir)}
+    replicas['sqlite'] = run_replicas(args, emulator, 'sqlite', os.path.join(data_dir, 'shared-cache.db'), data_dir)
+    if redis_url:
+        replicas['redis'] = run_replicas(args, emulator, 'redis', redis_url, data_dir)
+    else:
+        report['redis_skipped'] = 'fakeredis не установлен и --redis-url не задан'
+    report['replicas'] = replicas
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+async def start_emulator(args):
+    emulator = UpstreamEmulator(latency_ms=args.latency_ms, live_ratio=0.2, seed=args.seed)
+    await emulator.start()
+    return emulator
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк общего кеша результатов внешних API')
+    parser.add_argument('--replicas', type=int, default=3, help='экземпляров бота подряд')
+    parser.add_argument('--streamers', type=int, default=300, help='стримеров в опросе Twitch')
+    parser.add_argument('--keys', type=int, default=1000, help='ключей в замере бэкендов')
+    parser.add_argument('--latency-ms', type=float, default=20, help='задержка эмулятора')
+    parser.add_argument('--redis-url', help='настоящий Redis вместо fakeredis')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--replica']:
+        asyncio.run(run_replica())
+    else:
+        main(parse_args())
@@ -0,0 +1,170 @@
+"""Проверка кластерного режима: шарды в нескольких процессах с заглушкой шлюза Discord.
+
+Заполняет базу подписками на множестве серверов, запускает процессы через bot.run_cluster
+(каждый со своим BOT_SHARD_IDS) и проводит в каждом один цикл опроса Twitch против эмулятора.
+Шлюз заменен заглушкой: процесс видит только серверы своих шардов, как настоящий AutoShardedBot.
+Выводит JSON: сколько логинов опросил каждый процесс, сколько уведомлений отправлено и есть ли дубли:
+    python benchmarks/cluster_bench.py --processes 4 --shards 16 --guilds 2000 --streamers 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+from emulators import UpstreamEmulator  # noqa: E402
+
+class FakeChannel:
+    def __init__(self, guild_id, channel_id, sent):
+        self.id = channel_id
+        self.guild_id = guild_id
+        self.sent = sent
+    
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent.append((self.guild_id, embed.fields[0].value if embed else content))
+
+class FakeGuild:
+    def __init__(self, guild_id, sent):
+        self.id = guild_id
+        self.sent = sent
+    
+    def get_channel(self, channel_id):
+        return FakeChannel(self.id, channel_id, self.sent)
+
+async def run_worker(output_dir):
+    """Процесс кластера: загрузить свою часть подписок и сделать один цикл опроса"""
+    import bot
+    
+    sent = []
+    # Заглушка шлюза: только серверы шардов этого процесса
+    bot.bot.get_guild = lambda guild_id: FakeGuild(guild_id, sent) if bot.is_local_guild(guild_id) else None
+    
+    await bot.bot.setup_hook()
+    logins = set(bot.TWITCH_SUBSCRIPTIONS.logins())
+    started = time.perf_counter()
+    await bot.poll_twitch_streams()
+    elapsed = time.perf_counter() - started
+    await bot.NOTIFICATIONS.stop()
+    
+    bot.bot.loop_monitor.cancel()
+    await bot.STORE.close()
+    await bot.close_http_session()
+    
+    report = {
+        'index': bot.CLUSTER_INDEX,
+        'shards': sorted(bot.SHARD_IDS),
+        'guilds': len(bot.TWITCH_SUBSCRIPTIONS.by_guild),
+        'logins_polled': len(logins),
+        'poll_seconds': round(elapsed, 3),
+        'notifications': sent,
+    }
+    with open(os.path.join(output_dir, f'worker-{bot.CLUSTER_INDEX}.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f)
+
+def seed_store(path, args):
+    """Заполнить базу подписками; возвращает все пары (сервер, стример)"""
+    import bot
+    
+    rng = random.Random(args.seed)
+    store = bot.BotStore(path)
+    pairs = set()
+    
+    async def fill():
+        await store.load()
+        for _ in range(args.guilds):
+            guild_id = rng.getrandbits(63) >> 1  # Похоже на snowflake: шард зависит от старших битов
+            for channel_name in rng.sample(range(args.streamers), args.per_guild):
+                stream = bot.StreamState(f'streamer{channel_name}')
+                store.save_subscription(bot.Subscription(guild_id, guild_id + 1, None, stream))
+                pairs.add((guild_id, f'streamer{channel_name}'))
+        await store.close()
+    
+    asyncio.run(fill())
+    return pairs
+
+def start_emulator(args):
+    """Эмулятор Twitch в отдельном потоке - его делят все процессы"""
+    emulator = UpstreamEmulator(latency_ms=args.latency_ms, live_ratio=args.live_ratio, seed=args.seed)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(emulator.start())
+        ready.set()
+        loop.run_forever()
+    
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    return emulator
+
+def main(args):
+    data_dir = tempfile.mkdtemp()
+    emulator = start_emulator(args)
+    
+    # Настройки для процессов кластера передаются через окружение
+    os.environ.update(emulator.urls())
+    os.environ.update({
+        'BOT_DATA_DIR': data_dir,
+        'BOT_DB_FILE': os.path.join(data_dir, 'bot.db'),
+        'TWITCH_CLIENT_ID': 'bench',
+        'TWITCH_CLIENT_SECRET': 'bench',
+        'METRICS_PORT': '0',
+    })
+    import bot
+    
+    pairs = seed_store(os.environ['BOT_DB_FILE'], args)
+    started = time.perf_counter()
+    bot.run_cluster('bench', processes=args.processes, shard_count=args.shards,
+                    command=[sys.executable, os.path.abspath(__file__), '--worker', data_dir])
+    elapsed = time.perf_counter() - started
+    
+    reports = []
+    for name in sorted(os.listdir(data_dir)):
+        if name.startswith('worker-'):
+            with open(os.path.join(data_dir, name), encoding='utf-8') as f:
+                reports.append(json.load(f))
+    
+    notified = [tuple(item) for report in reports for item in report['notifications']]
+    expected = {pair for pair in pairs if emulator.is_live(pair[1])}
+    unique_logins = len({channel_name for _, channel_name in pairs})
+    
+    summary = {
+        'config': vars(args),
+        'elapsed_s': round(elapsed, 3),
+        'workers': [{key: value for key, value in report.items() if key != 'notifications'} for report in reports],
+        'subscriptions': len(pairs),
+        'unique_logins': unique_logins,
+        'logins_polled_total': sum(report['logins_polled'] for report in reports),
+        'logins_polled_naive': unique_logins * len(reports),  # Если бы каждый процесс опрашивал всех
+        'twitch_calls': emulator.snapshot_calls().get('twitch', 0),
+        'notifications_expected': len(expected),
+        'notifications_sent': len(notified),
+        'duplicates': len(notified) - len(set(notified)),
+        'missing': len(expected - set(notified)),
+    }
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Проверка кластерного режима с заглушкой шлюза')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--guilds', type=int, default=2000)
+    parser.add_argument('--streamers', type=int, default=500)
+    parser.add_argument('--per-guild', type=int, default=3, help='подписок на сервер')
+    parser.add_argument('--live-ratio', type=float, default=0.2)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        asyncio.run(run_worker(sys.argv[2]))
+    else:
+        main(parse_args())
@@ -0,0 +1,140 @@
+"""Бенчмарк обработки входящих сообщений в on_message.
+
+Прогоняет поток фейковых сообщений (в основном обычный чат, немного команд и упоминаний)
+через старую и новую реализацию on_message и выводит сообщений в секунду:
+    python benchmarks/dispatch_bench.py [количество_сообщений]
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import bot  # noqa: E402
+
+GUILDS = 50
+CHANNELS_PER_GUILD = 40
+ALLOWED_PER_GUILD = 10
+
+class FakeUser:
+    """Пользователь или бот"""
+    
+    def __init__(self, user_id, is_bot=False):
+        self.id = user_id
+        self.bot = is_bot
+    
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+class FakeMessage:
+    """Минимальное сообщение Discord для on_message"""
+    
+    def __init__(self, content, author, guild, channel, mentions=()):
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+        self._state = bot.bot._connection
+    
+    async def add_reaction(self, emoji):
+        pass
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+def legacy_is_channel_allowed(ctx, allowed_channels):
+    """Старая проверка: линейный поиск по списку"""
+    guild_id = ctx.guild.id if ctx.guild else None
+    if guild_id not in allowed_channels:
+        return True
+    if not allowed_channels[guild_id]:
+        return True
+    return ctx.channel.id in allowed_channels[guild_id]
+
+async def legacy_on_message(message, allowed_channels):
+    """Старая реализация on_message: до трех вызовов get_context на сообщение"""
+    if message.author.bot:
+        return
+    
+    if message.content.startswith('!'):
+        ctx = await bot.bot.get_context(message)
+        if not legacy_is_channel_allowed(ctx, allowed_channels):
+            return
+    
+    await bot.bot.process_commands(message)
+    
+    if bot.bot.user.mentioned_in(message):
+        ctx = await bot.bot.get_context(message)
+        if legacy_is_channel_allowed(ctx, allowed_channels):
+            await message.add_reaction('👋')
+
+def make_messages(count, me):
+    """Сгенерировать поток сообщений: 85% чат, 10% команды, 5% упоминания бота"""
+    rng = random.Random(42)
+    guilds = [FakeGuild(guild_id) for guild_id in range(GUILDS)]
+    users = [FakeUser(1000 + i) for i in range(200)] + [FakeUser(9000, is_bot=True)]
+    messages = []
+    
+    for _ in range(count):
+        guild = rng.choice(guilds)
+        channel = FakeChannel(guild.id * 1000 + rng.randrange(CHANNELS_PER_GUILD))
+        roll = rng.random()
+        if roll < 0.85:
+            messages.append(FakeMessage('привет всем, как дела?', rng.choice(users), guild, channel))
+        elif roll < 0.95:
+            messages.append(FakeMessage('!крипта btc eth', rng.choice(users), guild, channel))
+        else:
+            messages.append(FakeMessage('эй бот', rng.choice(users), guild, channel, mentions=[me]))
+    return messages
+
+async def measure(name, handler, messages):
+    """Прогнать сообщения через обработчик и посчитать пропускную способность"""
+    started = time.perf_counter()
+    for message in messages:
+        await handler(message)
+    elapsed = time.perf_counter() - started
+    rate = len(messages) / elapsed
+    print(f"{name:<10} {len(messages)} сообщений, {rate:,.0f} сообщений/с")
+    return rate
+
+async def main(count):
+    me = FakeUser(1)
+    bot.bot._connection.user = me
+    
+    invoked = []
+    
+    async def fake_invoke(ctx):
+        # Сами команды не выполняем - измеряем только диспетчеризацию
+        if ctx.command is not None:
+            invoked.append(ctx.invoked_with)
+    
+    bot.bot.invoke = fake_invoke
+    
+    # Разрешенные каналы: старая структура со списками и новая с множествами
+    legacy_allowed = {
+        guild_id: [guild_id * 1000 + i for i in range(0, CHANNELS_PER_GUILD, CHANNELS_PER_GUILD // ALLOWED_PER_GUILD)]
+        for guild_id in range(GUILDS)
+    }
+    bot.ALLOWED_CHANNELS.clear()
+    bot.ALLOWED_CHANNELS.update({guild_id: set(channels) for guild_id, channels in legacy_allowed.items()})
+    
+    messages = make_messages(count, me)
+    
+    before = await measure('До', lambda message: legacy_on_message(message, legacy_allowed), messages)
+    legacy_invoked = len(invoked)
+    invoked.clear()
+    after = await measure('После', bot.on_message, messages)
+    
+    assert legacy_invoked == len(invoked), 'Реализации вызвали разное количество команд'
+    print(f"Ускорение: {after / before:.1f}x")
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000))
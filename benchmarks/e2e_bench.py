@@ -0,0 +1,464 @@
+"""Офлайн end-to-end бенчмарк команд бота на эмулированных API.
+
+Поднимает локальные эмуляторы OpenWeatherMap, CoinGecko, Yahoo Finance и Twitch,
+направляет на них бота и прогоняет команды через фейковый контекст Discord
+с заданной конкурентностью. Результат - JSON с p50/p95/p99, пропускной способностью
+и числом обращений к каждому API:
+    python benchmarks/e2e_bench.py --requests 200 --concurrency 20 --latency-ms 80 --rate-429 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import bot  # noqa: E402
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+from emulators import UpstreamEmulator  # noqa: E402
+
+# Разные написания одних городов: геокодинг нужен один раз на город
+WEATHER_QUERIES = ['москва', 'питер', 'лондон', 'токио, берлин', 'новосибирск 5', 'мск, спб, екб',
+                   'Санкт-Петербург', 'ЛОНДОН', 'Новосибирск']
+CRYPTO_QUERIES = [(), ('btc', 'eth'), ('sol', 'doge', 'ada'), ('btc.d',), ('nasdaq', 'crv'), ('pepe',)]
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.bot = False
+        self.mention = f'<@{user_id}>'
+
+class FakeChannel:
+    """Текстовый канал: считает отправленные уведомления"""
+    
+    type = discord.ChannelType.text
+    send_latency = 0.0  # Задержка ответа Discord на отправку, секунды
+    
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.mention = f'<#{channel_id}>'
+        self.sent = 0
+    
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+    
+    def permissions_for(self, member):
+        # В бенчмарке все пишущие - администраторы сервера
+        return discord.Permissions(administrator=True)
+
+class FakeGuild:
+    """Сервер с ленивым созданием каналов"""
+    
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.channels = {}
+    
+    def get_channel(self, channel_id):
+        if channel_id not in self.channels:
+            self.channels[channel_id] = FakeChannel(channel_id)
+        return self.channels[channel_id]
+
+class FakeContext:
+    """Минимальный commands.Context: запоминает ответ команды"""
+    
+    def __init__(self, guild, channel, author):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.replies = []
+    
+    async def reply(self, content=None, **kwargs):
+        self.replies.append(content if content is not None else kwargs.get('embed'))
+    
+    send = reply
+    
+    def failed(self):
+        """Команда ответила ошибкой"""
+        errors = (bot.PHRASES['error'], bot.PHRASES['weather_error'], bot.PHRASES['weather_unavailable'])
+        return any(isinstance(reply, str) and (reply.startswith('❌') or reply in errors) for reply in self.replies)
+
+class FakeMessage:
+    """Сообщение пользователя для разбора командой бота"""
+    
+    def __init__(self, message_id, content, guild, channel, author):
+        self.id = message_id
+        self.content = content
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.attachments = []
+        self._state = bot.bot._connection
+
+class BenchContext(commands.Context):
+    """Настоящий commands.Context, который запоминает ответы вместо отправки"""
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.replies = []
+    
+    async def reply(self, content=None, **kwargs):
+        self.replies.append(content if content is not None else kwargs.get('embed'))
+    
+    send = reply
+
+async def dispatch(message):
+    """Выполнить сообщение как Discord: разбор префикса и подкоманды, проверки, bot.invoke"""
+    ctx = await bot.bot.get_context(message, cls=BenchContext)
+    await bot.bot.invoke(ctx)
+    return ctx
+
+class Harness:
+    """Фейковые серверы и контексты для прогона команд"""
+    
+    def __init__(self, guilds, seed):
+        self.random = random.Random(seed)
+        self.guilds = {guild_id: FakeGuild(guild_id) for guild_id in range(1, guilds + 1)}
+        self.author = FakeUser(1000)
+        bot.bot.get_guild = self.guilds.get
+        bot.bot._connection.user = FakeUser(1)  # get_context отличает сообщения самого бота
+    
+    def context(self, i):
+        """Контекст i-го запроса: один и тот же i всегда попадает на тот же сервер"""
+        guild = self.guilds[i % len(self.guilds) + 1]
+        return FakeContext(guild, guild.get_channel(guild.id * 100 + self.random.randint(0, 9)), self.author)
+    
+    def sent_notifications(self):
+        return sum(channel.sent for guild in self.guilds.values() for channel in guild.channels.values())
+
+def percentile(values, share):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(share * len(values) + 0.5)) - 1))
+    return values[index]
+
+def reset_caches():
+    """Холодный старт: сбросить все кэши бота между запросами"""
+    bot.WEATHER_CACHE.clear()
+    bot.FORECAST_AGGREGATES.clear()
+    bot.RESPONSE_CACHE.clear()
+    bot.CRYPTO_SNAPSHOT['entries'].clear()
+    bot.COIN_SEARCH_CACHE.clear()
+
+def make_scenarios(harness, args):
+    """Сценарии: имя -> корутина-функция одного запроса (без контроля допуска - он в weather_burst)"""
+    streamers = [f'streamer{i}' for i in range(args.streamers)]
+    
+    async def weather(ctx, i):
+        query = WEATHER_QUERIES[i % len(WEATHER_QUERIES)]
+        await bot.weather.callback.__wrapped__(ctx, city_name=query if i % 8 else None)
+    
+    async def crypto(ctx, i):
+        await bot.crypto_command.callback.__wrapped__(ctx, *CRYPTO_QUERIES[i % len(CRYPTO_QUERIES)])
+    
+    async def twitch_add(ctx, i):
+        await bot.twitch_add.callback.__wrapped__(ctx, channel_input=f'https://twitch.tv/{streamers[i % len(streamers)]}')
+    
+    async def twitch_list(ctx, i):
+        await bot.twitch_list.callback(ctx)
+    
+    async def twitch_poll(ctx, i):
+        await bot.poll_twitch_streams()
+    
+    async def twitch_remove(ctx, i):
+        await bot.twitch_remove.callback(ctx, channel_input=streamers[i % len(streamers)])
+    
+    return {
+        'weather': weather,
+        'crypto': crypto,
+        'twitch_add': twitch_add,
+        'twitch_list': twitch_list,
+        'twitch_poll': twitch_poll,
+        'twitch_remove': twitch_remove,
+    }
+
+def diff_calls(before, after):
+    return {key: after[key] - before.get(key, 0) for key in after if after[key] - before.get(key, 0)}
+
+async def run_scenario(name, call, harness, emulator, args):
+    """Прогнать один сценарий и собрать метрики"""
+    requests = args.poll_cycles if name == 'twitch_poll' else args.requests
+    concurrency = 1 if name == 'twitch_poll' else args.concurrency
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            if args.cold:
+                reset_caches()
+            ctx = harness.context(i)
+            start = time.perf_counter()
+            try:
+                await call(ctx, i)
+            except Exception as e:
+                errors += 1
+                print(f"Ошибка в сценарии {name}: {e}", file=sys.stderr)
+            else:
+                errors += ctx.failed()
+            latencies.append((time.perf_counter() - start) * 1000)
+    
+    calls_before = emulator.snapshot_calls()
+    sent_before = harness.sent_notifications()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    
+    # Уведомления рассылаются в фоне - ждем их отдельно от времени цикла опроса
+    await bot.NOTIFICATIONS.drain()
+    delivery = time.perf_counter() - start - elapsed
+    
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'max_ms': round(latencies[-1], 2),
+        'upstream_calls': diff_calls(calls_before, emulator.snapshot_calls()),
+        'notifications_sent': harness.sent_notifications() - sent_before,
+        'notifications_drain_s': round(delivery, 3),
+    }
+
+async def run_scheduler(harness, emulator, args):
+    """Прогнать планировщик опроса со сжатым интервалом и посмотреть, как распределены запросы"""
+    interval = args.scheduler_interval
+    poller = bot.TwitchPollScheduler(interval=interval, min_interval=interval / 4, max_interval=interval * 8,
+                                     budget=args.scheduler_budget, deadline=interval / 2, batch_window=interval / 24)
+    calls_before = emulator.snapshot_calls()
+    sent_before = harness.sent_notifications()
+    
+    # Запросы к Twitch по секундам - у равномерного планировщика нет всплесков
+    per_second = []
+    last = emulator.snapshot_calls().get('twitch', 0)
+    lags = []
+    poller.start()
+    try:
+        for _ in range(int(args.scheduler_seconds)):
+            await asyncio.sleep(1)
+            current = emulator.snapshot_calls().get('twitch', 0)
+            per_second.append(current - last)
+            last = current
+            lags.append(poller.lag)
+    finally:
+        await poller.stop()
+    await bot.NOTIFICATIONS.drain()
+    
+    stats = poller.get_stats()
+    lags.sort()
+    return {
+        'seconds': args.scheduler_seconds,
+        'interval_s': interval,
+        'budget_per_minute': args.scheduler_budget,
+        'batches': stats['batches'],
+        'checks': stats['checks'],
+        'timeouts': stats['timeouts'],
+        'queue_depth': stats['queue_depth'],
+        'stretch': stats['stretch'],
+        'lag_p50_ms': round(percentile(lags, 0.5) * 1000, 2),
+        'lag_p95_ms': round(percentile(lags, 0.95) * 1000, 2),
+        'requests_per_second_mean': round(sum(per_second) / len(per_second), 2),
+        'requests_per_second_max': max(per_second),
+        'upstream_calls': diff_calls(calls_before, emulator.snapshot_calls()),
+        'notifications_sent': harness.sent_notifications() - sent_before,
+    }
+
+def reset_admission():
+    bot.ADMISSION = bot.AdmissionController(bot.ADMISSION_MAX_ACTIVE, bot.ADMISSION_PER_GUILD, bot.ADMISSION_PER_USER,
+                                            bot.ADMISSION_MAX_QUEUE, bot.ADMISSION_QUEUE_TIMEOUT)
+
+async def run_burst(harness, emulator, args):
+    """Наплыв !погода от немногих пользователей: без контроля допуска и с ним.
+    
+    С контролем допуска команды приходят сообщениями и проходят весь путь bot.invoke.
+    """
+    results = {}
+    for mode in ('without_admission', 'with_admission'):
+        # Оба прогона начинают с пустыми кешами и индексом геокодинга
+        reset_caches()
+        bot.GEOCODER = bot.GeocodingIndex(bot.GEOCODE_NEGATIVE_TTL, bot.GEOCODE_NEGATIVE_SIZE)
+        bot.GEOCODER.add_known(bot.CITIES)
+        reset_admission()
+        emulator.peak_inflight = 0
+        calls_before = emulator.snapshot_calls()
+        latencies = []
+        busy = 0
+        
+        async def one(i):
+            nonlocal busy
+            guild = harness.guilds[i % min(args.burst_guilds, len(harness.guilds)) + 1]
+            channel = guild.get_channel(guild.id * 100)
+            author = FakeUser(2000 + i % args.burst_users)
+            city = f'город{i % args.burst_cities}'
+            start = time.perf_counter()
+            if mode == 'with_admission':
+                ctx = await dispatch(FakeMessage(i, f'!погода {city}', guild, channel, author))
+            else:
+                ctx = FakeContext(guild, channel, author)
+                await bot.weather.callback.__wrapped__(ctx, city_name=city)
+            latencies.append((time.perf_counter() - start) * 1000)
+            busy += ctx.replies == [bot.PHRASES['busy']]
+        
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.burst_requests)))
+        elapsed = time.perf_counter() - start
+        
+        latencies.sort()
+        results[mode] = {
+            'elapsed_s': round(elapsed, 3),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'answered': args.burst_requests - busy,
+            'busy': busy,
+            'upstream_calls': diff_calls(calls_before, emulator.snapshot_calls()),
+            'upstream_peak_inflight': emulator.peak_inflight,
+        }
+        if mode == 'with_admission':
+            results[mode]['admission'] = bot.ADMISSION.get_stats()
+    
+    results['twitch_add'] = await run_twitch_add_burst(harness, args)
+    results['config'] = {'requests': args.burst_requests, 'users': args.burst_users,
+                         'guilds': args.burst_guilds, 'cities': args.burst_cities}
+    return results
+
+async def run_twitch_add_burst(harness, args):
+    """Наплыв сообщений «!twitch добавить»: подкоманда группы тоже проходит контроль допуска"""
+    reset_admission()
+    requests = min(args.burst_requests, args.streamers)
+    
+    async def one(i):
+        guild = harness.guilds[i % min(args.burst_guilds, len(harness.guilds)) + 1]
+        message = FakeMessage(i, f'!twitch добавить streamer{i}', guild, guild.get_channel(guild.id * 100),
+                              FakeUser(2000 + i % args.burst_users))
+        return await dispatch(message)
+    
+    contexts = await asyncio.gather(*(one(i) for i in range(requests)))
+    stats = bot.ADMISSION.get_stats()
+    shed = sum(value for key, value in stats.items() if key.startswith('shed_'))
+    return {
+        'requests': requests,
+        'added': sum(isinstance(reply, str) and reply.startswith('✅') for ctx in contexts for reply in ctx.replies),
+        'busy': sum(ctx.replies == [bot.PHRASES['busy']] for ctx in contexts),
+        'admission': stats,
+        'admission_ok': stats['admitted'] + shed == requests,  # Каждое сообщение прошло через допуск
+    }
+
+def configure_bot(emulator, args, data_dir):
+    """Направить бота на эмуляторы и изолировать хранилище"""
+    for name, url in emulator.urls().items():
+        setattr(bot, name, url)
+    os.environ.setdefault('OPENWEATHER_API_KEY', 'bench')
+    os.environ.setdefault('TWITCH_CLIENT_ID', 'bench')
+    os.environ.setdefault('TWITCH_CLIENT_SECRET', 'bench')
+    
+    bot.STORE = bot.BotStore(os.path.join(data_dir, 'bench.db'))
+    FakeChannel.send_latency = args.send_latency_ms / 1000
+    bot.TWITCH_SUBSCRIPTIONS.clear()
+    bot.ALLOWED_CHANNELS.clear()
+    
+    # Лимиты настоящих API замедлили бы прогон до их квот - по умолчанию снимаем.
+    # Twitch все равно уточнит свой лимит по заголовкам эмулятора, как и в проде
+    if not args.real_limits:
+        for limiter in bot.RATE_LIMITERS.values():
+            limiter.rate = limiter.capacity = limiter.tokens = 1_000_000
+
+def subscribe_streamers(harness, args):
+    """Заполнить подписки для сценария опроса без обращений к API"""
+    for i in range(args.streamers * args.guilds_per_streamer):
+        streamer, copy = divmod(i, args.guilds_per_streamer)
+        guild_id = (streamer * args.guilds_per_streamer + copy) % len(harness.guilds) + 1
+        channel_name = f'streamer{streamer}'
+        bot.TWITCH_SUBSCRIPTIONS.add(guild_id, channel_name, guild_id * 100, is_live=False)
+
+async def main(args):
+    emulator = UpstreamEmulator(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        rate_429=args.rate_429, live_ratio=args.live_ratio, seed=args.seed
+    )
+    await emulator.start()
+    
+    with tempfile.TemporaryDirectory() as data_dir:
+        configure_bot(emulator, args, data_dir)
+        await bot.STORE.load()
+        harness = Harness(args.guilds, args.seed)
+        scenarios = make_scenarios(harness, args)
+        
+        results = {}
+        try:
+            for name in args.scenarios:
+                if name in ('twitch_poll', 'twitch_scheduler'):
+                    subscribe_streamers(harness, args)
+                if name == 'twitch_scheduler':
+                    results[name] = await run_scheduler(harness, emulator, args)
+                elif name == 'weather_burst':
+                    results[name] = await run_burst(harness, emulator, args)
+                else:
+                    results[name] = await run_scenario(name, scenarios[name], harness, emulator, args)
+        finally:
+            await bot.NOTIFICATIONS.stop()
+            await bot.STORE.close()
+            await bot.close_http_session()
+            await emulator.stop()
+    
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'scenarios': results,
+        'upstream_calls_total': emulator.snapshot_calls(),
+        'caches': {
+            'weather': bot.WEATHER_CACHE.get_stats(),
+            'responses': bot.RESPONSE_CACHE.get_stats(),
+            'geocode': bot.GEOCODER.get_stats(),
+        },
+        'rate_limiters': {name: limiter.get_stats() for name, limiter in bot.RATE_LIMITERS.items()},
+        'notifications': bot.NOTIFICATIONS.get_stats(),
+    }
+    
+    output = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+
+def parse_args():
+    scenarios = ['weather', 'crypto', 'twitch_add', 'twitch_list', 'twitch_poll', 'twitch_scheduler', 'twitch_remove',
+                 'weather_burst']
+    parser = argparse.ArgumentParser(description='Офлайн end-to-end бенчмарк команд бота')
+    parser.add_argument('--requests', type=int, default=100, help='запросов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=10, help='одновременных запросов')
+    parser.add_argument('--scenarios', nargs='+', choices=scenarios, default=scenarios)
+    parser.add_argument('--latency-ms', type=float, default=50, help='задержка эмулятора')
+    parser.add_argument('--jitter-ms', type=float, default=10, help='разброс задержки')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--send-latency-ms', type=float, default=0, help='задержка отправки сообщения в Discord')
+    parser.add_argument('--live-ratio', type=float, default=0.2, help='доля стримеров в эфире')
+    parser.add_argument('--guilds', type=int, default=20, help='фейковых серверов')
+    parser.add_argument('--streamers', type=int, default=300, help='стримеров в сценариях Twitch')
+    parser.add_argument('--guilds-per-streamer', type=int, default=3, help='подписок на одного стримера при опросе')
+    parser.add_argument('--poll-cycles', type=int, default=5, help='циклов опроса Twitch')
+    parser.add_argument('--scheduler-seconds', type=float, default=20, help='сколько работает планировщик опроса')
+    parser.add_argument('--scheduler-interval', type=float, default=10, help='сжатый базовый интервал планировщика')
+    parser.add_argument('--scheduler-budget', type=int, default=60, help='бюджет планировщика, запросов в минуту')
+    parser.add_argument('--burst-requests', type=int, default=1000, help='одновременных !погода в наплыве')
+    parser.add_argument('--burst-users', type=int, default=20, help='сколько пользователей шлют наплыв')
+    parser.add_argument('--burst-guilds', type=int, default=5)
+    parser.add_argument('--burst-cities', type=int, default=200, help='разных городов в наплыве')
+    parser.add_argument('--cold', action='store_true', help='сбрасывать кэши перед каждым запросом')
+    parser.add_argument('--real-limits', action='store_true', help='оставить лимиты запросов настоящих API')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='сохранить JSON в файл')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
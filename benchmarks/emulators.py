@@ -0,0 +1,365 @@
+"""Локальные эмуляторы внешних API для офлайн бенчмарков.
+
+Поднимает один aiohttp сервер с маршрутами OpenWeatherMap, CoinGecko, Yahoo Finance
+и Twitch (Helix + OAuth). Задержка, доля ошибок и доля ответов 429 настраиваются,
+количество обращений считается по каждому API.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+
+# Префиксы маршрутов эмулятора для каждого API
+OPENWEATHER_PREFIX = '/openweather'
+COINGECKO_PREFIX = '/coingecko'
+YAHOO_PREFIX = '/yahoo'
+TWITCH_API_PREFIX = '/twitch/helix'
+TWITCH_OAUTH_PREFIX = '/twitch/oauth2'
+TWITCH_EVENTSUB_PATH = '/twitch/eventsub/ws'
+
+COINS = [
+    ('bitcoin', 'btc', 'Bitcoin'), ('ethereum', 'eth', 'Ethereum'), ('tether', 'usdt', 'Tether'),
+    ('binancecoin', 'bnb', 'BNB'), ('ripple', 'xrp', 'XRP'), ('cardano', 'ada', 'Cardano'),
+    ('dogecoin', 'doge', 'Dogecoin'), ('solana', 'sol', 'Solana'), ('polkadot', 'dot', 'Polkadot'),
+    ('curve-dao-token', 'crv', 'Curve DAO'), ('uniswap', 'uni', 'Uniswap'), ('chainlink', 'link', 'Chainlink'),
+    ('pepe', 'pepe', 'Pepe'), ('pepe-bridged', 'pepe', 'Pepe (bridged)'),
+]
+
+def upstream_of(path):
+    """Определить API по пути запроса"""
+    for name, prefix in (('openweather', OPENWEATHER_PREFIX), ('coingecko', COINGECKO_PREFIX),
+                         ('yahoo', YAHOO_PREFIX), ('twitch', '/twitch')):
+        if path.startswith(prefix):
+            return name
+    return 'unknown'
+
+class UpstreamEmulator:
+    """Эмулятор внешних API с настраиваемыми задержкой, ошибками и 429"""
+    
+    def __init__(self, latency_ms=50, jitter_ms=10, error_rate=0.0, rate_429=0.0, live_ratio=0.2, seed=42,
+                 eventsub_keepalive=10):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.live_ratio = live_ratio
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.inflight = 0                 # HTTP запросов обрабатывается сейчас
+        self.peak_inflight = 0
+        self.runner = None
+        self.base_url = None
+        self.token_counter = 0
+        self.twitch_window = (0, 0)       # (начало минутного окна, запросов в нем)
+        self.live_overrides = {}          # login -> в эфире ли (поверх детерминированного статуса)
+        self.stream_restarts = {}         # login -> сколько раз стрим перезапускался (меняет ID стрима)
+        self.eventsub_keepalive = eventsub_keepalive
+        self.eventsub_sessions = {}       # session_id -> открытое WebSocket соединение
+        self.eventsub_subscriptions = {}  # id -> {'type', 'user_id', 'session_id'}
+        self.message_ids = itertools.count()
+    
+    def reset_calls(self):
+        """Сбросить счетчики обращений"""
+        self.calls = {}
+    
+    def snapshot_calls(self):
+        """Текущие счетчики обращений"""
+        return dict(self.calls)
+    
+    def count(self, key):
+        self.calls[key] = self.calls.get(key, 0) + 1
+    
+    @web.middleware
+    async def middleware(self, request, handler):
+        """Общая для всех API задержка, ошибки и 429"""
+        upstream = upstream_of(request.path)
+        self.count(upstream)
+        if request.path == TWITCH_EVENTSUB_PATH:  # Сбои эмулируются только для HTTP
+            return await handler(request)
+        
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            delay = max(0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            await asyncio.sleep(delay)
+            
+            roll = self.random.random()
+            if roll < self.rate_429:
+                self.count(f'{upstream}_429')
+                return web.json_response({'error': 'rate limited'}, status=429, headers={'Retry-After': '0'})
+            if roll < self.rate_429 + self.error_rate:
+                self.count(f'{upstream}_errors')
+                return web.json_response({'error': 'internal'}, status=500)
+            return await handler(request)
+        finally:
+            self.inflight -= 1
+    
+    # OpenWeatherMap
+    async def forecast(self, request):
+        city = request.query.get('q')
+        if city and city.lower().startswith('nowhere'):
+            return web.json_response({'cod': '404', 'message': 'city not found'}, status=404)
+        
+        now = int(time.time()) // 10800 * 10800
+        seed = zlib.crc32((city or request.query.get('lat', '')).encode())
+        items = []
+        for i in range(40):
+            base = (seed % 30) - 10 + (i % 8) - 4
+            items.append({
+                'dt': now + i * 10800,
+                'main': {'temp_min': base - 1.5, 'temp_max': base + 1.5},
+                'weather': [{'description': ['ясно', 'облачно', 'небольшой дождь'][(seed + i // 4) % 3]}],
+                'wind': {'speed': round(1 + (seed + i) % 7 * 0.7, 1)}
+            })
+        return web.json_response({
+            'cod': '200',
+            'list': items,
+            'city': {'id': seed, 'name': city or 'Coords', 'timezone': 10800,
+                     'coord': {'lat': float(request.query.get('lat', 55.75)), 'lon': float(request.query.get('lon', 37.61))}}
+        })
+    
+    async def geocode(self, request):
+        query = request.query.get('q', '')
+        if query.lower().startswith('nowhere'):
+            return web.json_response([])
+        seed = zlib.crc32(query.encode())
+        return web.json_response([{
+            'name': query, 'local_names': {'ru': query},
+            'lat': 40 + seed % 2000 / 100, 'lon': 20 + seed % 3000 / 100, 'country': 'RU'
+        }])
+    
+    # CoinGecko
+    async def simple_price(self, request):
+        ids = [coin_id for coin_id in request.query.get('ids', '').split(',') if coin_id]
+        known = {coin_id for coin_id, _, _ in COINS}
+        return web.json_response({
+            coin_id: {
+                'usd': 10 + zlib.crc32(coin_id.encode()) % 50000,
+                'usd_24h_change': (zlib.crc32(coin_id.encode()) % 1000 - 500) / 100,
+                'usd_market_cap': 1_000_000_000 + zlib.crc32(coin_id.encode()) % 10 ** 9
+            }
+            for coin_id in ids if coin_id in known
+        })
+    
+    async def global_data(self, request):
+        return web.json_response({'data': {'market_cap_percentage': {'btc': 54.3, 'eth': 17.1}}})
+    
+    async def search(self, request):
+        query = request.query.get('query', '').lower()
+        return web.json_response({'coins': [
+            {'id': coin_id, 'symbol': symbol.upper(), 'name': name}
+            for coin_id, symbol, name in COINS if query in (symbol, coin_id)
+        ]})
+    
+    async def coins_list(self, request):
+        return web.json_response([{'id': coin_id, 'symbol': symbol, 'name': name} for coin_id, symbol, name in COINS])
+    
+    async def coins_markets(self, request):
+        if request.query.get('page', '1') != '1':
+            return web.json_response([])
+        return web.json_response([{'id': coin_id} for coin_id, _, _ in COINS])
+    
+    # Yahoo Finance
+    async def chart(self, request):
+        return web.json_response({'chart': {'result': [{'meta': {'regularMarketPrice': 16120.4, 'previousClose': 15980.1}}]}})
+    
+    # Twitch
+    async def token(self, request):
+        self.token_counter += 1
+        return web.json_response({'access_token': f'emulator-token-{self.token_counter}', 'expires_in': 3600, 'token_type': 'bearer'})
+    
+    def is_live(self, login):
+        """Детерминированно решить, идет ли стрим"""
+        if login in self.live_overrides:
+            return self.live_overrides[login]
+        return zlib.crc32(login.encode()) % 1000 < self.live_ratio * 1000
+    
+    def stream_id(self, login):
+        return f'stream-{login}-{self.stream_restarts.get(login, 0)}'
+    
+    def restart_stream(self, login):
+        """Стрим закончился и начался снова: у нового стрима другой ID"""
+        self.stream_restarts[login] = self.stream_restarts.get(login, 0) + 1
+    
+    @staticmethod
+    def user_id(login):
+        return str(zlib.crc32(login.encode()))
+    
+    async def streams(self, request):
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return web.json_response({'error': 'Unauthorized'}, status=401)
+        
+        logins = request.query.getall('user_login', [])
+        data = [
+            {
+                'id': self.stream_id(login), 'user_login': login, 'user_name': login,
+                'game_name': 'Just Chatting', 'title': f'Стрим {login}', 'viewer_count': zlib.crc32(login.encode()) % 5000,
+                'started_at': '2024-01-01T00:00:00Z', 'type': 'live'
+            }
+            for login in logins if self.is_live(login)
+        ]
+        # Квота Helix: 800 запросов в минуту, остаток и сброс в заголовках
+        window_start, used = self.twitch_window
+        now = int(time.time())
+        if now - window_start >= 60:
+            window_start, used = now, 0
+        used += 1
+        self.twitch_window = (window_start, used)
+        headers = {'Ratelimit-Limit': '800', 'Ratelimit-Remaining': str(max(0, 800 - used)), 'Ratelimit-Reset': str(window_start + 60)}
+        return web.json_response({'data': data}, headers=headers)
+    
+    async def users(self, request):
+        logins = request.query.getall('login', [])
+        return web.json_response({'data': [
+            {'id': self.user_id(login), 'login': login, 'display_name': login} for login in logins
+        ]})
+    
+    # Twitch EventSub (WebSocket)
+    async def create_subscription(self, request):
+        body = await request.json()
+        session_id = body['transport'].get('session_id')
+        if session_id not in self.eventsub_sessions:
+            return web.json_response({'error': 'Bad Request', 'message': 'session does not exist'}, status=400)
+        
+        subscription_id = str(uuid.uuid4())
+        self.eventsub_subscriptions[subscription_id] = {
+            'type': body['type'], 'user_id': body['condition']['broadcaster_user_id'], 'session_id': session_id
+        }
+        return web.json_response({'data': [{'id': subscription_id, 'status': 'enabled', 'type': body['type']}]}, status=202)
+    
+    async def delete_subscription(self, request):
+        if self.eventsub_subscriptions.pop(request.query.get('id'), None) is None:
+            return web.json_response({'error': 'Not Found'}, status=404)
+        return web.Response(status=204)
+    
+    def eventsub_message(self, message_type, payload, subscription_type=None):
+        metadata = {
+            'message_id': f'msg-{next(self.message_ids)}',
+            'message_type': message_type,
+            'message_timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        if subscription_type:
+            metadata['subscription_type'] = subscription_type
+            metadata['subscription_version'] = '1'
+        return json.dumps({'metadata': metadata, 'payload': payload})
+    
+    async def eventsub_ws(self, request):
+        """Сессия EventSub: welcome, keepalive и перенос по ?migrate=<session_id>"""
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        
+        migrated = request.query.get('migrate')
+        session_id = migrated if migrated in self.eventsub_sessions else str(uuid.uuid4())
+        old_ws = self.eventsub_sessions.get(session_id)
+        self.eventsub_sessions[session_id] = ws
+        
+        session = {
+            'id': session_id, 'status': 'connected', 'reconnect_url': None,
+            'keepalive_timeout_seconds': None if old_ws else self.eventsub_keepalive,
+            'connected_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        await ws.send_str(self.eventsub_message('session_welcome', {'session': session}))
+        if old_ws is not None:  # Перенос завершен - старое соединение закрывает сервер
+            await old_ws.close()
+        
+        try:
+            while not ws.closed:
+                try:
+                    msg = await ws.receive(timeout=self.eventsub_keepalive)
+                except asyncio.TimeoutError:
+                    await ws.send_str(self.eventsub_message('session_keepalive', {}))
+                    continue
+                if msg.type in (web.WSMsgType.CLOSE, web.WSMsgType.CLOSED, web.WSMsgType.ERROR):
+                    break
+        finally:
+            # Закрылось текущее соединение сессии (а не старое после переноса) - подписки удаляются
+            if self.eventsub_sessions.get(session_id) is ws:
+                del self.eventsub_sessions[session_id]
+                for subscription_id, subscription in list(self.eventsub_subscriptions.items()):
+                    if subscription['session_id'] == session_id:
+                        del self.eventsub_subscriptions[subscription_id]
+        return ws
+    
+    async def eventsub_notify(self, login, online=True):
+        """Стример начал или закончил стрим: обновить статус и разослать события подписчикам"""
+        self.live_overrides[login] = online
+        event_type = 'stream.online' if online else 'stream.offline'
+        event = {'broadcaster_user_id': self.user_id(login), 'broadcaster_user_login': login, 'broadcaster_user_name': login}
+        if online:
+            event.update({'id': self.stream_id(login), 'type': 'live', 'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+        
+        sent = 0
+        for subscription_id, subscription in list(self.eventsub_subscriptions.items()):
+            ws = self.eventsub_sessions.get(subscription['session_id'])
+            if subscription['type'] == event_type and subscription['user_id'] == event['broadcaster_user_id'] and ws is not None:
+                payload = {'subscription': {'id': subscription_id, 'type': event_type, 'version': '1'}, 'event': event}
+                await ws.send_str(self.eventsub_message('notification', payload, event_type))
+                sent += 1
+        return sent
+    
+    async def eventsub_reconnect(self):
+        """Попросить клиентов перенести сессии (как при обслуживании серверов Twitch)"""
+        for session_id, ws in list(self.eventsub_sessions.items()):
+            session = {'id': session_id, 'status': 'reconnecting', 'keepalive_timeout_seconds': None,
+                       'reconnect_url': f'{self.ws_url()}?migrate={session_id}'}
+            await ws.send_str(self.eventsub_message('session_reconnect', {'session': session}))
+    
+    async def eventsub_drop(self):
+        """Оборвать все соединения (подписки пропадают вместе с сессиями)"""
+        for ws in list(self.eventsub_sessions.values()):
+            await ws.close(code=1011)
+    
+    def ws_url(self):
+        return self.base_url.replace('http://', 'ws://') + TWITCH_EVENTSUB_PATH
+    
+    def make_app(self):
+        """Собрать приложение со всеми маршрутами"""
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get(f'{OPENWEATHER_PREFIX}/data/2.5/forecast', self.forecast)
+        app.router.add_get(f'{OPENWEATHER_PREFIX}/geo/1.0/direct', self.geocode)
+        app.router.add_get(f'{COINGECKO_PREFIX}/simple/price', self.simple_price)
+        app.router.add_get(f'{COINGECKO_PREFIX}/global', self.global_data)
+        app.router.add_get(f'{COINGECKO_PREFIX}/search', self.search)
+        app.router.add_get(f'{COINGECKO_PREFIX}/coins/list', self.coins_list)
+        app.router.add_get(f'{COINGECKO_PREFIX}/coins/markets', self.coins_markets)
+        app.router.add_get(YAHOO_PREFIX + '/v8/finance/chart/{symbol}', self.chart)
+        app.router.add_post(f'{TWITCH_OAUTH_PREFIX}/token', self.token)
+        app.router.add_get(f'{TWITCH_API_PREFIX}/streams', self.streams)
+        app.router.add_get(f'{TWITCH_API_PREFIX}/users', self.users)
+        app.router.add_post(f'{TWITCH_API_PREFIX}/eventsub/subscriptions', self.create_subscription)
+        app.router.add_delete(f'{TWITCH_API_PREFIX}/eventsub/subscriptions', self.delete_subscription)
+        app.router.add_get(TWITCH_EVENTSUB_PATH, self.eventsub_ws)
+        return app
+    
+    async def start(self, host='127.0.0.1', port=0):
+        """Запустить эмулятор и вернуть его адрес"""
+        self.runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+    
+    async def stop(self):
+        """Остановить эмулятор"""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+    
+    def urls(self):
+        """Адреса API для переменных окружения / модуля bot"""
+        return {
+            'OPENWEATHER_API_URL': f'{self.base_url}{OPENWEATHER_PREFIX}/data/2.5',
+            'OPENWEATHER_GEO_URL': f'{self.base_url}{OPENWEATHER_PREFIX}/geo/1.0',
+            'COINGECKO_API_URL': f'{self.base_url}{COINGECKO_PREFIX}',
+            'YAHOO_FINANCE_URL': f'{self.base_url}{YAHOO_PREFIX}',
+            'TWITCH_API_URL': f'{self.base_url}{TWITCH_API_PREFIX}',
+            'TWITCH_OAUTH_URL': f'{self.base_url}{TWITCH_OAUTH_PREFIX}',
+            'TWITCH_EVENTSUB_URL': self.ws_url(),
+        }
@@ -0,0 +1,172 @@
+"""Бенчмарк уведомлений Twitch через EventSub против локального эмулятора.
+
+Подписывает бота на стримеров через эмулятор EventSub (WebSocket + Helix), затем:
+  1. стримеры начинают стримы - замеряется время от события до отправки уведомлений;
+  2. сервер просит перенести сессию (session_reconnect) - события после переноса должны доходить;
+  3. соединение обрывается, пока стример выходит в эфир - после переподключения
+     статус сверяется пакетным опросом и уведомление все равно отправляется.
+Выводит JSON с задержками, числом обращений к API и статистикой клиента:
+    python benchmarks/eventsub_bench.py --streamers 100 --guilds 50 --events 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import bot  # noqa: E402
+from emulators import UpstreamEmulator  # noqa: E402
+
+class FakeChannel:
+    def __init__(self, sent):
+        self.sent = sent
+    
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent.append((embed.fields[0].value, time.perf_counter()))
+
+class FakeGuild:
+    def __init__(self, guild_id, sent):
+        self.id = guild_id
+        self.sent = sent
+    
+    def get_channel(self, channel_id):
+        return FakeChannel(self.sent)
+
+async def wait_for(condition, timeout):
+    """Ждать выполнения условия не дольше timeout секунд"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.005)
+    return True
+
+def percentile(values, share):
+    values = sorted(values)
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(share * len(values)))] * 1000, 2)
+
+async def go_live(emulator, sent, login, expected, timeout):
+    """Стример выходит в эфир; задержка до последнего уведомления по его серверам"""
+    before = len(sent)
+    started = time.perf_counter()
+    await emulator.eventsub_notify(login, online=True)
+    delivered = await wait_for(lambda: sum(1 for name, _ in sent[before:] if name == login) >= expected, timeout)
+    return (max(at for name, at in sent[before:] if name == login) - started) if delivered else None
+
+async def main(args):
+    rng = random.Random(args.seed)
+    emulator = UpstreamEmulator(latency_ms=args.latency_ms, live_ratio=0.0, seed=args.seed, eventsub_keepalive=args.keepalive)
+    await emulator.start()
+    
+    data_dir = tempfile.mkdtemp()
+    for name, url in emulator.urls().items():
+        setattr(bot, name, url)
+    os.environ.setdefault('TWITCH_CLIENT_ID', 'bench')
+    os.environ.setdefault('TWITCH_CLIENT_SECRET', 'bench')
+    bot.STORE = bot.BotStore(os.path.join(data_dir, 'bench.db'))
+    bot.TWITCH_EVENTSUB.url = emulator.ws_url()
+    bot.TWITCH_EVENTSUB.token = 'bench-user-token'
+    
+    sent = []
+    guilds = {guild_id: FakeGuild(guild_id, sent) for guild_id in range(1, args.guilds + 1)}
+    bot.bot.get_guild = guilds.get
+    
+    streamers = [f'streamer{i}' for i in range(args.streamers)]
+    followers = {login: 0 for login in streamers}
+    for guild_id in guilds:
+        for login in rng.sample(streamers, min(args.per_guild, len(streamers))):
+            bot.TWITCH_SUBSCRIPTIONS.add(guild_id, login, guild_id, is_live=False)
+            followers[login] += 1
+    followed = [login for login in streamers if followers[login]]
+    wanted = min(len(followed), bot.TWITCH_EVENTSUB.max_subscriptions // 2)
+    
+    report = {'config': vars(args)}
+    try:
+        started = time.perf_counter()
+        bot.TWITCH_EVENTSUB.start()
+        subscribed = await wait_for(lambda: len(bot.TWITCH_EVENTSUB.covered) >= wanted, args.timeout)
+        report['subscribe'] = {
+            'ok': subscribed,
+            'covered': len(bot.TWITCH_EVENTSUB.covered),
+            'followed_streamers': len(followed),
+            'seconds': round(time.perf_counter() - started, 3),
+            'upstream_calls': emulator.snapshot_calls(),
+        }
+        
+        # 1. Задержка уведомлений
+        calls_before = emulator.snapshot_calls().get('twitch', 0)
+        offline = [login for login in followed if login in bot.TWITCH_EVENTSUB.covered]
+        rng.shuffle(offline)
+        latencies = []
+        for login in offline[:args.events]:
+            latency = await go_live(emulator, sent, login, followers[login], args.timeout)
+            if latency is not None:
+                latencies.append(latency)
+        report['notifications'] = {
+            'events': min(args.events, len(offline)),
+            'delivered': len(latencies),
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'twitch_calls': emulator.snapshot_calls().get('twitch', 0) - calls_before,
+            # При опросе уведомление в среднем приходит через половину интервала
+            'polling_expected_mean_ms': bot.TWITCH_POLL_INTERVAL * 500,
+        }
+        offline = offline[args.events:]
+        
+        # 2. Перенос сессии
+        session_before = bot.TWITCH_EVENTSUB.session_id
+        await emulator.eventsub_reconnect()
+        migrated = await wait_for(lambda: bot.TWITCH_EVENTSUB.stats['migrations'] >= 1, args.timeout)
+        latency = await go_live(emulator, sent, offline.pop(), 1, args.timeout) if migrated and offline else None
+        report['migration'] = {
+            'ok': migrated and latency is not None,
+            'same_session': bot.TWITCH_EVENTSUB.session_id == session_before,
+            'covered': len(bot.TWITCH_EVENTSUB.covered),
+            'latency_ms': round(latency * 1000, 2) if latency is not None else None,
+        }
+        
+        # 3. Обрыв: стример выходит в эфир, пока соединения нет
+        login = offline.pop()
+        await emulator.eventsub_drop()
+        await wait_for(lambda: bot.TWITCH_EVENTSUB.session_id is None, args.timeout)
+        emulator.live_overrides[login] = True
+        before = len(sent)
+        started = time.perf_counter()
+        recovered = await wait_for(lambda: any(name == login for name, _ in sent[before:]), args.timeout + 5)
+        report['reconnect'] = {
+            'ok': recovered,
+            'seconds': round(time.perf_counter() - started, 3),
+            'covered': len(bot.TWITCH_EVENTSUB.covered),
+        }
+        report['client'] = bot.TWITCH_EVENTSUB.get_stats()
+    finally:
+        await bot.TWITCH_EVENTSUB.stop()
+        await bot.NOTIFICATIONS.stop()
+        await bot.STORE.close()
+        await bot.close_http_session()
+        await emulator.stop()
+    
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк Twitch EventSub против эмулятора')
+    parser.add_argument('--streamers', type=int, default=100)
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--per-guild', type=int, default=5, help='подписок на сервер')
+    parser.add_argument('--events', type=int, default=30, help='сколько стримеров выйдет в эфир')
+    parser.add_argument('--latency-ms', type=float, default=20, help='задержка Helix в эмуляторе')
+    parser.add_argument('--keepalive', type=int, default=10, help='keepalive_timeout_seconds эмулятора')
+    parser.add_argument('--timeout', type=float, default=15, help='ожидание каждого шага, секунды')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,66 @@
+"""Бенчмарк общего HTTP клиента против отдельной сессии на каждый запрос.
+
+Запускает локальный мок OpenWeatherMap и сравнивает задержку одного запроса:
+    python benchmarks/http_client_bench.py [количество_запросов]
+"""
+import asyncio
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import bot  # noqa: E402
+
+FORECAST = {'cod': '200', 'list': [], 'city': {'name': 'Москва', 'timezone': 10800}}
+
+async def forecast_handler(request):
+    """Ответ мок-сервера на /forecast"""
+    return web.json_response(FORECAST)
+
+async def start_mock_server():
+    """Запустить мок OpenWeatherMap на случайном порту"""
+    app = web.Application()
+    app.router.add_get('/forecast', forecast_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+async def fetch_with_new_session(base_url):
+    """Старое поведение: новая сессия (коннектор, DNS, соединение) на каждый запрос"""
+    url = f"{base_url}/forecast?lat=55.7558&lon=37.6176&appid=bench&units=metric&lang=ru"
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            return await response.json()
+
+async def measure(name, func, count):
+    """Измерить среднюю задержку последовательных запросов"""
+    started = time.perf_counter()
+    for _ in range(count):
+        await func()
+    elapsed = time.perf_counter() - started
+    per_request_ms = elapsed / count * 1000
+    print(f"{name:<28} {count} запросов, {per_request_ms:.3f} мс/запрос")
+    return per_request_ms
+
+async def main(count):
+    runner, base_url = await start_mock_server()
+    bot.OPENWEATHER_API_URL = base_url
+    # Меряем пул соединений, а не лимит бесплатного тарифа OpenWeatherMap (60 запросов в минуту)
+    bot.RATE_LIMITERS['openweather'] = bot.RateLimiter('openweather', rate=1_000_000, capacity=1_000_000)
+    
+    try:
+        before = await measure('Сессия на каждый запрос', lambda: fetch_with_new_session(base_url), count)
+        after = await measure('Общая сессия (пул)', lambda: bot.fetch_weather_forecast('bench', 55.7558, 37.6176), count)
+        print(f"Экономия: {before - after:.3f} мс/запрос ({before / after:.1f}x)")
+    finally:
+        await bot.close_http_session()
+        await runner.cleanup()
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
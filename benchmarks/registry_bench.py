@@ -0,0 +1,151 @@
+"""Бенчмарк реестра подписок Twitch: память и поиск на большом числе подписок.
+
+Строит одни и те же подписки в старой структуре (вложенные словари по серверам) и в
+SubscriptionRegistry, затем сравнивает занятую память (tracemalloc), поиск подписчиков
+стримера, разбор ответа опроса и удаление подписок удаленного канала Discord:
+    python benchmarks/registry_bench.py [количество_подписок]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import bot  # noqa: E402
+
+GUILDS_SHARE = 0.05      # Серверов на подписку: 100k подписок - 5000 серверов
+STREAMERS_SHARE = 0.2    # Стримеров на подписку
+CHANNELS_PER_GUILD = 3   # Каналов для уведомлений на сервере
+CUSTOM_MESSAGE_SHARE = 0.1
+LIVE_SHARE = 0.05        # Сколько стримеров в эфире в одном ответе опроса
+
+def make_rows(count):
+    """Подписки (guild_id, login, channel_id, message) со степенным распределением популярности"""
+    rng = random.Random(42)
+    guilds = max(1, int(count * GUILDS_SHARE))
+    streamers = max(1, int(count * STREAMERS_SHARE))
+    rows = {}
+    while len(rows) < count:
+        guild_id = 10**17 + rng.randrange(guilds)
+        login = f'streamer{int(streamers * rng.random() ** 3)}'  # Популярных стримеров мало
+        channel_id = guild_id * 10 + rng.randrange(CHANNELS_PER_GUILD)
+        message = 'Стрим начался, заходите!' if rng.random() < CUSTOM_MESSAGE_SHARE else None
+        # Строки из базы каждый раз новые - как при загрузке из SQLite
+        rows[(guild_id, login)] = (guild_id, ''.join(login), channel_id, ''.join(message) if message else None)
+    return list(rows.values())
+
+def build_legacy(rows):
+    """Старая структура: {guild_id: {login: {'channel_id', 'message', 'is_live'}}}"""
+    subscriptions = {}
+    for guild_id, login, channel_id, message in rows:
+        subscriptions.setdefault(guild_id, {})[login] = {
+            'channel_id': channel_id,
+            'message': message or bot.default_twitch_message(login),
+            'is_live': False
+        }
+    return subscriptions
+
+def build_registry(rows):
+    registry = bot.SubscriptionRegistry()
+    for guild_id, login, channel_id, message in rows:
+        registry.add(guild_id, login, channel_id, message)
+    return registry
+
+def measure_memory(build, count):
+    """Сколько памяти занимает построенная структура (строки загрузки к этому моменту освобождены)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rows = make_rows(count)
+    structure = build(rows)
+    del rows
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return structure, used
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat, result
+
+def legacy_followers(subscriptions, login):
+    return [(guild_id, channels[login]) for guild_id, channels in subscriptions.items() if login in channels]
+
+def legacy_apply(subscriptions, streams):
+    """Старый разбор ответа опроса: обход всех серверов и подписок"""
+    started = 0
+    for guild_id, channels in subscriptions.items():
+        for login, info in channels.items():
+            if login not in streams:
+                continue
+            if streams[login]:
+                if not info['is_live']:
+                    info['is_live'] = True
+                    started += 1
+            else:
+                info['is_live'] = False
+    return started
+
+def registry_apply(registry, streams):
+    started = 0
+    for login, stream_info in streams.items():
+        if registry.set_live(login, bool(stream_info)):
+            started += sum(1 for _ in registry.followers(login))
+    return started
+
+def legacy_remove_channel(subscriptions, channel_id):
+    removed = 0
+    for channels in subscriptions.values():
+        for login in [login for login, info in channels.items() if info['channel_id'] == channel_id]:
+            del channels[login]
+            removed += 1
+    return removed
+
+def check_shared_state():
+    """Подписка нового сервера на уже отслеживаемого стримера не меняет общий статус стрима"""
+    registry = bot.SubscriptionRegistry()
+    registry.add(1, 'x', 10)
+    registry.add(2, 'x', 20, is_live=True)
+    assert not registry.stream('x').is_live
+    assert registry.set_live('x', True, 'stream-1'), 'подписчики сервера 1 не получат уведомление'
+
+def report(name, before, after, unit='мс', scale=1000):
+    print(f"{name:<28} до {before * scale:>10.3f} {unit}   после {after * scale:>10.3f} {unit}   "
+          f"{before / after if after else float('inf'):>8.1f}x")
+
+def main(count):
+    check_shared_state()
+    legacy, legacy_memory = measure_memory(build_legacy, count)
+    registry, registry_memory = measure_memory(build_registry, count)
+    rows = make_rows(count)
+    print(f"Подписок: {len(registry)}, серверов: {len(registry.by_guild)}, стримеров: {len(registry.streams)}")
+    print(f"{'Память':<28} до {legacy_memory / 2**20:>10.1f} МБ   после {registry_memory / 2**20:>10.1f} МБ   "
+          f"{legacy_memory / registry_memory:>8.1f}x")
+    
+    # Подписчики самого популярного стримера
+    popular = max(registry.streams, key=lambda login: len(registry.by_login[login]))
+    before, legacy_result = timed(lambda: legacy_followers(legacy, popular), 20)
+    after, result = timed(lambda: list(registry.followers(popular)), 20)
+    assert len(legacy_result) == len(result)
+    report(f'Подписчики ({len(result)})', before, after)
+    
+    # Ответ опроса: пачка из 100 логинов, часть в эфире
+    rng = random.Random(7)
+    streams = {login: ({'title': 'live'} if rng.random() < LIVE_SHARE else None)
+               for login in rng.sample(sorted(registry.streams), min(100, len(registry.streams)))}
+    before, legacy_started = timed(lambda: legacy_apply(legacy, streams), 5)
+    for login in streams:
+        registry.set_live(login, False)
+    after, started = timed(lambda: registry_apply(registry, streams), 5)
+    report('Разбор пачки опроса', before, after)
+    
+    # Удаление канала Discord
+    channel_id = rows[0][2]
+    before, legacy_removed = timed(lambda: legacy_remove_channel(legacy, channel_id), 1)
+    after, removed = timed(lambda: registry.remove_channel(channel_id), 1)
+    assert legacy_removed == len(removed)
+    report(f'Удаление канала ({len(removed)})', before, after)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,169 @@
+"""Проверка быстрого перезапуска: снимок состояния против холодного старта.
+
+Заполняет базу подписками и дважды запускает процесс бота с заглушкой шлюза Discord: первый запуск
+опрашивает Twitch, получает погоду и котировки и при остановке пишет снимок, второй - перезапуск.
+Между запусками часть стримов перезапускается (новый ID стрима) - о них уведомление нужно.
+То же повторяется без снимка. Выводит JSON: уведомления и обращения к API после перезапуска:
+    python benchmarks/restart_bench.py --guilds 500 --streamers 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+from emulators import UpstreamEmulator  # noqa: E402
+
+class FakeChannel:
+    def __init__(self, guild_id, sent):
+        self.guild_id = guild_id
+        self.sent = sent
+    
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent.append((self.guild_id, embed.fields[0].value if embed else content))
+
+class FakeGuild:
+    def __init__(self, guild_id, sent):
+        self.id = guild_id
+        self.sent = sent
+    
+    def get_channel(self, channel_id):
+        return FakeChannel(self.id, self.sent)
+
+async def run_worker():
+    """Один запуск бота: восстановление, опрос Twitch, погода и котировки, остановка со снимком"""
+    import bot
+    
+    sent = []
+    bot.bot.get_guild = lambda guild_id: FakeGuild(guild_id, sent)
+    
+    await bot.bot.setup_hook()
+    await bot.poll_twitch_streams()
+    await bot.NOTIFICATIONS.stop()
+    
+    # Как после on_ready: фоновое обновление котировок и команды пользователей
+    await bot.crypto_ticker()
+    await bot.get_market_data(bot.CRYPTO_DEFAULT_SYMBOLS)
+    await asyncio.gather(*(bot.get_weather_forecast('bench', city['lat'], city['lon']) for city in bot.CITIES.values()))
+    
+    # Остановка, как в EbilBotMixin.close
+    bot.bot.loop_monitor.cancel()
+    await bot.TWITCH_POLLER.stop()
+    await bot.save_snapshot()
+    await bot.STORE.close()
+    await bot.close_http_session()
+    print(json.dumps({'notifications': sent}))
+
+def seed_store(path, args):
+    """Заполнить базу подписками; возвращает все пары (сервер, стример)"""
+    import bot
+    
+    rng = random.Random(args.seed)
+    store = bot.BotStore(path)
+    pairs = set()
+    
+    async def fill():
+        await store.load()
+        for guild_id in range(1, args.guilds + 1):
+            for index in rng.sample(range(args.streamers), args.per_guild):
+                store.save_subscription(bot.Subscription(guild_id, guild_id, None, bot.StreamState(f'streamer{index}')))
+                pairs.add((guild_id, f'streamer{index}'))
+        await store.close()
+    
+    asyncio.run(fill())
+    return pairs
+
+def start_emulator(args):
+    """Эмулятор API в отдельном потоке - его делят все запуски"""
+    emulator = UpstreamEmulator(latency_ms=args.latency_ms, live_ratio=args.live_ratio, seed=args.seed)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(emulator.start())
+        ready.set()
+        loop.run_forever()
+    
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    return emulator
+
+def run_bot(emulator, env):
+    """Запустить бота в отдельном процессе; уведомления и обращения к API за запуск"""
+    emulator.reset_calls()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker'], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    notifications = [tuple(item) for item in json.loads(output[output.index('{"notifications"'):])['notifications']]
+    return notifications, emulator.snapshot_calls()
+
+def run_scenario(args, emulator, pairs, data_dir, snapshot):
+    """Запуск и перезапуск бота; между ними часть стримов перезапускается"""
+    env = dict(os.environ, BOT_SNAPSHOT_FILE=os.path.join(data_dir, f'snapshot-{"on" if snapshot else "off"}.json.gz'))
+    first, first_calls = run_bot(emulator, env)
+    if not snapshot:
+        os.remove(env['BOT_SNAPSHOT_FILE'])
+    
+    live = sorted({login for _, login in pairs if emulator.is_live(login)})
+    restarted = set(random.Random(args.seed).sample(live, min(args.restarted, len(live))))
+    for login in restarted:
+        emulator.restart_stream(login)
+    
+    second, second_calls = run_bot(emulator, env)
+    expected = {pair for pair in pairs if pair[1] in restarted}
+    return {
+        'first_run': {'notifications': len(first), 'upstream_calls': first_calls},
+        'restart': {
+            'notifications': len(second),
+            'repeated': len(set(second) - expected),     # Уже объявленные стримы, объявленные снова
+            'restarted_expected': len(expected),
+            'restarted_missing': len(expected - set(second)),
+            'upstream_calls': second_calls,
+            'total_calls': sum(second_calls.values()),
+        },
+    }
+
+def main(args):
+    data_dir = tempfile.mkdtemp()
+    emulator = start_emulator(args)
+    
+    os.environ.update(emulator.urls())
+    os.environ.update({
+        'BOT_DATA_DIR': data_dir,
+        'BOT_DB_FILE': os.path.join(data_dir, 'bot.db'),
+        'TWITCH_CLIENT_ID': 'bench',
+        'TWITCH_CLIENT_SECRET': 'bench',
+        'METRICS_PORT': '0',
+    })
+    pairs = seed_store(os.environ['BOT_DB_FILE'], args)
+    
+    report = {'config': vars(args), 'subscriptions': len(pairs)}
+    report['cold'] = run_scenario(args, emulator, pairs, data_dir, snapshot=False)
+    for login in list(emulator.stream_restarts):
+        emulator.stream_restarts[login] = 0
+    report['snapshot'] = run_scenario(args, emulator, pairs, data_dir, snapshot=True)
+    report['snapshot_bytes'] = os.path.getsize(os.path.join(data_dir, 'snapshot-on.json.gz'))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Перезапуск бота со снимком состояния и без него')
+    parser.add_argument('--guilds', type=int, default=500)
+    parser.add_argument('--streamers', type=int, default=300)
+    parser.add_argument('--per-guild', type=int, default=3, help='подписок на сервер')
+    parser.add_argument('--live-ratio', type=float, default=0.2)
+    parser.add_argument('--restarted', type=int, default=5, help='сколько стримов перезапустится между запусками')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--worker']:
+        asyncio.run(run_worker())
+    else:
+        main(parse_args())
@@ -2,18 +2,2216 @@ import discord
 from discord.ext import commands, tasks
 import os
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import asyncio
+import bisect
 import aiohttp
+from aiohttp import web
 import json
+import time
+import sqlite3
+import functools
+import gzip
+import contextlib
+import contextvars
+import difflib
+import heapq
+import itertools
+import random
+import signal
+import subprocess
+import sys
+import urllib.parse
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Загружаем переменные окружения
 load_dotenv()
 
+# Адреса внешних API (можно переопределить через .env, например для локальных эмуляторов)
+OPENWEATHER_API_URL = os.getenv('OPENWEATHER_API_URL', 'http://api.openweathermap.org/data/2.5')
+OPENWEATHER_GEO_URL = os.getenv('OPENWEATHER_GEO_URL', 'http://api.openweathermap.org/geo/1.0')
+COINGECKO_API_URL = os.getenv('COINGECKO_API_URL', 'https://api.coingecko.com/api/v3')
+YAHOO_FINANCE_URL = os.getenv('YAHOO_FINANCE_URL', 'https://query1.finance.yahoo.com')
+TWITCH_API_URL = os.getenv('TWITCH_API_URL', 'https://api.twitch.tv/helix')
+TWITCH_OAUTH_URL = os.getenv('TWITCH_OAUTH_URL', 'https://id.twitch.tv/oauth2')
+
+# Таймауты для каждого внешнего API (connect - установка соединения, sock_read - чтение ответа)
+HTTP_TIMEOUTS = {
+    'openweather': aiohttp.ClientTimeout(total=15, connect=5, sock_read=10),
+    'coingecko': aiohttp.ClientTimeout(total=15, connect=5, sock_read=10),
+    'yahoo': aiohttp.ClientTimeout(total=10, connect=5, sock_read=8),
+    'twitch': aiohttp.ClientTimeout(total=10, connect=5, sock_read=8),
+}
+
+# Настройки пула соединений
+HTTP_POOL_LIMIT = 100           # Всего одновременных соединений
+HTTP_POOL_LIMIT_PER_HOST = 20   # Соединений на один хост
+HTTP_KEEPALIVE_TIMEOUT = 30     # Сколько секунд держать простаивающее соединение
+HTTP_DNS_CACHE_TTL = 300        # Сколько секунд кешировать DNS
+
+# Общая HTTP сессия бота (создается при запуске, закрывается при остановке)
+HTTP_SESSION = None
+
+def get_http_session():
+    """Получить общую HTTP сессию с пулом соединений"""
+    global HTTP_SESSION
+    
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector)
+    return HTTP_SESSION
+
+async def close_http_session():
+    """Закрыть общую HTTP сессию"""
+    global HTTP_SESSION
+    
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+# Приоритеты запросов к внешним API: команды пользователей обслуживаются раньше фоновых задач
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+REQUEST_PRIORITY = contextvars.ContextVar('request_priority', default=PRIORITY_INTERACTIVE)
+
+# Команда, не допущенная из-за перегрузки, отвечает только из кешей: здесь счетчик ее промахов
+CACHE_ONLY = contextvars.ContextVar('cache_only', default=None)
+
+class LoadShedError(Exception):
+    """Запрос к внешнему API не выполняется: команда работает только с кешами"""
+
+def check_cache_only(upstream):
+    """Отказать в новом запросе к API, если команда отвечает только из кешей"""
+    shed = CACHE_ONLY.get()
+    if shed is not None:
+        shed['misses'] += 1
+        raise LoadShedError(f'нет данных в кеше, запрос к {upstream} пропущен из-за нагрузки')
+
+def header_number(headers, *names):
+    """Прочитать числовой заголовок (первый найденный из names)"""
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+class RateLimiter:
+    """Token bucket для одного внешнего API.
+    
+    Лимит уточняется по заголовкам ответов (Ratelimit-* / X-RateLimit-* / Retry-After),
+    запросы сверх лимита ждут в очереди по приоритету, на 429 включается пауза с jitter.
+    """
+    
+    def __init__(self, name, rate, capacity, window=60, max_retries=3, base_backoff=1.0, max_backoff=60.0):
+        self.name = name
+        self.rate = rate                  # Токенов в секунду
+        self.capacity = capacity          # Размер ведра
+        self.window = window              # Окно, к которому относится заголовок Limit, секунды
+        self.max_retries = max_retries    # Сколько раз повторять запрос после 429
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0            # До этого момента запросы не отправляются (после 429)
+        self.failures = 0                 # 429 подряд
+        self.waiters = []                 # Куча (priority, seq, future)
+        self.sequence = itertools.count()
+        self.wakeup = None
+        self.stats = {'requests': 0, 'queued': 0, 'throttled': 0, 'wait_time': 0.0}
+    
+    def refill(self):
+        """Пополнить ведро по прошедшему времени"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return now
+    
+    def reserve(self, priority):
+        """Сколько токенов фоновые запросы оставляют командам пользователей"""
+        if priority == PRIORITY_INTERACTIVE:
+            return 0
+        return max(0, min(self.capacity * 0.2, self.capacity - 1))
+    
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """Дождаться разрешения на запрос"""
+        self.stats['requests'] += 1
+        now = self.refill()
+        
+        if not self.waiters and now >= self.blocked_until and self.tokens - 1 >= self.reserve(priority):
+            self.tokens -= 1
+            return
+        
+        # Ждем своей очереди
+        self.stats['queued'] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.schedule(0)
+        
+        started = time.monotonic()
+        try:
+            await future
+        finally:
+            self.stats['wait_time'] += time.monotonic() - started
+    
+    def schedule(self, delay):
+        """Запланировать раздачу токенов ожидающим"""
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+        self.wakeup = asyncio.get_running_loop().call_later(max(delay, 0), self.release_waiters)
+    
+    def release_waiters(self):
+        """Раздать доступные токены ожидающим в порядке приоритета"""
+        self.wakeup = None
+        
+        while self.waiters:
+            priority, _, future = self.waiters[0]
+            if future.done():  # Ожидающий отменен
+                heapq.heappop(self.waiters)
+                continue
+            
+            now = self.refill()
+            if now < self.blocked_until:
+                self.schedule(self.blocked_until - now)
+                return
+            
+            needed = 1 + self.reserve(priority) - self.tokens
+            if needed > 0:
+                self.schedule(needed / self.rate)
+                return
+            
+            heapq.heappop(self.waiters)
+            self.tokens -= 1
+            future.set_result(None)
+    
+    def block_for(self, delay):
+        """Не отправлять запросы delay секунд"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.tokens = 0
+    
+    def update_from_headers(self, headers):
+        """Уточнить лимит по заголовкам ответа"""
+        limit = header_number(headers, 'Ratelimit-Limit', 'X-RateLimit-Limit')
+        remaining = header_number(headers, 'Ratelimit-Remaining', 'X-RateLimit-Remaining')
+        reset = header_number(headers, 'Ratelimit-Reset', 'X-RateLimit-Reset')
+        
+        if limit:
+            self.capacity = limit
+            self.rate = limit / self.window
+        if remaining is not None:
+            self.refill()
+            self.tokens = min(self.tokens, remaining)
+            if remaining < 1 and reset:
+                # Reset бывает временем (unix time) или количеством секунд
+                delay = reset - time.time() if reset > 1e9 else reset
+                self.block_for(min(max(delay, 0), self.max_backoff))
+    
+    def throttled(self, headers):
+        """Ответ 429: пауза по Retry-After или экспоненциальная с jitter"""
+        self.stats['throttled'] += 1
+        self.failures += 1
+        
+        retry_after = header_number(headers, 'Retry-After')
+        if retry_after is not None:
+            delay = min(retry_after, self.max_backoff) + random.uniform(0, 1)
+        else:
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        self.block_for(delay)
+    
+    def succeeded(self):
+        """Успешный ответ сбрасывает счетчик 429"""
+        self.failures = 0
+    
+    def get_stats(self):
+        """Статистика лимитера"""
+        return dict(self.stats, tokens=round(self.tokens, 2), rate=round(self.rate, 3), waiting=len(self.waiters))
+
+# Лимиты внешних API по умолчанию (уточняются по заголовкам ответов)
+RATE_LIMITERS = {
+    'openweather': RateLimiter('openweather', rate=1.0, capacity=10),        # Бесплатный тариф: 60 запросов в минуту
+    'coingecko': RateLimiter('coingecko', rate=0.5, capacity=5),             # Публичный API: около 30 запросов в минуту
+    'yahoo': RateLimiter('yahoo', rate=2.0, capacity=5),
+    'twitch': RateLimiter('twitch', rate=800 / 60, capacity=800),            # Helix: 800 очков в минуту
+}
+
+@contextlib.asynccontextmanager
+async def upstream_request(upstream, method, url, **kwargs):
+    """Запрос к внешнему API с учетом его лимитов: ждет своей очереди и повторяет после 429"""
+    check_cache_only(upstream)
+    limiter = RATE_LIMITERS[upstream]
+    priority = REQUEST_PRIORITY.get()
+    session = get_http_session()
+    
+    for attempt in range(limiter.max_retries + 1):
+        await limiter.acquire(priority)
+        started = time.perf_counter()
+        try:
+            response = await session.request(method, url, timeout=HTTP_TIMEOUTS[upstream], **kwargs)
+        except Exception as e:
+            METRICS.inc('upstream_errors_total', upstream=upstream, error=type(e).__name__)
+            raise
+        finally:
+            METRICS.observe('upstream_request_seconds', time.perf_counter() - started, upstream=upstream)
+        
+        METRICS.inc('upstream_requests_total', upstream=upstream, status=response.status)
+        limiter.update_from_headers(response.headers)
+        
+        if response.status == 429:
+            limiter.throttled(response.headers)
+            if attempt < limiter.max_retries:
+                response.release()
+                continue
+        else:
+            limiter.succeeded()
+        
+        try:
+            yield response
+        finally:
+            response.release()
+        return
+
+class TTLCache:
+    """Кеш с временем жизни записей, вытеснением по LRU и отдачей устаревших данных"""
+    
+    def __init__(self, maxsize, ttl, stale_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl                # Сколько секунд запись считается свежей
+        self.stale_ttl = stale_ttl    # Сколько еще секунд можно отдавать устаревшую запись, обновляя ее в фоне
+        self.entries = OrderedDict()  # key -> (value, stored_at)
+        self.refreshing = {}          # key -> фоновая задача обновления
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'evictions': 0, 'refreshes': 0}
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def set(self, key, value):
+        """Сохранить значение в кеш"""
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+        
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+    
+    def clear(self):
+        """Очистить кеш"""
+        self.entries.clear()
+    
+    def get(self, key):
+        """Получить значение без запроса (None, если записи нет или она слишком старая)"""
+        entry = self.entries.get(key)
+        
+        if entry is not None and time.monotonic() - entry[1] < self.ttl + self.stale_ttl:
+            self.stats['hits'] += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+        
+        self.stats['misses'] += 1
+        return None
+    
+    async def get_or_fetch(self, key, fetch):
+        """Получить значение из кеша или через fetch() (None не кешируется)"""
+        entry = self.entries.get(key)
+        
+        if entry is not None:
+            value, stored_at = entry
+            age = time.monotonic() - stored_at
+            
+            if age < self.ttl:
+                self.stats['hits'] += 1
+                self.entries.move_to_end(key)
+                return value
+            
+            if CACHE_ONLY.get() is not None:
+                # Перегрузка: любые данные лучше, чем никаких, и без фонового обновления
+                self.stats['stale_hits'] += 1
+                return value
+            
+            if age < self.ttl + self.stale_ttl:
+                # Отдаем устаревшее значение сразу, а свежее получаем в фоне
+                self.stats['stale_hits'] += 1
+                self.entries.move_to_end(key)
+                self.refresh(key, fetch)
+                return value
+            
+            del self.entries[key]
+        
+        self.stats['misses'] += 1
+        value = await fetch()
+        if value is not None:
+            self.set(key, value)
+        return value
+    
+    def refresh(self, key, fetch):
+        """Запустить фоновое обновление записи (не более одного на ключ)"""
+        if key in self.refreshing:
+            return
+        
+        async def run():
+            REQUEST_PRIORITY.set(PRIORITY_BACKGROUND)
+            CACHE_ONLY.set(None)
+            try:
+                value = await fetch()
+                if value is not None:
+                    self.set(key, value)
+            except Exception as e:
+                print(f"Ошибка при фоновом обновлении кеша {key}: {e}")
+            finally:
+                self.refreshing.pop(key, None)
+        
+        self.stats['refreshes'] += 1
+        self.refreshing[key] = asyncio.create_task(run())
+    
+    def get_stats(self):
+        """Счетчики попаданий и промахов для настройки кеша"""
+        requests = self.stats['hits'] + self.stats['stale_hits'] + self.stats['misses']
+        hit_ratio = (self.stats['hits'] + self.stats['stale_hits']) / requests if requests else 0
+        return dict(self.stats, size=len(self.entries), hit_ratio=round(hit_ratio, 3))
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов: все вызовы ждут один результат"""
+    
+    def __init__(self):
+        self.inflight = {}  # key -> future выполняющегося запроса
+        self.stats = {}     # upstream -> {'calls': n, 'coalesced': n}
+    
+    async def run(self, key, fetch):
+        """Выполнить fetch() или присоединиться к уже идущему запросу с тем же ключом"""
+        stats = self.stats.setdefault(key[0], {'calls': 0, 'coalesced': 0})
+        stats['calls'] += 1
+        
+        future = self.inflight.get(key)
+        if future is not None:
+            stats['coalesced'] += 1
+        else:
+            future = asyncio.ensure_future(fetch())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(future)
+    
+    def get_stats(self):
+        """Сколько вызовов было и сколько из них не дошло до API"""
+        return {upstream: dict(stats) for upstream, stats in self.stats.items()}
+
+def coalesced(upstream, make_key=None):
+    """Декоратор: одинаковые одновременные вызовы функции выполняют один запрос к API"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args):
+            key = (upstream, func.__name__) + (make_key(*args) if make_key else args)
+            if key not in UPSTREAM_FLIGHTS.inflight:
+                check_cache_only(upstream)  # К уже идущему запросу можно присоединиться и при перегрузке
+            return await UPSTREAM_FLIGHTS.run(key, lambda: func(*args))
+        return wrapper
+    return decorator
+
+class MemoryCacheBackend:
+    """Бэкенд общего кеша в памяти процесса: LRU со временем жизни записей"""
+    
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (value, expires_at)
+    
+    async def get_many(self, keys):
+        """Значения живых записей по ключам"""
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            if entry[1] <= now:
+                del self.entries[key]
+                continue
+            self.entries.move_to_end(key)
+            found[key] = entry[0]
+        return found
+    
+    async def set_many(self, items, ttl):
+        """Сохранить значения на ttl секунд"""
+        expires_at = time.monotonic() + ttl
+        for key, value in items.items():
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+    
+    async def delete(self, key):
+        self.entries.pop(key, None)
+    
+    async def close(self):
+        self.entries.clear()
+
+class SQLiteCacheBackend:
+    """Бэкенд общего кеша в файле SQLite: его делят процессы на одной машине и он переживает перезапуск"""
+    
+    PRUNE_EVERY = 500  # Через сколько записей удалять истекшие
+    
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.writes = 0
+        # Один поток: все операции с соединением выполняются последовательно
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-cache')
+    
+    def connect(self):
+        """Открыть базу и создать таблицу (выполняется в потоке кеша)"""
+        if self.connection is not None:
+            return
+        
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self.connection = sqlite3.connect(self.path, timeout=1)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')  # Потеря кеша при сбое не страшна
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID"""
+            )
+    
+    def read(self, keys):
+        self.connect()
+        placeholders = ','.join('?' * len(keys))
+        rows = self.connection.execute(
+            f'SELECT key, value FROM cache WHERE key IN ({placeholders}) AND expires_at > ?', (*keys, time.time())
+        )
+        return dict(rows)
+    
+    def write(self, items, ttl):
+        self.connect()
+        expires_at = time.time() + ttl
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                [(key, value, expires_at) for key, value in items.items()]
+            )
+            self.writes += len(items)
+            if self.writes >= self.PRUNE_EVERY:
+                self.writes = 0
+                self.connection.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+    
+    def remove(self, key):
+        self.connect()
+        with self.connection:
+            self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+    
+    async def get_many(self, keys):
+        if not keys:
+            return {}
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.read, list(keys))
+    
+    async def set_many(self, items, ttl):
+        if items:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.write, items, ttl)
+    
+    async def delete(self, key):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.remove, key)
+    
+    async def close(self):
+        def close_connection():
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        
+        await asyncio.get_running_loop().run_in_executor(self.executor, close_connection)
+
+class RedisError(Exception):
+    """Ответ-ошибка сервера Redis"""
+
+class RedisCacheBackend:
+    """Бэкенд общего кеша в Redis (или совместимом сервере) по протоколу RESP.
+    
+    Нужны только GET/SET/DEL, поэтому клиент свой: одно соединение, команды пачки
+    отправляются конвейером, при сетевой ошибке соединение открывается заново.
+    """
+    
+    def __init__(self, url, timeout=1.0):
+        parsed = urllib.parse.urlsplit(url or 'redis://127.0.0.1:6379/0')
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.strip('/') or 0)
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+    
+    @staticmethod
+    def encode(*args):
+        """Команда в формате RESP"""
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+    
+    async def read_reply(self):
+        """Прочитать один ответ; ошибка сервера возвращается как RedisError, чтобы не сбить конвейер"""
+        line = await self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Соединение с Redis закрыто')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            return RedisError(rest.decode(errors='replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            return None if size < 0 else (await self.reader.readexactly(size + 2))[:-2]
+        if kind == b'*':
+            size = int(rest)
+            return None if size < 0 else [await self.read_reply() for _ in range(size)]
+        raise ConnectionError(f'Непонятный ответ Redis: {line[:20]!r}')
+    
+    async def send(self, commands):
+        """Отправить команды одним пакетом и прочитать ответы"""
+        self.writer.write(b''.join(self.encode(*command) for command in commands))
+        await self.writer.drain()
+        return [await self.read_reply() for _ in commands]
+    
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        for reply in await self.send(setup) if setup else []:
+            if isinstance(reply, RedisError):
+                raise reply
+    
+    async def execute(self, *commands):
+        """Выполнить команды конвейером; при ошибке соединения оно закрывается и откроется при следующем вызове"""
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    await asyncio.wait_for(self.connect(), self.timeout)
+                replies = await asyncio.wait_for(self.send(commands), self.timeout)
+            except BaseException:
+                # Ответы могли остаться непрочитанными - соединение больше не годится
+                self.disconnect()
+                raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+    
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+    
+    async def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = (await self.execute(('MGET', *keys)))[0]
+        return {key: value for key, value in zip(keys, values) if value is not None}
+    
+    async def set_many(self, items, ttl):
+        if items:
+            milliseconds = max(1, int(ttl * 1000))
+            await self.execute(*(('SET', key, value, 'PX', milliseconds) for key, value in items.items()))
+    
+    async def delete(self, key):
+        await self.execute(('DEL', key))
+    
+    async def close(self):
+        async with self.lock:
+            self.disconnect()
+
+class SharedCache:
+    """Общий кеш результатов внешних API для нескольких экземпляров бота.
+    
+    Ключи разделены по пространствам имен (обычно по API): префикс:пространство:ключ.
+    Значения хранятся компактным JSON, большие сжимаются zlib. Ошибки бэкенда считаются
+    промахом: без общего кеша бот просто идет в API.
+    """
+    
+    COMPRESS_MIN_SIZE = 1024  # С какого размера JSON сжимать, байты
+    
+    def __init__(self, backend=None, prefix='ebilbot'):
+        self.backend = backend  # None - общий кеш выключен
+        self.prefix = prefix
+        self.stats = {}         # namespace -> {'hits', 'misses', 'writes', 'errors'}
+    
+    @classmethod
+    def dumps(cls, value):
+        """Значение -> байты: 'j' + JSON или 'z' + сжатый JSON"""
+        data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+        if len(data) >= cls.COMPRESS_MIN_SIZE:
+            return b'z' + zlib.compress(data)
+        return b'j' + data
+    
+    @staticmethod
+    def loads(data):
+        if data[:1] == b'z':
+            return json.loads(zlib.decompress(data[1:]))
+        return json.loads(data[1:])
+    
+    def count(self, namespace, stat, value=1):
+        stats = self.stats.setdefault(namespace, {'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0})
+        stats[stat] += value
+    
+    async def get_many(self, namespace, keys):
+        """Найденные значения по ключам пространства имен"""
+        keys = list(keys)
+        if self.backend is None or not keys:
+            return {}
+        
+        full_keys = {f'{self.prefix}:{namespace}:{key}': key for key in keys}
+        try:
+            stored = await self.backend.get_many(list(full_keys))
+            found = {full_keys[full_key]: self.loads(data) for full_key, data in stored.items()}
+        except Exception as e:
+            self.count(namespace, 'errors')
+            print(f"Ошибка при чтении общего кеша {namespace}: {e}")
+            found = {}
+        
+        self.count(namespace, 'hits', len(found))
+        self.count(namespace, 'misses', len(keys) - len(found))
+        return found
+    
+    async def set_many(self, namespace, items, ttl):
+        """Сохранить значения на ttl секунд"""
+        if self.backend is None or not items:
+            return
+        
+        try:
+            await self.backend.set_many({f'{self.prefix}:{namespace}:{key}': self.dumps(value)
+                                         for key, value in items.items()}, ttl)
+            self.count(namespace, 'writes', len(items))
+        except Exception as e:
+            self.count(namespace, 'errors')
+            print(f"Ошибка при записи в общий кеш {namespace}: {e}")
+    
+    async def get(self, namespace, key):
+        return (await self.get_many(namespace, [key])).get(key)
+    
+    async def set(self, namespace, key, value, ttl):
+        await self.set_many(namespace, {key: value}, ttl)
+    
+    async def get_or_fetch(self, namespace, key, ttl, fetch):
+        """Значение из общего кеша или через fetch() с сохранением для остальных экземпляров (None не кешируется)"""
+        value = await self.get(namespace, key)
+        if value is not None:
+            return value
+        
+        value = await fetch()
+        if value is not None:
+            await self.set(namespace, key, value, ttl)
+        return value
+    
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
+    
+    def get_stats(self):
+        return {namespace: dict(stats) for namespace, stats in self.stats.items()}
+
+def create_cache_backend(kind, url):
+    """Бэкенд общего кеша по настройке CACHE_BACKEND: memory, sqlite, redis или пусто (выключен)"""
+    if kind in ('', 'none', 'off'):
+        return None
+    if kind == 'memory':
+        return MemoryCacheBackend()
+    if kind == 'sqlite':
+        return SQLiteCacheBackend(url or os.path.join(os.getenv('BOT_DATA_DIR', 'data'), 'cache.db'))
+    if kind == 'redis':
+        return RedisCacheBackend(url)
+    raise ValueError(f'Неизвестный CACHE_BACKEND: {kind}')
+
+class WeatherUnavailableError(Exception):
+    """API погоды ответило ошибкой - в отличие от «город не найден», стоит повторить позже"""
+
+class GeocodingIndex:
+    """Названия городов -> координаты.
+    
+    Город ищется через API геокодинга один раз, результат (в том числе «не найден»)
+    сохраняется в базе. Регистр, ё/е и дефисы не важны, а русское и основное название
+    из ответа становятся синонимами той же записи. Для промахов подбираются похожие названия.
+    """
+    
+    def __init__(self, negative_ttl=86400, negative_size=10000, suggestions=3, cutoff=0.75):
+        self.places = {}                # ключ названия -> {'name', 'lat', 'lon', 'country'}
+        self.missing = OrderedDict()    # ключ названия -> когда город не нашелся (unix time)
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self.suggestions = suggestions
+        self.cutoff = cutoff
+        self.stats = {'hits': 0, 'negative_hits': 0, 'lookups': 0, 'not_found': 0, 'errors': 0}
+    
+    def __len__(self):
+        return len(self.places)
+    
+    @staticmethod
+    def normalize(name):
+        """Ключ поиска: без регистра, ё -> е, дефисы и лишние пробелы не важны"""
+        name = name.casefold().replace('ё', 'е').replace('-', ' ')
+        return ' '.join(name.split())
+    
+    def add_known(self, cities):
+        """Города с известными координатами (CITIES) - без обращений к API и без записи в базу"""
+        for name, city in cities.items():
+            self.places[self.normalize(name)] = {'name': name, 'lat': city['lat'], 'lon': city['lon'], 'country': None}
+    
+    def load(self, rows):
+        """Восстановить индекс из строк базы (query, name, lat, lon, country, updated_at)"""
+        expired = time.time() - self.negative_ttl
+        for key, name, lat, lon, country, updated_at in rows:
+            if name is not None:
+                self.places.setdefault(key, {'name': name, 'lat': lat, 'lon': lon, 'country': country})
+            elif updated_at > expired:
+                self.missing[key] = updated_at
+    
+    def remember(self, key, place):
+        self.places[key] = place
+        self.missing.pop(key, None)
+        STORE.save_geocode(key, place)
+    
+    def remember_missing(self, key):
+        self.missing[key] = time.time()
+        self.missing.move_to_end(key)
+        while len(self.missing) > self.negative_size:
+            self.missing.popitem(last=False)
+        STORE.save_geocode(key, None)
+    
+    async def resolve(self, api_key, query):
+        """Координаты города или None, если город не найден (WeatherUnavailableError - API недоступен)"""
+        key = self.normalize(query)
+        place = self.places.get(key)
+        if place is not None:
+            self.stats['hits'] += 1
+            return place
+        
+        missed_at = self.missing.get(key)
+        if missed_at is not None and time.time() - missed_at < self.negative_ttl:
+            self.stats['negative_hits'] += 1
+            return None
+        
+        self.stats['lookups'] += 1
+        results = await fetch_geocode(api_key, query)
+        if results is None:
+            # Ошибка API - не запоминаем, следующий запрос попробует снова
+            self.stats['errors'] += 1
+            raise WeatherUnavailableError(f"ошибка геокодинга для {query}")
+        if not results:
+            self.stats['not_found'] += 1
+            self.remember_missing(key)
+            return None
+        
+        found = results[0]
+        local_name = (found.get('local_names') or {}).get('ru')
+        place = {'name': local_name or found['name'], 'lat': found['lat'], 'lon': found['lon'], 'country': found.get('country')}
+        self.remember(key, place)
+        
+        # Другие написания того же города больше не потребуют запроса
+        for name in (found.get('name'), local_name):
+            alias = self.normalize(name) if name else None
+            if alias and alias not in self.places:
+                self.remember(alias, place)
+        return place
+    
+    def suggest(self, query):
+        """Похожие известные названия для города, который не нашелся"""
+        candidates = {key: place['name'] for key, place in self.places.items()}
+        candidates.update((self.normalize(alias), name) for alias, name in CITY_SHORTCUTS.items())
+        matches = difflib.get_close_matches(self.normalize(query), candidates, self.suggestions * 2, self.cutoff)
+        return list(dict.fromkeys(candidates[match] for match in matches))[:self.suggestions]
+    
+    def get_stats(self):
+        return dict(self.stats, places=len(self.places), missing=len(self.missing))
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами корзин (как в Prometheus)"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        """Добавить наблюдение"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return None
+        
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):  # Выше последней границы точнее не оценить
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и показатели бота с выгрузкой в формате Prometheus"""
+    
+    def __init__(self, prefix='ebilbot'):
+        self.prefix = prefix
+        self.counters = {}    # (name, labels) -> значение
+        self.gauges = {}      # (name, labels) -> значение
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.help = {}        # name -> описание
+        self.collectors = []  # Функции, возвращающие [(name, labels, value)] на момент чтения
+    
+    @staticmethod
+    def labels_key(labels):
+        return tuple(sorted(labels.items()))
+    
+    def describe(self, name, text):
+        """Описание метрики для # HELP"""
+        self.help[name] = text
+    
+    def inc(self, name, value=1, **labels):
+        """Увеличить счетчик"""
+        key = (name, self.labels_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        """Установить показатель"""
+        self.gauges[(name, self.labels_key(labels))] = value
+    
+    def observe(self, name, value, **labels):
+        """Добавить наблюдение в гистограмму"""
+        key = (name, self.labels_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+    
+    def add_collector(self, collect):
+        """Зарегистрировать источник показателей, которые считаются при чтении"""
+        self.collectors.append(collect)
+    
+    def counter(self, name, **labels):
+        return self.counters.get((name, self.labels_key(labels)), 0)
+    
+    def gauge(self, name, **labels):
+        return self.gauges.get((name, self.labels_key(labels)))
+    
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, self.labels_key(labels)))
+    
+    def series(self, name):
+        """Все ряды счетчика: [(labels, значение)]"""
+        return [(dict(labels), value) for (metric, labels), value in self.counters.items() if metric == name]
+    
+    def collect(self):
+        """Показатели от зарегистрированных источников"""
+        gauges = dict(self.gauges)
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    gauges[(name, self.labels_key(labels))] = value
+            except Exception as e:
+                print(f"Ошибка при сборе метрик: {e}")
+        return gauges
+    
+    def format_labels(self, labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+    
+    def render_prometheus(self):
+        """Текстовый формат Prometheus 0.0.4"""
+        lines = []
+        
+        def header(name, kind):
+            full_name = f'{self.prefix}_{name}'
+            if name in self.help:
+                lines.append(f'# HELP {full_name} {self.help[name]}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            return full_name
+        
+        for kind, metrics in (('counter', self.counters), ('gauge', self.collect())):
+            for name in sorted({name for name, _ in metrics}):
+                full_name = header(name, kind)
+                for (metric, labels), value in sorted(metrics.items(), key=lambda item: str(item[0])):
+                    if metric == name:
+                        lines.append(f'{full_name}{self.format_labels(labels)} {value}')
+        
+        for name in sorted({name for name, _ in self.histograms}):
+            full_name = header(name, 'histogram')
+            for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{full_name}_bucket{self.format_labels(labels, le=le)} {cumulative}')
+                lines.append(f'{full_name}_sum{self.format_labels(labels)} {histogram.sum}')
+                lines.append(f'{full_name}_count{self.format_labels(labels)} {histogram.count}')
+        
+        return '\n'.join(lines) + '\n'
+
+class BotStore:
+    """Хранилище подписок Twitch, разрешенных каналов и индекса геокодинга в SQLite.
+    
+    Данные читаются один раз при запуске, дальше бот работает со словарями в памяти,
+    а изменения накапливаются и записываются пачками в отдельном потоке.
+    """
+    
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS twitch_subscriptions (
+            guild_id INTEGER NOT NULL,
+            channel_name TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message TEXT,
+            PRIMARY KEY (guild_id, channel_name)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS allowed_channels (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, channel_id)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS geocodes (
+            query TEXT PRIMARY KEY,
+            name TEXT,
+            lat REAL,
+            lon REAL,
+            country TEXT,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID""",
+    )
+    
+    def __init__(self, path, flush_delay=1.0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.connection = None
+        self.pending = []        # Очередь изменений: (sql, params)
+        self.flush_task = None
+        # Один поток: все операции с соединением выполняются последовательно
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bot-store')
+    
+    def connect(self):
+        """Открыть базу и создать таблицы (выполняется в потоке хранилища)"""
+        if self.connection is not None:
+            return
+        
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+    
+    def read_all(self):
+        """Прочитать все подписки и разрешенные каналы (выполняется в потоке хранилища)"""
+        self.connect()
+        
+        # Строки (guild_id, channel_name, channel_id, message); message None - стандартное сообщение
+        subscriptions = self.connection.execute(
+            'SELECT guild_id, channel_name, channel_id, message FROM twitch_subscriptions'
+        ).fetchall()
+        
+        allowed_channels = {}
+        for guild_id, channel_id in self.connection.execute('SELECT guild_id, channel_id FROM allowed_channels'):
+            allowed_channels.setdefault(guild_id, set()).add(channel_id)
+        
+        return subscriptions, allowed_channels
+    
+    def write_batch(self, operations):
+        """Записать пачку изменений одной транзакцией (выполняется в потоке хранилища)"""
+        self.connect()
+        with self.connection:
+            for sql, params in operations:
+                self.connection.execute(sql, params)
+    
+    def read_geocodes(self):
+        """Прочитать индекс геокодинга (выполняется в потоке хранилища); name NULL - город не найден"""
+        self.connect()
+        return self.connection.execute('SELECT query, name, lat, lon, country, updated_at FROM geocodes').fetchall()
+    
+    async def load(self):
+        """Загрузить данные из базы, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.read_all)
+    
+    async def load_geocodes(self):
+        """Загрузить индекс геокодинга, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.read_geocodes)
+    
+    def queue(self, sql, params=()):
+        """Поставить изменение в очередь на запись"""
+        self.pending.append((sql, params))
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+    
+    async def flush_later(self):
+        """Подождать, пока накопятся изменения, и записать их"""
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+    
+    async def flush(self):
+        """Записать все накопленные изменения"""
+        if not self.pending:
+            return
+        
+        operations, self.pending = self.pending, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.write_batch, operations)
+        except Exception as e:
+            print(f"Ошибка при записи в хранилище ({len(operations)} изменений): {e}")
+    
+    async def close(self):
+        """Записать остаток изменений и закрыть базу"""
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self.flush()
+        
+        def close_connection():
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        
+        await asyncio.get_running_loop().run_in_executor(self.executor, close_connection)
+    
+    def save_subscription(self, subscription):
+        """Сохранить подписку на Twitch канал (стандартное сообщение хранится как NULL)"""
+        self.queue(
+            'INSERT OR REPLACE INTO twitch_subscriptions (guild_id, channel_name, channel_id, message) VALUES (?, ?, ?, ?)',
+            (subscription.guild_id, subscription.login, subscription.channel_id, subscription.message)
+        )
+    
+    def delete_subscription(self, guild_id, channel_name):
+        """Удалить подписку на Twitch канал"""
+        self.queue('DELETE FROM twitch_subscriptions WHERE guild_id = ? AND channel_name = ?', (guild_id, channel_name))
+    
+    def save_geocode(self, query, place):
+        """Сохранить результат геокодинга (None - город не найден)"""
+        if place is None:
+            params = (query, None, None, None, None, time.time())
+        else:
+            params = (query, place['name'], place['lat'], place['lon'], place['country'], time.time())
+        self.queue('INSERT OR REPLACE INTO geocodes (query, name, lat, lon, country, updated_at) VALUES (?, ?, ?, ?, ?, ?)', params)
+    
+    def prune_geocodes(self, before):
+        """Удалить устаревшие записи «город не найден»"""
+        self.queue('DELETE FROM geocodes WHERE name IS NULL AND updated_at < ?', (before,))
+    
+    def add_allowed_channel(self, guild_id, channel_id):
+        """Сохранить разрешенный канал"""
+        self.queue('INSERT OR IGNORE INTO allowed_channels (guild_id, channel_id) VALUES (?, ?)', (guild_id, channel_id))
+    
+    def remove_allowed_channel(self, guild_id, channel_id):
+        """Удалить разрешенный канал"""
+        self.queue('DELETE FROM allowed_channels WHERE guild_id = ? AND channel_id = ?', (guild_id, channel_id))
+    
+    def reset_allowed_channels(self, guild_id):
+        """Удалить все разрешенные каналы сервера"""
+        self.queue('DELETE FROM allowed_channels WHERE guild_id = ?', (guild_id,))
+
+class StreamState:
+    """Общее для всех серверов состояние стримера"""
+    __slots__ = ('login', 'is_live', 'stream_id')
+    
+    def __init__(self, login):
+        self.login = login
+        self.is_live = False
+        self.stream_id = None  # ID стрима Twitch, о котором уже разослано уведомление
+
+class Subscription:
+    """Подписка сервера на стримера"""
+    __slots__ = ('guild_id', 'channel_id', 'message', 'stream')
+    
+    def __init__(self, guild_id, channel_id, message, stream):
+        self.guild_id = guild_id
+        self.channel_id = channel_id  # Канал Discord для уведомлений
+        self.message = message        # None - стандартное сообщение, оно собирается при отправке
+        self.stream = stream
+    
+    @property
+    def login(self):
+        return self.stream.login
+    
+    @property
+    def is_live(self):
+        return self.stream.is_live
+    
+    @property
+    def text(self):
+        """Текст уведомления"""
+        return self.message if self.message is not None else default_twitch_message(self.stream.login)
+
+class SubscriptionRegistry:
+    """Подписки Twitch с индексами по серверу, стримеру и каналу Discord.
+    
+    Статус стримера хранится один раз и общий для всех его подписок, поэтому опрос
+    обновляет его за O(1), а рассылка обходит только подписчиков этого стримера.
+    """
+    
+    def __init__(self):
+        self.by_guild = {}    # guild_id -> {login: Subscription}
+        self.by_login = {}    # login -> {guild_id: Subscription}
+        self.by_channel = {}  # channel_id -> [Subscription] (в канале обычно несколько подписок - список компактнее)
+        self.streams = {}     # login -> StreamState
+        self.count = 0
+        self.version = 0      # Растет при каждом добавлении и удалении
+    
+    def __len__(self):
+        return self.count
+    
+    def get(self, guild_id, login):
+        return self.by_guild.get(guild_id, {}).get(login)
+    
+    def for_guild(self, guild_id):
+        """Подписки сервера: {login: Subscription}"""
+        return self.by_guild.get(guild_id, {})
+    
+    def followers(self, login):
+        """Подписки на стримера"""
+        return self.by_login.get(login, {}).values()
+    
+    def logins(self):
+        """Все отслеживаемые стримеры"""
+        return self.by_login.keys()
+    
+    def stream(self, login):
+        return self.streams.get(login)
+    
+    def add(self, guild_id, login, channel_id, message=None, is_live=None):
+        """Добавить или заменить подписку сервера на стримера"""
+        login = sys.intern(login)
+        stream = self.streams.get(login)
+        if stream is None:
+            stream = self.streams[login] = StreamState(login)
+            # Статус общий для всех серверов - задаем его только новому стримеру, иначе другие
+            # подписчики не получат уведомление о стриме, который еще не был объявлен
+            if is_live is not None:
+                stream.is_live = is_live
+        
+        subscription = self.get(guild_id, login)
+        if subscription is not None:
+            # Повторное добавление переносит уведомления в новый канал
+            self.unindex_channel(subscription)
+            subscription.channel_id = channel_id
+        else:
+            subscription = Subscription(guild_id, channel_id, None, stream)
+            self.by_guild.setdefault(guild_id, {})[login] = subscription
+            self.by_login.setdefault(login, {})[guild_id] = subscription
+            self.count += 1
+        self.set_message(subscription, message)
+        self.by_channel.setdefault(channel_id, []).append(subscription)
+        self.version += 1
+        return subscription
+    
+    def remove(self, guild_id, login):
+        """Удалить подписку; возвращает удаленную подписку или None"""
+        subscription = self.by_guild.get(guild_id, {}).pop(login, None)
+        if subscription is None:
+            return None
+        
+        if not self.by_guild[guild_id]:
+            del self.by_guild[guild_id]
+        followers = self.by_login[login]
+        del followers[guild_id]
+        if not followers:
+            del self.by_login[login]
+            del self.streams[login]
+        self.unindex_channel(subscription)
+        self.count -= 1
+        self.version += 1
+        return subscription
+    
+    def unindex_channel(self, subscription):
+        channel_subscriptions = self.by_channel[subscription.channel_id]
+        channel_subscriptions.remove(subscription)
+        if not channel_subscriptions:
+            del self.by_channel[subscription.channel_id]
+    
+    def remove_channel(self, channel_id):
+        """Удалить все подписки, которые шлют уведомления в канал Discord"""
+        removed = list(self.by_channel.get(channel_id, ()))
+        for subscription in removed:
+            self.remove(subscription.guild_id, subscription.login)
+        return removed
+    
+    def set_message(self, subscription, message):
+        """Задать текст уведомления; совпадающие тексты хранятся одной строкой"""
+        if message is None or message == default_twitch_message(subscription.stream.login):
+            subscription.message = None
+        else:
+            subscription.message = sys.intern(message)
+    
+    def set_live(self, login, is_live, stream_id=None):
+        """Обновить статус стримера; True, если стрим только что начался (или это уже другой стрим)"""
+        stream = self.streams.get(login)
+        if stream is None:
+            return False
+        started = is_live and (not stream.is_live or (None not in (stream_id, stream.stream_id) and stream_id != stream.stream_id))
+        stream.is_live = is_live
+        if not is_live:
+            stream.stream_id = None
+        elif stream_id is not None:
+            stream.stream_id = stream_id
+        return started
+    
+    def clear(self):
+        self.by_guild.clear()
+        self.by_login.clear()
+        self.by_channel.clear()
+        self.streams.clear()
+        self.count = 0
+        self.version += 1
+
+class TwitchTokenManager:
+    """Токен приложения Twitch: обновляется заранее, одновременные запросы ждут одно обновление"""
+    
+    def __init__(self, refresh_margin=300, retry_delay=10):
+        self.token = None
+        self.expires_at = 0               # Время истечения токена (unix time)
+        self.refresh_margin = refresh_margin  # За сколько секунд до истечения обновлять токен
+        self.retry_delay = retry_delay    # Пауза после неудачного получения токена
+        self.retry_at = 0
+        self.refresh_task = None
+    
+    async def get(self):
+        """Получить действующий токен (без обращения к сети, если он еще не истекает)"""
+        now = time.time()
+        
+        if self.token and now < self.expires_at - self.refresh_margin:
+            return self.token
+        
+        if self.token and now < self.expires_at:
+            # Токен скоро истечет - обновляем в фоне, а пока отдаем текущий
+            self.start_refresh()
+            return self.token
+        
+        if now < self.retry_at:
+            return None
+        
+        return await self.refresh()
+    
+    def start_refresh(self):
+        """Запустить обновление токена, если оно еще не идет"""
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.fetch())
+        return self.refresh_task
+    
+    async def refresh(self):
+        """Дождаться общего обновления токена"""
+        return await asyncio.shield(self.start_refresh())
+    
+    async def fetch(self):
+        """Получить новый токен у Twitch"""
+        CACHE_ONLY.set(None)  # Токен нужен всем - его получаем и при перегрузке
+        try:
+            data = await fetch_twitch_token()
+        except Exception as e:
+            print(f"Ошибка при получении токена Twitch: {e}")
+            data = None
+        
+        if not data or not data.get('access_token'):
+            self.retry_at = time.time() + self.retry_delay
+            # Старый токен еще может быть действующим
+            return self.token if time.time() < self.expires_at else None
+        
+        self.token = data['access_token']
+        self.expires_at = time.time() + data.get('expires_in', 3600)
+        return self.token
+    
+    def invalidate(self, token):
+        """Пометить токен недействительным (после ответа 401)"""
+        # Другой запрос мог уже получить новый токен - его не трогаем
+        if token == self.token:
+            self.token = None
+            self.expires_at = 0
+
+class TwitchEventSub:
+    """Клиент Twitch EventSub по WebSocket: stream.online/stream.offline приходят сразу, без опроса.
+    
+    Подписки живут в сессии соединения. Keepalive контролируется таймаутом чтения, по
+    session_reconnect сессия переносится на новый адрес вместе с подписками, а после
+    обрыва создается новая сессия и состояние сверяется одним пакетным опросом.
+    Стримеров без подписки (лимит, ошибка, нет соединения) продолжает опрашивать TWITCH_POLLER.
+    """
+    
+    EVENT_TYPES = ('stream.online', 'stream.offline')
+    
+    def __init__(self, url, token, max_subscriptions=300, keepalive_margin=5, max_backoff=60):
+        self.url = url
+        self.token = token                        # Пользовательский токен: WebSocket подписки требуют его
+        self.max_subscriptions = max_subscriptions  # Лимит подписок на одно соединение
+        self.keepalive_margin = keepalive_margin
+        self.max_backoff = max_backoff
+        self.session_id = None
+        self.keepalive_timeout = 10
+        self.user_ids = {}                        # login -> broadcaster_user_id
+        self.subscriptions = {}                   # login -> [id подписок]
+        self.covered = set()                      # Логины, статус которых приходит по EventSub
+        self.seen = OrderedDict()                 # Последние message_id - Twitch может прислать событие повторно
+        self.task = None
+        self.sync_task = None
+        self.sync_pending = False
+        self.reconcile_pending = False
+        self.handlers = set()                     # Задачи обработки уведомлений
+        self.stats = {'connects': 0, 'migrations': 0, 'notifications': 0, 'duplicates': 0,
+                      'keepalive_timeouts': 0, 'revocations': 0}
+    
+    def start(self):
+        """Запустить клиент, если есть токен"""
+        if not self.token or (self.task and not self.task.done()):
+            return False
+        self.task = asyncio.create_task(self.run())
+        return True
+    
+    async def stop(self):
+        """Остановить клиент"""
+        tasks_to_cancel = [task for task in (self.task, self.sync_task, *self.handlers) if task and not task.done()]
+        for task in tasks_to_cancel:
+            task.cancel()
+        await asyncio.gather(*tasks_to_cancel, return_exceptions=True)
+        self.drop_session()
+    
+    def headers(self):
+        return {'Client-ID': os.getenv('TWITCH_CLIENT_ID'), 'Authorization': f'Bearer {self.token}'}
+    
+    async def run(self):
+        """Держать соединение: переносить сессию по запросу Twitch и переподключаться после обрывов"""
+        failures = 0
+        while True:
+            ws = None
+            try:
+                ws = await self.open(self.url)
+                failures = 0
+                # Новая сессия: подписки создаются заново, пропущенное за время обрыва сверяем опросом
+                self.request_sync(reconcile=True)
+                
+                while True:
+                    reconnect_url = await self.listen(ws)
+                    # Перенос: старое соединение закрываем только после приветствия на новом
+                    new_ws = await self.open(reconnect_url)
+                    await ws.close()
+                    ws = new_ws
+                    self.stats['migrations'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ошибка соединения EventSub: {e}")
+            finally:
+                if ws is not None:
+                    await ws.close()
+            
+            # Подписки сессии удалены вместе с ней - до переподключения стримеров опрашивает поллер
+            self.drop_session()
+            failures += 1
+            delay = min(self.max_backoff, 2 ** failures)
+            await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))
+    
+    async def open(self, url):
+        """Подключиться и дождаться session_welcome"""
+        ws = await get_http_session().ws_connect(url, heartbeat=None)
+        try:
+            message = await self.receive(ws)
+            if message['metadata']['message_type'] != 'session_welcome':
+                raise ConnectionError(f"ожидалось session_welcome, получено {message['metadata']['message_type']}")
+        except BaseException:
+            await ws.close()
+            raise
+        
+        session = message['payload']['session']
+        self.session_id = session['id']
+        # После переноса Twitch присылает keepalive_timeout_seconds = null - оставляем прежний
+        self.keepalive_timeout = session.get('keepalive_timeout_seconds') or self.keepalive_timeout
+        self.stats['connects'] += 1
+        return ws
+    
+    async def receive(self, ws):
+        """Следующее сообщение; тишина дольше keepalive - соединение мертво"""
+        try:
+            msg = await ws.receive(timeout=self.keepalive_timeout + self.keepalive_margin)
+        except asyncio.TimeoutError:
+            self.stats['keepalive_timeouts'] += 1
+            raise ConnectionError("нет keepalive от EventSub")
+        
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            raise ConnectionError(f"соединение закрыто ({msg.type.name}, код {ws.close_code})")
+        return json.loads(msg.data)
+    
+    async def listen(self, ws):
+        """Читать сообщения сессии; возвращает адрес для переноса по session_reconnect"""
+        while True:
+            message = await self.receive(ws)
+            metadata = message['metadata']
+            message_type = metadata['message_type']
+            
+            if message_type == 'notification':
+                if metadata['message_id'] in self.seen:
+                    self.stats['duplicates'] += 1
+                    continue
+                self.seen[metadata['message_id']] = True
+                if len(self.seen) > 1000:
+                    self.seen.popitem(last=False)
+                
+                self.stats['notifications'] += 1
+                payload = message['payload']
+                # Обработка ходит в API и Discord - не задерживаем чтение keepalive
+                task = asyncio.create_task(self.handle_notification(payload['subscription']['type'], payload['event']))
+                self.handlers.add(task)
+                task.add_done_callback(self.handlers.discard)
+            elif message_type == 'session_reconnect':
+                return message['payload']['session']['reconnect_url']
+            elif message_type == 'revocation':
+                self.stats['revocations'] += 1
+                user_id = message['payload']['subscription']['condition'].get('broadcaster_user_id')
+                for login, known_id in list(self.user_ids.items()):
+                    if known_id == user_id:
+                        self.subscriptions.pop(login, None)
+                        self.covered.discard(login)
+    
+    async def handle_notification(self, event_type, event):
+        """Применить событие начала или окончания стрима"""
+        METRICS.inc('twitch_eventsub_notifications_total', type=event_type)
+        login = event.get('broadcaster_user_login', '').lower()
+        try:
+            if event_type == 'stream.online':
+                # В событии нет игры и названия - берем их из Helix (стрим может еще не появиться там).
+                # Общий кеш в обход: в нем может лежать статус «оффлайн» из последнего опроса
+                streams = await fetch_twitch_streams_batch([login])
+                stream_info = (streams or {}).get(login) or {'user_login': login, 'id': event.get('id')}
+                await apply_stream_states({login: stream_info})
+            elif event_type == 'stream.offline':
+                await apply_stream_states({login: None})
+        except Exception as e:
+            print(f"Ошибка при обработке события {event_type} для {login}: {e}")
+    
+    def drop_session(self):
+        """Сессия закрыта: ее подписки больше не действуют"""
+        self.session_id = None
+        self.subscriptions.clear()
+        self.covered.clear()
+    
+    def request_sync(self, reconcile=False):
+        """Привести подписки к TWITCH_SUBSCRIPTIONS в фоне"""
+        if self.session_id is None:
+            return
+        self.reconcile_pending = self.reconcile_pending or reconcile
+        if self.sync_task is None or self.sync_task.done():
+            self.sync_task = asyncio.create_task(self.sync())
+        else:
+            self.sync_pending = True
+    
+    async def sync(self):
+        """Создать недостающие и удалить лишние подписки, при необходимости сверить статусы"""
+        REQUEST_PRIORITY.set(PRIORITY_BACKGROUND)
+        while True:
+            self.sync_pending = False
+            try:
+                await self.sync_subscriptions()
+                if self.reconcile_pending:
+                    self.reconcile_pending = False
+                    await self.reconcile()
+            except Exception as e:
+                print(f"Ошибка синхронизации подписок EventSub: {e}")
+            if not self.sync_pending:
+                return
+    
+    async def sync_subscriptions(self):
+        session_id = self.session_id
+        wanted = set(TWITCH_SUBSCRIPTIONS.logins())
+        
+        for login in set(self.subscriptions) - wanted:
+            await self.unsubscribe(login)
+        
+        # Сверх лимита соединения стримеры остаются на опросе
+        free = self.max_subscriptions // len(self.EVENT_TYPES) - len(self.subscriptions)
+        missing = sorted(wanted - set(self.subscriptions))[:max(0, free)]
+        await self.resolve_user_ids(missing)
+        
+        # Twitch закрывает сессию без подписок через 10 секунд - подписываемся пачками параллельно
+        missing = [login for login in missing if login in self.user_ids]
+        for i in range(0, len(missing), TWITCH_EVENTSUB_SUBSCRIBE_CONCURRENCY):
+            if self.session_id != session_id:  # Сессия сменилась - синхронизация начнется заново
+                return
+            chunk = missing[i:i + TWITCH_EVENTSUB_SUBSCRIBE_CONCURRENCY]
+            await asyncio.gather(*(self.subscribe(login) for login in chunk))
+    
+    async def resolve_user_ids(self, logins):
+        """Узнать ID стримеров пачками по 100"""
+        logins = [login for login in logins if login not in self.user_ids]
+        for i in range(0, len(logins), TWITCH_STREAMS_BATCH_SIZE):
+            params = [('login', login) for login in logins[i:i + TWITCH_STREAMS_BATCH_SIZE]]
+            async with upstream_request('twitch', 'GET', f'{TWITCH_API_URL}/users', params=params, headers=self.headers()) as response:
+                if response.status != 200:
+                    print(f"Ошибка при получении ID стримеров: HTTP {response.status}")
+                    continue
+                data = await response.json()
+                for user in data.get('data', []):
+                    self.user_ids[user['login'].lower()] = user['id']
+    
+    async def subscribe(self, login):
+        """Подписаться на начало и окончание стримов одного стримера"""
+        ids = []
+        try:
+            for event_type in self.EVENT_TYPES:
+                body = {
+                    'type': event_type,
+                    'version': '1',
+                    'condition': {'broadcaster_user_id': self.user_ids[login]},
+                    'transport': {'method': 'websocket', 'session_id': self.session_id}
+                }
+                url = f'{TWITCH_API_URL}/eventsub/subscriptions'
+                async with upstream_request('twitch', 'POST', url, json=body, headers=self.headers()) as response:
+                    if response.status in (200, 202):
+                        data = await response.json()
+                        ids.append(data['data'][0]['id'])
+                    else:
+                        print(f"Ошибка подписки EventSub {event_type} для {login}: HTTP {response.status}")
+                        break
+        except Exception as e:
+            print(f"Ошибка подписки EventSub для {login}: {e}")
+        
+        self.subscriptions[login] = ids
+        if len(ids) == len(self.EVENT_TYPES):
+            self.covered.add(login)
+        else:
+            # Половина подписки бесполезна и занимает лимит соединения: удаляем ее, а стример
+            # остается без подписки - следующая синхронизация попробует снова
+            await self.unsubscribe(login)
+    
+    async def unsubscribe(self, login):
+        """Удалить подписки стримера"""
+        self.covered.discard(login)
+        for subscription_id in self.subscriptions.pop(login, []):
+            url = f'{TWITCH_API_URL}/eventsub/subscriptions'
+            async with upstream_request('twitch', 'DELETE', url, params={'id': subscription_id}, headers=self.headers()) as response:
+                if response.status not in (204, 404):
+                    print(f"Ошибка удаления подписки EventSub {login}: HTTP {response.status}")
+    
+    async def reconcile(self):
+        """Сверить статусы одним пакетным опросом: события за время без соединения потеряны"""
+        if self.covered:
+            streams = await get_twitch_streams(self.covered)
+            await apply_stream_states(streams)
+    
+    def get_stats(self):
+        return dict(self.stats, connected=self.session_id is not None, covered=len(self.covered))
+
+class NotificationDispatcher:
+    """Рассылка уведомлений о стримах по каналам Discord отдельно от опроса.
+    
+    Embed собирается один раз на событие, для каждого сервера подставляется только его текст.
+    Отправки идут параллельно (не больше concurrency) и под общим лимитом запросов к Discord;
+    лимиты отдельных каналов (route buckets) соблюдает HTTP клиент discord.py.
+    """
+    
+    def __init__(self, concurrency=10, rate=45, max_queue=10000, max_retries=2):
+        self.concurrency = concurrency
+        self.limiter = RateLimiter('discord', rate=rate, capacity=rate)  # Глобальный лимит Discord - 50 запросов/с
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.queue = None
+        self.workers = []
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'retries': 0}
+    
+    def start(self):
+        """Запустить обработчики очереди (при первой рассылке)"""
+        if self.workers:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+    
+    def dispatch(self, channel_name, stream_info, deliveries):
+        """Поставить в очередь уведомления о стриме: deliveries - [(канал Discord, текст сервера)]"""
+        self.start()
+        base = build_stream_embed(channel_name, stream_info)
+        queued_at = time.monotonic()
+        
+        for discord_channel, message in deliveries:
+            embed = base.copy()
+            embed.description = message
+            try:
+                self.queue.put_nowait((discord_channel, embed, channel_name, queued_at))
+            except asyncio.QueueFull:
+                self.stats['dropped'] += 1
+                METRICS.inc('notifications_total', status='dropped')
+                print(f"Ошибка: очередь уведомлений переполнена, уведомление о {channel_name} пропущено")
+            else:
+                self.stats['queued'] += 1
+    
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.deliver(*item)
+            except Exception as e:
+                print(f"Ошибка при рассылке уведомления: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def deliver(self, discord_channel, embed, channel_name, queued_at):
+        """Отправить одно уведомление с повтором временных ошибок"""
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                await discord_channel.send(embed=embed)
+            except (discord.Forbidden, discord.NotFound) as e:
+                # Нет прав или канал удален - повтор не поможет
+                error = e
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    self.stats['retries'] += 1
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+            else:
+                now = time.monotonic()
+                self.stats['sent'] += 1
+                METRICS.inc('notifications_total', status='sent')
+                METRICS.observe('notification_send_seconds', now - started)
+                METRICS.observe('notification_delivery_seconds', now - queued_at)
+                return
+        
+        self.stats['failed'] += 1
+        METRICS.inc('notifications_total', status='failed')
+        print(f"Ошибка отправки уведомления о стриме {channel_name} в канал {getattr(discord_channel, 'id', '?')}: {error}")
+    
+    async def drain(self):
+        """Дождаться отправки всего, что уже в очереди"""
+        if self.queue is not None:
+            await self.queue.join()
+    
+    async def stop(self, timeout=10):
+        """Дослать очередь (не дольше timeout) и остановить обработчики"""
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.drain(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Ошибка: не отправлено уведомлений при остановке: {self.queue.qsize()}")
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queue = None
+    
+    def get_stats(self):
+        return dict(self.stats, pending=self.queue.qsize() if self.queue else 0)
+
+class TwitchPollScheduler:
+    """Планировщик опроса стримов: у каждого стримера свое время следующей проверки.
+    
+    Проверки равномерно распределены по интервалу со случайным сдвигом и собираются в пачки
+    до 100 логинов; каждый запрос пачки ограничен дедлайном и не задерживает остальные.
+    Интервал подстраивается под стримера: чаще в часы, когда он обычно начинает стримы, реже
+    для тех, кто давно не выходил в эфир. Общее число запросов ограничено бюджетом -
+    если его не хватает, интервалы растягиваются.
+    """
+    
+    def __init__(self, interval=120, min_interval=30, max_interval=900, budget=60, deadline=20,
+                 batch_window=5, jitter=0.1, max_inflight=4):
+        self.interval = interval          # Базовый интервал проверки, секунды
+        self.min_interval = min_interval  # В часы, когда стример обычно начинает
+        self.max_interval = max_interval  # Для давно не стримивших
+        self.budget = budget              # Запросов к /streams в минуту на опрос
+        self.deadline = deadline          # Предельное время одного запроса пачки, секунды
+        self.batch_window = batch_window  # Проверки, до которых меньше batch_window секунд, идут той же пачкой
+        self.jitter = jitter
+        self.max_inflight = max_inflight
+        self.queue = []                   # Куча (due_at, seq, login), due_at по time.monotonic()
+        self.scheduled = {}               # login -> due_at актуальной записи в куче
+        self.states = {}                  # login -> {'live', 'last_live', 'added', 'starts'}
+        self.version = None               # Версия реестра подписок на момент последней сверки
+        self.sequence = itertools.count()
+        self.limiter = RateLimiter('twitch_poll', rate=budget / 60, capacity=max(1, budget // 12))
+        self.inflight = set()
+        self.stretch = 1.0                # Во сколько раз растянуты интервалы из-за бюджета
+        self.lag = 0.0                    # Отставание последней пачки от расписания
+        self.synced_at = 0
+        self.task = None
+        self.stats = {'batches': 0, 'checks': 0, 'timeouts': 0, 'errors': 0, 'skipped': 0}
+    
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        tasks_to_cancel = [task for task in (self.task, *self.inflight) if task and not task.done()]
+        for task in tasks_to_cancel:
+            task.cancel()
+        await asyncio.gather(*tasks_to_cancel, return_exceptions=True)
+    
+    def schedule(self, login, due_at):
+        self.scheduled[login] = due_at
+        heapq.heappush(self.queue, (due_at, next(self.sequence), login))
+    
+    def sync(self):
+        """Добавить новых стримеров (равномерно по интервалу) и пересчитать растяжение под бюджет"""
+        now = time.monotonic()
+        if self.version != TWITCH_SUBSCRIPTIONS.version:
+            for login in TWITCH_SUBSCRIPTIONS.logins() - self.scheduled.keys():
+                self.states.setdefault(login, {'live': None, 'last_live': None, 'added': time.time(), 'starts': [0] * 24})
+                self.schedule(login, now + random.uniform(0, self.interval))
+            self.version = TWITCH_SUBSCRIPTIONS.version
+        
+        # Сколько запросов в минуту нужно при текущих интервалах (по 100 логинов в запросе)
+        demand = sum(60 / self.base_interval(login) for login in TWITCH_SUBSCRIPTIONS.logins() - TWITCH_EVENTSUB.covered)
+        self.stretch = max(1.0, demand / TWITCH_STREAMS_BATCH_SIZE / self.budget)
+        self.synced_at = now
+    
+    def base_interval(self, login):
+        """Интервал стримера без учета бюджета и разброса"""
+        state = self.states[login]
+        if state['live']:
+            return self.interval  # В эфире - ждем окончания с обычным интервалом
+        
+        now = time.time()
+        hour = int(now // 3600) % 24
+        starts = state['starts']
+        if starts[hour] or starts[(hour + 1) % 24]:
+            return self.min_interval  # Обычно начинает в это время
+        
+        idle = now - (state['last_live'] or state['added'])
+        if idle > 7 * 86400:
+            return self.max_interval
+        if idle > 86400:
+            return min(self.max_interval, self.interval * 2)
+        return self.interval
+    
+    def next_interval(self, login):
+        interval = min(self.max_interval, self.base_interval(login) * self.stretch)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+    
+    def pop_batch(self, now, limit=None):
+        """Стримеры, которых пора проверить (до limit, по умолчанию 100), и отставание самого раннего из них"""
+        if limit is None:
+            limit = TWITCH_STREAMS_BATCH_SIZE
+        batch = []
+        lag = 0.0
+        while self.queue and len(batch) < limit and self.queue[0][0] <= now + self.batch_window:
+            due_at, _, login = heapq.heappop(self.queue)
+            if self.scheduled.get(login) != due_at:
+                continue  # Устаревшая запись - стример перепланирован
+            if TWITCH_SUBSCRIPTIONS.stream(login) is None:
+                del self.scheduled[login]
+                self.states.pop(login, None)
+                continue
+            if login in TWITCH_EVENTSUB.covered:
+                # Статус приходит по EventSub; проверим позже, если подписка пропадет
+                self.stats['skipped'] += 1
+                self.schedule(login, now + self.next_interval(login))
+                continue
+            if not batch:
+                lag = max(0.0, now - due_at)
+            batch.append(login)
+        return batch, lag
+    
+    async def run(self):
+        """Выдавать пачки по расписанию в пределах бюджета"""
+        REQUEST_PRIORITY.set(PRIORITY_BACKGROUND)
+        semaphore = asyncio.Semaphore(self.max_inflight)
+        while True:
+            now = time.monotonic()
+            if now - self.synced_at >= self.batch_window:
+                self.sync()
+            
+            if not self.queue or self.queue[0][0] > now:
+                delay = self.queue[0][0] - now if self.queue else self.batch_window
+                await asyncio.sleep(min(delay, self.batch_window))
+                continue
+            
+            # Бюджет и слот берем только под непустую пачку: записи в голове очереди могут оказаться
+            # устаревшими или покрытыми EventSub, и такой такт не должен тратить запросы к Helix
+            batch, lag = self.pop_batch(now)
+            if not batch:
+                continue
+            try:
+                await self.limiter.acquire(PRIORITY_BACKGROUND)
+                await semaphore.acquire()
+            except asyncio.CancelledError:
+                for login in batch:
+                    self.schedule(login, now)  # Остановка во время ожидания - пачка не теряется
+                raise
+            
+            # Пока ждали, подошли новые проверки - дополняем ими пачку
+            batch += self.pop_batch(time.monotonic(), TWITCH_STREAMS_BATCH_SIZE - len(batch))[0]
+            self.lag = lag
+            METRICS.set('twitch_poll_lag_seconds', lag)
+            task = asyncio.create_task(self.check(batch, semaphore))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+    
+    async def check(self, batch, semaphore):
+        """Проверить пачку стримеров и запланировать их следующие проверки"""
+        started = time.monotonic()
+        try:
+            streams = await asyncio.wait_for(get_twitch_streams_batch(batch), self.deadline)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            streams = None
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"Ошибка при проверке стримов: {e}")
+            streams = None
+        finally:
+            semaphore.release()
+            METRICS.observe('twitch_poll_seconds', time.monotonic() - started)
+            METRICS.inc('twitch_poll_batches_total')
+        
+        self.stats['batches'] += 1
+        now = time.monotonic()
+        if streams is None:
+            # Статус неизвестен - повторим скоро, не дожидаясь полного интервала
+            for login in batch:
+                self.schedule(login, now + min(self.interval, 30) * random.uniform(1, 1 + self.jitter))
+            return
+        
+        self.stats['checks'] += len(batch)
+        self.record(streams)
+        await apply_stream_states(streams)
+        for login in batch:
+            self.schedule(login, now + self.next_interval(login))
+    
+    def record(self, streams):
+        """Запомнить статусы и часы начала стримов"""
+        now = time.time()
+        for login, stream_info in streams.items():
+            state = self.states.get(login)
+            if state is None:
+                continue
+            if stream_info:
+                if state['live'] is False:  # Начало стрима, которое мы застали
+                    state['starts'][int(now // 3600) % 24] += 1
+                state['last_live'] = now
+            state['live'] = bool(stream_info)
+    
+    def get_stats(self):
+        now = time.monotonic()
+        return dict(
+            self.stats,
+            queue_depth=len(self.scheduled),
+            overdue=sum(1 for due_at in self.scheduled.values() if due_at <= now),
+            inflight=len(self.inflight),
+            stretch=round(self.stretch, 2),
+            lag=round(self.lag, 3),
+        )
+
+class AdmissionController:
+    """Допуск команд, которые ходят во внешние API.
+    
+    Одновременно выполняется не больше max_active команд, не больше per_guild с одного
+    сервера и per_user от одного пользователя (с учетом ожидающих). Остальные ждут в
+    общей очереди ограниченного размера; свободный слот достается серверам по кругу,
+    поэтому один шумный сервер не задерживает остальных. Кого не удалось допустить,
+    обслуживает облегченный режим: ответ из кешей или сразу «занято».
+    """
+    
+    def __init__(self, max_active=32, per_guild=4, per_user=2, max_queue=100, queue_timeout=5):
+        self.max_active = max_active
+        self.per_guild = per_guild
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout  # Дольше в очереди не ждем - лучше быстро ответить «занято»
+        self.active = 0
+        self.active_by_guild = {}           # guild_id -> выполняется команд
+        self.by_user = {}                   # user_id -> выполняется и ждет команд
+        self.queues = OrderedDict()         # guild_id -> deque ожидающих future (порядок - очередь серверов)
+        self.waiting = 0
+        self.stats = {'admitted': 0, 'queued': 0, 'shed_user': 0, 'shed_queue': 0, 'shed_timeout': 0,
+                      'served_cached': 0, 'busy': 0}
+    
+    async def acquire(self, user_id, guild_id):
+        """Дождаться слота; False - команду надо выполнить в облегченном режиме"""
+        if self.by_user.get(user_id, 0) >= self.per_user:
+            self.reject('shed_user')
+            return False
+        
+        if self.active < self.max_active and self.active_by_guild.get(guild_id, 0) < self.per_guild \
+                and guild_id not in self.queues:
+            self.start(user_id, guild_id)
+            METRICS.observe('admission_wait_seconds', 0)
+            return True
+        
+        if self.waiting >= self.max_queue:
+            self.reject('shed_queue')
+            return False
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(guild_id, deque()).append(waiter)
+        self.waiting += 1
+        self.by_user[user_id] = self.by_user.get(user_id, 0) + 1
+        self.stats['queued'] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.leave_queue(user_id, guild_id, waiter)
+            self.reject('shed_timeout')
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(user_id, guild_id)  # Слот уже выдан - возвращаем
+            else:
+                self.leave_queue(user_id, guild_id, waiter)
+            raise
+        METRICS.observe('admission_wait_seconds', time.monotonic() - started)
+        return True
+    
+    def start(self, user_id, guild_id, queued=False):
+        self.active += 1
+        self.active_by_guild[guild_id] = self.active_by_guild.get(guild_id, 0) + 1
+        if not queued:
+            self.by_user[user_id] = self.by_user.get(user_id, 0) + 1
+        self.stats['admitted'] += 1
+        METRICS.inc('admission_total', result='admitted')
+    
+    def reject(self, reason):
+        self.stats[reason] += 1
+        METRICS.inc('admission_total', result=reason)
+    
+    def leave_queue(self, user_id, guild_id, waiter):
+        """Убрать ожидающего, которому слот так и не достался"""
+        queue = self.queues.get(guild_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[guild_id]
+        self.forget_user(user_id)
+    
+    def forget_user(self, user_id):
+        count = self.by_user.get(user_id, 0) - 1
+        if count > 0:
+            self.by_user[user_id] = count
+        else:
+            self.by_user.pop(user_id, None)
+    
+    def release(self, user_id, guild_id):
+        """Команда завершилась: освободить слот и отдать его следующему"""
+        self.active -= 1
+        count = self.active_by_guild[guild_id] - 1
+        if count:
+            self.active_by_guild[guild_id] = count
+        else:
+            del self.active_by_guild[guild_id]
+        self.forget_user(user_id)
+        self.dispatch()
+    
+    def dispatch(self):
+        """Раздать свободные слоты ожидающим: по одной команде с сервера по кругу"""
+        progress = True
+        while progress and self.active < self.max_active:
+            progress = False
+            for guild_id in list(self.queues):
+                if self.active >= self.max_active:
+                    break
+                if self.active_by_guild.get(guild_id, 0) >= self.per_guild:
+                    continue
+                
+                queue = self.queues[guild_id]
+                waiter = queue.popleft()
+                self.waiting -= 1
+                if queue:
+                    self.queues.move_to_end(guild_id)
+                else:
+                    del self.queues[guild_id]
+                progress = True
+                if not waiter.done():
+                    self.start(None, guild_id, queued=True)
+                    waiter.set_result(True)
+    
+    def get_stats(self):
+        return dict(self.stats, active=self.active, waiting=self.waiting, guilds_waiting=len(self.queues))
+
+def admitted(func):
+    """Декоратор команды: выполнять ее через контроль допуска.
+    
+    Стоит на самой команде, а не в Bot.invoke: там у групп известна только группа (!twitch),
+    а подкоманда выбирается позже. Проверки прав выполняются раньше и слот не занимают.
+    """
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        await run_admitted(ctx, lambda ctx: func(ctx, *args, **kwargs))
+    return wrapper
+
+async def run_admitted(ctx, invoke):
+    """Выполнить команду через контроль допуска"""
+    user_id = ctx.author.id
+    guild_id = ctx.guild.id if ctx.guild else None
+    if not await ADMISSION.acquire(user_id, guild_id):
+        await invoke_from_cache(ctx, invoke)
+        return
+    
+    try:
+        await invoke(ctx)
+    finally:
+        ADMISSION.release(user_id, guild_id)
+
+async def invoke_from_cache(ctx, invoke):
+    """Перегрузка: ответить из кешей без запросов к API, а если данных нет - сразу сообщить о занятости"""
+    replies = []
+    send, reply = ctx.send, ctx.reply
+    
+    async def buffer_send(*args, **kwargs):
+        replies.append((send, args, kwargs))
+    
+    async def buffer_reply(*args, **kwargs):
+        replies.append((reply, args, kwargs))
+    
+    ctx.send, ctx.reply = buffer_send, buffer_reply
+    shed = {'misses': 0}
+    token = CACHE_ONLY.set(shed)
+    try:
+        await invoke(ctx)
+    except LoadShedError:
+        pass  # Промах уже учтен - ниже ответим «занято»
+    finally:
+        CACHE_ONLY.reset(token)
+        del ctx.send, ctx.reply
+    
+    # Ответ, собранный без части данных, вводил бы в заблуждение («город не найден»)
+    if shed['misses'] or not replies:
+        ADMISSION.stats['busy'] += 1
+        METRICS.inc('admission_total', result='busy')
+        await reply(PHRASES['busy'])
+        return
+    
+    ADMISSION.stats['served_cached'] += 1
+    METRICS.inc('admission_total', result='served_cached')
+    for method, args, kwargs in replies:
+        await method(*args, **kwargs)
+
+class EbilBotMixin:
+    """Общие ресурсы бота на всё время работы (для обычного и шардированного режима)"""
+    
+    async def setup_hook(self):
+        """Подготовка ресурсов перед подключением к Discord"""
+        get_http_session()
+        await asyncio.get_running_loop().run_in_executor(None, load_coin_index)
+        
+        # Восстанавливаем подписки и разрешенные каналы. Процесс держит только серверы своих шардов:
+        # их события приходят только сюда, и стримеров остальных серверов опрашивают другие процессы
+        subscriptions, allowed_channels = await STORE.load()
+        allowed_channels = {guild_id: channels for guild_id, channels in allowed_channels.items() if is_local_guild(guild_id)}
+        for guild_id, channel_name, channel_id, message in subscriptions:
+            if is_local_guild(guild_id):
+                TWITCH_SUBSCRIPTIONS.add(guild_id, channel_name, channel_id, message)
+        ALLOWED_CHANNELS.update(allowed_channels)
+        print(f"💾 Загружено подписок: {len(TWITCH_SUBSCRIPTIONS)}, "
+              f"серверов с разрешенными каналами: {len(allowed_channels)}")
+        
+        # Индекс геокодинга общий для всех процессов кластера
+        GEOCODER.load(await STORE.load_geocodes())
+        STORE.prune_geocodes(time.time() - GEOCODER.negative_ttl)
+        
+        # Статусы стримов, токен и свежие данные прошлого запуска: опрос, который начнется в on_ready,
+        # не объявит заново уже идущие стримы, а команды не пойдут в API за только что полученным
+        await load_snapshot()
+        
+        # Замер загрузки event loop и выгрузка метрик
+        self.loop_monitor = asyncio.create_task(monitor_event_loop())
+        self.metrics_server = await start_metrics_server() if METRICS_PORT else None
+    
+    async def invoke(self, ctx):
+        """Выполнить команду с замером длительности"""
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        
+        started = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            # Для групп (!twitch добавить) подкоманда известна только после выполнения
+            command = (ctx.invoked_subcommand or ctx.command).qualified_name
+            METRICS.observe('command_seconds', time.perf_counter() - started, command=command)
+            METRICS.inc('commands_total', command=command, status='error' if ctx.command_failed else 'ok')
+    
+    async def close(self):
+        """Остановка бота и освобождение ресурсов"""
+        try:
+            # Досылаем уведомления, пока соединение с Discord открыто
+            await NOTIFICATIONS.stop()
+            await super().close()
+        finally:
+            if getattr(self, 'loop_monitor', None):
+                self.loop_monitor.cancel()
+            await TWITCH_EVENTSUB.stop()
+            await TWITCH_POLLER.stop()
+            snapshot_saver.cancel()
+            await save_snapshot()
+            if getattr(self, 'metrics_server', None):
+                await self.metrics_server.cleanup()
+            await STORE.close()
+            await SHARED_CACHE.close()
+            await close_http_session()
+
+class EbilBot(EbilBotMixin, commands.Bot):
+    """Бот с одним шардом в одном процессе"""
+
+class EbilShardedBot(EbilBotMixin, commands.AutoShardedBot):
+    """Бот с несколькими шардами; шарды можно разнести по процессам через BOT_SHARD_IDS"""
+
+# Объединение одинаковых одновременных запросов к внешним API
+UPSTREAM_FLIGHTS = SingleFlight()
+
+# Общий кеш результатов внешних API для нескольких экземпляров бота и перезапусков (по умолчанию выключен)
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', '').strip().lower()  # memory, sqlite или redis
+CACHE_URL = os.getenv('CACHE_URL', '')                           # redis://[:пароль@]хост:порт/база или путь к файлу SQLite
+CACHE_PREFIX = os.getenv('CACHE_PREFIX', 'ebilbot')
+SHARED_CACHE = SharedCache(create_cache_backend(CACHE_BACKEND, CACHE_URL), CACHE_PREFIX)
+
+# Метрики бота (команда !статистика и выгрузка для Prometheus)
+METRICS = MetricsRegistry()
+
+# Шардирование: BOT_SHARD_COUNT - число шардов ('auto' - сколько рекомендует Discord, пусто - без шардов),
+# BOT_SHARD_IDS - шарды этого процесса, BOT_CLUSTER_PROCESSES - на сколько процессов разнести шарды
+SHARD_COUNT_SETTING = os.getenv('BOT_SHARD_COUNT', '').strip().lower()
+SHARD_COUNT = int(SHARD_COUNT_SETTING) if SHARD_COUNT_SETTING.isdigit() else None
+SHARD_IDS = frozenset(int(shard_id) for shard_id in os.getenv('BOT_SHARD_IDS', '').split(',') if shard_id.strip())
+CLUSTER_PROCESSES = int(os.getenv('BOT_CLUSTER_PROCESSES', 1))
+CLUSTER_INDEX = int(os.getenv('BOT_CLUSTER_INDEX', 0))
+CLUSTER_RESTART_DELAY = 5      # Пауза перед перезапуском упавшего процесса, секунды
+DISCORD_API_URL = os.getenv('DISCORD_API_URL', 'https://discord.com/api/v10')
+
 # Настройка бота
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents, case_insensitive=True)
+if SHARD_COUNT_SETTING or SHARD_IDS:
+    bot = EbilShardedBot(command_prefix='!', intents=intents, case_insensitive=True,
+                         shard_count=SHARD_COUNT, shard_ids=sorted(SHARD_IDS) or None)
+else:
+    bot = EbilBot(command_prefix='!', intents=intents, case_insensitive=True)
 
 # Русские фразы для бота
 PHRASES = {
@@ -25,6 +2223,8 @@ PHRASES = {
 • `!время` - показать текущее время
 • `!погода` - прогноз погоды для основных городов
 • `!погода <город>` - прогноз погоды для любого города
+• `!погода москва, спб, екб` - прогноз для нескольких городов
+• `!погода москва 5` - прогноз на несколько дней (до 5)
 
 
 **Сокращения городов:**
@@ -51,12 +2251,17 @@ PHRASES = {
 • `!канал добавить` - разрешить боту работать в этом канале
 • `!канал удалить` - запретить боту работать в этом канале
 • `!канал список` - показать разрешенные каналы
-• `!канал сброс` - разрешить боту работать во всех каналах''',
+• `!канал сброс` - разрешить боту работать во всех каналах
+
+**Метрики (только для администраторов):**
+• `!статистика` - показать метрики бота''',
     'time': 'Текущее время: ',
     'unknown': 'Извините, я не понимаю эту команду. Напишите `!помощь` для списка команд.',
     'error': 'Произошла ошибка при выполнении команды.',
     'weather_error': 'Не удалось получить данные о погоде. Проверьте API ключ.',
-    'no_api_key': 'API ключ OpenWeatherMap не настроен.'
+    'weather_unavailable': '⚠️ Сервис погоды сейчас не отвечает, попробуйте через несколько минут.',
+    'no_api_key': 'API ключ OpenWeatherMap не настроен.',
+    'busy': '⏳ Сейчас слишком много запросов, попробуйте через несколько секунд.'
 }
 
 # Города для прогноза погоды
@@ -68,14 +2273,56 @@ CITIES = {
     
 }
 
-# Сокращения популярных городов
+# Сокращения и разговорные названия городов (ключи в виде GeocodingIndex.normalize)
 CITY_SHORTCUTS = {
     'спб': 'Санкт-Петербург',
     'питер': 'Санкт-Петербург',
+    'ленинград': 'Санкт-Петербург',
     'екб': 'Екатеринбург',
-    'мск': 'Москва'
+    'ебург': 'Екатеринбург',
+    'мск': 'Москва',
+    'нск': 'Новосибирск',
+    'новосиб': 'Новосибирск',
+    'нн': 'Нижний Новгород',
+    'нижний': 'Нижний Новгород',
+    'ростов': 'Ростов-на-Дону',
+    'челяба': 'Челябинск',
+    'влад': 'Владивосток',
+    'крд': 'Краснодар',
 }
 
+# Сколько запросов погоды выполнять одновременно и сколько городов можно запросить за раз
+WEATHER_FETCH_CONCURRENCY = 4
+WEATHER_MAX_CITIES = 10
+
+# Кеш прогнозов погоды (прогноз OpenWeatherMap обновляется раз в 3 часа)
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', 600))          # Свежесть записи, секунды
+WEATHER_CACHE_STALE_TTL = int(os.getenv('WEATHER_CACHE_STALE_TTL', 1800))  # Отдача устаревшей записи с фоновым обновлением
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', 256))
+WEATHER_CACHE = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL, WEATHER_CACHE_STALE_TTL)
+
+# Индекс геокодинга: город ищется один раз, дальше прогноз запрашивается по координатам
+GEOCODE_NEGATIVE_TTL = 86400     # Сколько помнить, что город не найден, секунды
+GEOCODE_NEGATIVE_SIZE = 10000
+GEOCODER = GeocodingIndex(GEOCODE_NEGATIVE_TTL, GEOCODE_NEGATIVE_SIZE)
+GEOCODER.add_known(CITIES)
+
+# Прогноз по умолчанию на 2 дня, бесплатный API OpenWeatherMap дает максимум 5
+WEATHER_DEFAULT_DAYS = 2
+WEATHER_MAX_DAYS = 5
+
+# Кеш агрегатов прогноза по дням (дешевая отрисовка без повторного разбора прогноза).
+# Ключ - версия загруженного прогноза: новый ответ OpenWeatherMap дает новые агрегаты
+FORECAST_AGGREGATES = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL, WEATHER_CACHE_STALE_TTL)
+FORECAST_VERSIONS = itertools.count()
+
+# Кеш готовых ответов команд (ключ: команда + нормализованные аргументы + версия данных)
+RESPONSE_CACHE_TTL = 300
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+WEEKDAYS = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+
 # Эмодзи для погодных условий (API уже возвращает русские описания)
 WEATHER_EMOJIS = {
     'ясно': '☀️',
@@ -96,14 +2343,50 @@ WEATHER_EMOJIS = {
 }
 
 # Хранилище для отслеживания Twitch каналов
-# Структура: {guild_id: {channel_name: {'channel_id': discord_channel_id, 'message': custom_message, 'is_live': False}}}
-TWITCH_SUBSCRIPTIONS = {}
+TWITCH_SUBSCRIPTIONS = SubscriptionRegistry()
+
+# Twitch API токен (будет получен при первом запросе и обновляться заранее)
+TWITCH_TOKENS = TwitchTokenManager()
+
+# EventSub по WebSocket: нужен пользовательский токен (TWITCH_USER_TOKEN), без него работает только опрос
+TWITCH_EVENTSUB_URL = os.getenv('TWITCH_EVENTSUB_URL', 'wss://eventsub.wss.twitch.tv/ws')
+TWITCH_EVENTSUB = TwitchEventSub(TWITCH_EVENTSUB_URL, os.getenv('TWITCH_USER_TOKEN'))
+TWITCH_EVENTSUB_SUBSCRIBE_CONCURRENCY = 10
+
+# Сколько раз повторять запрос к Twitch после ответа 401
+TWITCH_AUTH_RETRIES = 1
 
-# Twitch API токен (будет получен при запуске)
-TWITCH_ACCESS_TOKEN = None
+# Максимум логинов в одном запросе к /helix/streams
+TWITCH_STREAMS_BATCH_SIZE = 100
 
-# Хранилище для разрешенных каналов
-# Структура: {guild_id: [channel_id1, channel_id2, ...]}
+# Сколько секунд статус стрима из общего кеша считается свежим (другие экземпляры не опрашивают его повторно)
+TWITCH_STREAMS_SHARED_TTL = 20
+
+# Опрос стримов: базовый интервал, пределы адаптации, бюджет запросов в минуту и дедлайн запроса
+TWITCH_POLL_INTERVAL = int(os.getenv('TWITCH_POLL_INTERVAL', 120))
+TWITCH_POLL_MIN_INTERVAL = 30
+TWITCH_POLL_MAX_INTERVAL = 900
+TWITCH_POLL_BUDGET = int(os.getenv('TWITCH_POLL_BUDGET', 60))  # Из 800 запросов Helix в минуту
+TWITCH_POLL_DEADLINE = 20
+TWITCH_POLLER = TwitchPollScheduler(TWITCH_POLL_INTERVAL, TWITCH_POLL_MIN_INTERVAL, TWITCH_POLL_MAX_INTERVAL,
+                                    TWITCH_POLL_BUDGET, TWITCH_POLL_DEADLINE)
+
+# Рассылка уведомлений о стримах: одновременных отправок и запросов к Discord в секунду
+NOTIFY_CONCURRENCY = 10
+NOTIFY_RATE = 45
+NOTIFICATIONS = NotificationDispatcher(NOTIFY_CONCURRENCY, NOTIFY_RATE)
+
+# Контроль допуска команд, которые ходят во внешние API
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', 32))  # Всего выполняется одновременно
+ADMISSION_PER_GUILD = 4          # С одного сервера
+ADMISSION_PER_USER = 2           # От одного пользователя, вместе с ожидающими
+ADMISSION_MAX_QUEUE = 100
+ADMISSION_QUEUE_TIMEOUT = 5      # Дольше ждать слот не стоит, секунды
+ADMISSION = AdmissionController(ADMISSION_MAX_ACTIVE, ADMISSION_PER_GUILD, ADMISSION_PER_USER,
+                                ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+
+# Хранилище для разрешенных каналов (множества - проверка на каждое сообщение за O(1))
+# Структура: {guild_id: {channel_id1, channel_id2, ...}}
 ALLOWED_CHANNELS = {}
 
 # Криптовалюты для мониторинга
@@ -134,6 +2417,54 @@ CRYPTO_SYMBOLS = {
     'sui': 'sui'
 }
 
+# Символы для !крипта без аргументов
+CRYPTO_DEFAULT_SYMBOLS = ['btc.d', 'nasdaq', 'btc', 'eth', 'crv']
+
+# Синонимы символов для !крипта
+CRYPTO_SYMBOL_ALIASES = {'btcd': 'btc.d'}
+
+# Фоновое обновление котировок: команда !крипта читает готовый снимок из памяти
+CRYPTO_TICKER_INTERVAL = int(os.getenv('CRYPTO_TICKER_INTERVAL', 60))  # Период обновления, секунды
+CRYPTO_SNAPSHOT_MAX_AGE = CRYPTO_TICKER_INTERVAL * 5  # Старше этого данные из снимка не используем
+CRYPTO_TRACKED_MAX = 50          # Сколько запрошенных пользователями символов обновлять в фоне
+CRYPTO_TRACKED_IDLE = 3600       # Через сколько секунд без запросов символ перестает обновляться
+CRYPTO_TRACKED = OrderedDict()   # symbol -> время последнего запроса (LRU)
+
+# Снимок котировок заменяется целиком, поэтому читатели всегда видят согласованную версию
+# Структура: {'version': n, 'updated_at': unix_time, 'entries': {symbol: (data_key, data, fetched_at)}}
+CRYPTO_SNAPSHOT = {'version': 0, 'updated_at': 0, 'entries': {}}
+
+# Каталог для файлов с данными бота
+DATA_DIR = os.getenv('BOT_DATA_DIR', 'data')
+
+# База с подписками Twitch и разрешенными каналами
+STORE_FILE = os.getenv('BOT_DB_FILE', os.path.join(DATA_DIR, 'bot.db'))
+STORE = BotStore(STORE_FILE)
+
+# Снимок состояния для быстрого перезапуска: статусы стримов, токен Twitch, свежие прогнозы и котировки.
+# У каждого процесса кластера свой снимок - подписки у них разные
+SNAPSHOT_FILE = os.getenv('BOT_SNAPSHOT_FILE', os.path.join(DATA_DIR, f'snapshot-{CLUSTER_INDEX}.json.gz' if SHARD_IDS else 'snapshot.json.gz'))
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 300))  # Период сохранения, секунды
+SNAPSHOT_VERSION = 1
+SNAPSHOT_LOADED = False        # Перезаписывать снимок можно только после попытки его прочитать
+
+# Локальный индекс монет CoinGecko (символ -> ID), строится из /coins/list и хранится на диске
+COIN_INDEX_FILE = os.path.join(DATA_DIR, 'coin_index.json')
+COIN_INDEX_REFRESH_HOURS = 24
+COIN_INDEX_RANK_PAGES = 4      # Сколько страниц /coins/markets (по 250) использовать для выбора среди одинаковых тикеров
+COIN_INDEX = {}                # symbol -> coin_id
+COIN_IDS = set()               # Все известные ID (можно писать !крипта bitcoin)
+COIN_INDEX_UPDATED_AT = 0      # Время построения индекса (unix time)
+
+# Кеш результатов поиска, пока индекс не загружен (None - символа нет на CoinGecko)
+COIN_SEARCH_CACHE_TTL = 3600
+COIN_SEARCH_CACHE = {}         # symbol -> (coin_id или None, время истечения)
+
+# Метрики: выгрузка в формате Prometheus на локальном порту (0 - выключена)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+LOOP_MONITOR_INTERVAL = 1.0    # Период замера загрузки event loop, секунды
+
 @bot.event
 async def on_ready():
     """Событие готовности бота"""
@@ -143,10 +2474,30 @@ async def on_ready():
     activity = discord.Game(name="!помощь")
     await bot.change_presence(activity=activity)
     
-    # Запускаем мониторинг Twitch стримов
-    if not check_twitch_streams.is_running():
-        check_twitch_streams.start()
+    # Запускаем мониторинг Twitch стримов: EventSub, а опрос - для стримеров без подписки
+    if TWITCH_EVENTSUB.start():
+        print("🟣 Twitch EventSub запущен")
+    if TWITCH_POLLER.task is None:
+        TWITCH_POLLER.start()
         print("🔴 Мониторинг Twitch стримов запущен")
+    
+    # Запускаем обновление индекса монет и котировок
+    if not refresh_coin_index.is_running():
+        refresh_coin_index.start()
+    if not crypto_ticker.is_running():
+        crypto_ticker.start()
+    if not snapshot_saver.is_running():
+        snapshot_saver.start()
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """Канал удален - его подписки больше некуда отправлять"""
+    removed = TWITCH_SUBSCRIPTIONS.remove_channel(channel.id)
+    for subscription in removed:
+        STORE.delete_subscription(subscription.guild_id, subscription.login)
+    if removed:
+        TWITCH_EVENTSUB.request_sync()
+        print(f"🗑️ Канал {channel.id} удален, снято подписок Twitch: {len(removed)}")
 
 @bot.command(name='время', aliases=['time'])
 async def current_time(ctx):
@@ -171,259 +2522,539 @@ async def current_time(ctx):
         await ctx.reply(PHRASES['error'])
         print(f"Ошибка в команде время: {e}")
 
+def normalize_city_query(city_name):
+    """Привести название города к виду для запроса и отображения"""
+    original_city_name = city_name.strip()
+    key = GeocodingIndex.normalize(original_city_name)
+    
+    # Проверяем сокращения городов
+    if key in CITY_SHORTCUTS:
+        city_name = CITY_SHORTCUTS[key]
+        return city_name, f"{city_name} ({original_city_name})"
+    return original_city_name, original_city_name.title()
+
+def parse_city_list(text):
+    """Разобрать список городов через запятую без повторов (порядок сохраняется)"""
+    cities = []
+    seen = set()
+    
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        city_name, display_name = normalize_city_query(part)
+        key = GeocodingIndex.normalize(city_name)
+        if key in seen:
+            continue
+        seen.add(key)
+        cities.append({'name': city_name, 'display': display_name, 'query': part.strip()})
+    
+    return cities
+
+async def get_weather_for_cities(api_key, cities):
+    """Получить прогнозы для нескольких городов параллельно: (прогнозы, флаги ошибок API) в том же порядке.
+    
+    Прогноз None без ошибки - город не найден, с ошибкой - API не ответило.
+    """
+    semaphore = asyncio.Semaphore(WEATHER_FETCH_CONCURRENCY)
+    
+    async def fetch(city):
+        async with semaphore:
+            try:
+                if 'lat' in city:
+                    weather_data = await get_weather_forecast(api_key, city['lat'], city['lon'])
+                    return weather_data, weather_data is None
+                return await get_weather_by_city_name(api_key, city['name']), False
+            except LoadShedError:
+                return None, True
+            except Exception as e:
+                # Ошибка одного города не должна ломать остальные
+                print(f"Ошибка при получении погоды для {city['name']}: {e}")
+                return None, True
+    
+    fetched = await asyncio.gather(*(fetch(city) for city in cities))
+    return [weather_data for weather_data, _ in fetched], [failed for _, failed in fetched]
+
+def parse_forecast_days(text):
+    """Отделить количество дней в конце запроса: 'москва 5' -> ('москва', 5)"""
+    if not text:
+        return None, WEATHER_DEFAULT_DAYS
+    
+    parts = text.rsplit(maxsplit=1)
+    if parts[-1].isdigit():
+        days = min(max(int(parts[-1]), 1), WEATHER_MAX_DAYS)
+        return (parts[0] if len(parts) == 2 else None), days
+    return text, WEATHER_DEFAULT_DAYS
+
+def get_weather_version(results):
+    """Версия данных для кеша ответов: какие прогнозы использованы и какой сейчас день в городе"""
+    version = []
+    for weather_data in results:
+        if weather_data and 'list' in weather_data:
+            tz_offset = weather_data.get('city', {}).get('timezone', 0)
+            local_today = (datetime.now(timezone.utc) + timedelta(seconds=tz_offset)).date()
+            version.append((get_forecast_version(weather_data), local_today))
+        else:
+            version.append(None)
+    return tuple(version)
+
+def build_city_weather_embed(display_name, weather_data, days):
+    """Собрать ответ с прогнозом для одного города"""
+    embed = discord.Embed(
+        title=f"🌤️ Прогноз погоды для города {display_name}",
+        color=0x87CEEB
+    )
+    
+    city_info = format_weather_for_city(display_name, weather_data, '🌍', days)
+    embed.add_field(
+        name=f"🌍 **{display_name.upper()}**",
+        value=city_info,
+        inline=False
+    )
+    
+    embed.set_footer(text="Данные предоставлены OpenWeatherMap")
+    return embed
+
+def build_cities_weather_embed(cities, results, failed, days):
+    """Собрать ответ с прогнозом для нескольких городов"""
+    embed = discord.Embed(
+        title=f"🌤️ Прогноз погоды на {format_days_count(days)}",
+        color=0x87CEEB
+    )
+    
+    for city, weather_data, error in zip(cities, results, failed):
+        if weather_data:
+            city_info = format_weather_for_city(city['display'], weather_data, '🌍', days)
+        elif error:
+            city_info = "⚠️ Прогноз временно недоступен"
+        else:
+            city_info = "❌ Город не найден"
+        embed.add_field(
+            name=f"🌍 **{city['display'].upper()}**",
+            value=city_info,
+            inline=False
+        )
+    
+    embed.set_footer(text="Данные предоставлены OpenWeatherMap")
+    return embed
+
+def build_default_weather_embed(cities, results, days):
+    """Собрать ответ с прогнозом для основных городов"""
+    embed = discord.Embed(
+        title=f"🌤️ Прогноз погоды на {format_days_count(days)}",
+        color=0x87CEEB
+    )
+    
+    for city, weather_data in zip(cities, results):
+        if weather_data:
+            city_info = format_weather_for_city(city['name'], weather_data, city['flag'], days)
+            embed.add_field(
+                name=f"🌍 **{city['name'].upper()}** {city['flag']}",
+                value=city_info,
+                inline=False
+            )
+    
+    embed.set_footer(text="Данные предоставлены OpenWeatherMap • Используйте !погода <город> для поиска")
+    return embed
+
+def get_cached_response(key, build):
+    """Взять готовый ответ из кеша или собрать его через build()"""
+    response = RESPONSE_CACHE.get(key)
+    if response is None:
+        response = build()
+        RESPONSE_CACHE.set(key, response)
+    return response
+
 @bot.command(name='погода', aliases=['weather'])
+@admitted
 async def weather(ctx, *, city_name=None):
-    """Показать прогноз погоды на 2 дня для городов или конкретного города"""
+    """Показать прогноз погоды на 2 дня (или N дней) для городов или конкретного города"""
     api_key = os.getenv('OPENWEATHER_API_KEY')
     if not api_key:
         await ctx.reply(PHRASES['no_api_key'])
         return
     
     try:
-        if city_name:
-            # Проверяем сокращения городов
-            original_city_name = city_name
-            city_name_lower = city_name.lower()
-            
-            if city_name_lower in CITY_SHORTCUTS:
-                city_name = CITY_SHORTCUTS[city_name_lower]
-                display_name = f"{city_name} ({original_city_name})"
-            else:
-                display_name = city_name.title()
+        city_name, days = parse_forecast_days(city_name)
+        cities = parse_city_list(city_name) if city_name else []
+        
+        # Лишние города не запрашиваем, но сообщаем, какие пропущены
+        notice = None
+        if len(cities) > WEATHER_MAX_CITIES:
+            skipped = ', '.join(city['query'] for city in cities[WEATHER_MAX_CITIES:])
+            notice = f"⚠️ Слишком много городов: показаны первые {WEATHER_MAX_CITIES}, пропущены: {skipped}"
+            cities = cities[:WEATHER_MAX_CITIES]
+        
+        if len(cities) == 1:
+            display_name = cities[0]['display']
             
             # Поиск погоды для конкретного города
-            weather_data = await get_weather_by_city_name(api_key, city_name)
+            weather_data = await get_weather_by_city_name(api_key, cities[0]['name'])
             if weather_data:
-                embed = discord.Embed(
-                    title=f"🌤️ Прогноз погоды для города {display_name}",
-                    color=0x87CEEB
-                )
-                
-                city_info = format_weather_for_city(display_name, weather_data, '🌍')
-                embed.add_field(
-                    name=f"🌍 **{display_name.upper()}**",
-                    value=city_info,
-                    inline=False
-                )
-                
-                embed.set_footer(text="Данные предоставлены OpenWeatherMap")
+                key = ('погода', display_name, days, get_weather_version([weather_data]))
+                embed = get_cached_response(key, lambda: build_city_weather_embed(display_name, weather_data, days))
                 await ctx.reply(embed=embed)
             else:
-                await ctx.reply(f"❌ Не удалось найти город '{original_city_name}'. Проверьте правильность написания.")
+                suggestions = GEOCODER.suggest(cities[0]['name'])
+                hint = f" Возможно, вы имели в виду: {', '.join(suggestions)}?" if suggestions else " Проверьте правильность написания."
+                await ctx.reply(f"❌ Не удалось найти город '{cities[0]['query']}'.{hint}")
+        elif cities:
+            # Несколько городов через запятую
+            results, failed = await get_weather_for_cities(api_key, cities)
+            
+            if not any(results):
+                if any(failed):
+                    await ctx.reply(PHRASES['weather_unavailable'])
+                else:
+                    await ctx.reply("❌ Не удалось найти ни один из указанных городов. Проверьте правильность написания.")
+                return
+            
+            # Порядок городов важен - поля ответа идут в порядке запроса
+            key = ('погода', tuple(city['display'] for city in cities), days, get_weather_version(results), tuple(failed))
+            embed = get_cached_response(key, lambda: build_cities_weather_embed(cities, results, failed, days))
+            await ctx.reply(notice, embed=embed)
         else:
             # Показать погоду для основных городов
-            embed = discord.Embed(
-                title="🌤️ Прогноз погоды на 2 дня",
-                color=0x87CEEB
-            )
-            
-            for city_name, coords in CITIES.items():
-                weather_data = await get_weather_forecast(api_key, coords['lat'], coords['lon'])
-                if weather_data:
-                    city_info = format_weather_for_city(city_name, weather_data, coords['flag'])
-                    embed.add_field(
-                        name=f"🌍 **{city_name.upper()}** {coords['flag']}",
-                        value=city_info,
-                        inline=False
-                    )
+            cities = [dict(coords, name=name) for name, coords in CITIES.items()]
+            results, _ = await get_weather_for_cities(api_key, cities)
             
-            embed.set_footer(text="Данные предоставлены OpenWeatherMap • Используйте !погода <город> для поиска")
+            key = ('погода', None, days, get_weather_version(results))
+            embed = get_cached_response(key, lambda: build_default_weather_embed(cities, results, days))
             await ctx.reply(embed=embed)
         
+    except LoadShedError:
+        pass  # Ответ «занято» отправит контроль допуска
+    except (WeatherUnavailableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await ctx.reply(PHRASES['weather_unavailable'])
+        print(f"Ошибка API погоды в команде погода: {e}")
     except Exception as e:
         await ctx.reply(PHRASES['weather_error'])
         print(f"Ошибка в команде погода: {e}")
 
 async def get_weather_forecast(api_key, lat, lon):
-    """Получить прогноз погоды через OpenWeatherMap API"""
-    url = f"http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={api_key}&units=metric&lang=ru"
+    """Получить прогноз погоды по координатам (с кешированием в процессе и в общем кеше)"""
+    key = ('coords', round(float(lat), 2), round(float(lon), 2))
+    shared_key = f'{key[1]}:{key[2]}'
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.json()
-            return None
+    async def fetch():
+        weather_data = await SHARED_CACHE.get_or_fetch(
+            'openweather', shared_key, WEATHER_CACHE_TTL, lambda: fetch_weather_forecast(api_key, lat, lon)
+        )
+        # Версия ставится до попадания в кеш: запись в кеше и снимке больше не меняется
+        if weather_data and 'list' in weather_data:
+            get_forecast_version(weather_data)
+        return weather_data
+    
+    return await WEATHER_CACHE.get_or_fetch(key, fetch)
 
 async def get_weather_by_city_name(api_key, city_name):
-    """Получить прогноз погоды по названию города"""
-    url = f"http://api.openweathermap.org/data/2.5/forecast?q={city_name}&appid={api_key}&units=metric&lang=ru"
+    """Получить прогноз погоды по названию города: координаты из индекса геокодинга, прогноз по ним.
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.json()
-            return None
-
-def format_weather_for_city(city_name, weather_data, flag):
-    """Форматировать данные о погоде для города"""
-    if not weather_data or 'list' not in weather_data:
-        return "❌ Данные недоступны"
+    None - город не найден; ошибка API - WeatherUnavailableError.
+    """
+    place = await GEOCODER.resolve(api_key, city_name)
+    if place is None:
+        return None
     
-    today = datetime.now().date()
-    tomorrow = today + timedelta(days=1)
+    weather_data = await get_weather_forecast(api_key, place['lat'], place['lon'])
+    if weather_data is None:
+        raise WeatherUnavailableError(f"нет прогноза для {city_name}")
+    return weather_data
+
+# Ключ как у WEATHER_CACHE: одновременные промахи по одной ячейке координат дают один запрос
+@coalesced('openweather', lambda api_key, lat, lon: (round(float(lat), 2), round(float(lon), 2)))
+async def fetch_weather_forecast(api_key, lat, lon):
+    """Получить прогноз погоды через OpenWeatherMap API"""
+    url = f"{OPENWEATHER_API_URL}/forecast?lat={lat}&lon={lon}&appid={api_key}&units=metric&lang=ru"
     
-    today_forecasts = []
-    tomorrow_forecasts = []
+    async with upstream_request('openweather', 'GET', url) as response:
+        if response.status == 200:
+            return await response.json()
+        return None
+
+@coalesced('openweather', lambda api_key, city_name: (api_key, GeocodingIndex.normalize(city_name)))
+async def fetch_geocode(api_key, city_name):
+    """Найти город через API геокодинга OpenWeatherMap (пустой список - не найден, None - ошибка API)"""
+    url = f"{OPENWEATHER_GEO_URL}/direct"
+    params = {'q': city_name, 'limit': 1, 'appid': api_key}
     
-    # Собираем все прогнозы для каждого дня
-    for item in weather_data['list']:
-        forecast_date = datetime.fromtimestamp(item['dt']).date()
-        
-        if forecast_date == today:
-            today_forecasts.append(item)
-        elif forecast_date == tomorrow:
-            tomorrow_forecasts.append(item)
+    async with upstream_request('openweather', 'GET', url, params=params) as response:
+        if response.status == 200:
+            return await response.json()
+        return None
+
+@functools.lru_cache(maxsize=512)
+def get_weather_emoji(description):
+    """Подобрать эмодзи к описанию погоды"""
+    description = description.lower()
+    if description in WEATHER_EMOJIS:
+        return WEATHER_EMOJIS[description]
     
-    result = ""
+    for key, value in WEATHER_EMOJIS.items():
+        if key in description:
+            return value
+    return ""
+
+def aggregate_forecast(weather_data):
+    """Сгруппировать прогноз по дням (по местной дате города) за один проход"""
+    tz_offset = weather_data.get('city', {}).get('timezone', 0)
+    days = {}
     
-    # Сегодня
-    if today_forecasts:
-        min_temp = min(round(item['main']['temp_min']) for item in today_forecasts)
-        max_temp = max(round(item['main']['temp_max']) for item in today_forecasts)
-        
-        # Берем самое частое описание погоды за день (API уже возвращает на русском)
-        descriptions = [item['weather'][0]['description'] for item in today_forecasts]
-        most_common_desc = max(set(descriptions), key=descriptions.count)
+    for item in weather_data['list']:
+        local_date = datetime.fromtimestamp(item['dt'] + tz_offset, timezone.utc).date()
         
-        # Добавляем эмодзи к описанию
-        emoji = ""
-        for key, value in WEATHER_EMOJIS.items():
-            if key in most_common_desc.lower():
-                emoji = value
-                break
+        day = days.get(local_date)
+        if day is None:
+            day = days[local_date] = {
+                'date': local_date,
+                'min_temp': None,
+                'max_temp': None,
+                'wind_min': None,
+                'wind_max': None,
+                'wind_sum': 0,
+                'count': 0,
+                'descriptions': {}
+            }
         
-        # Средняя скорость ветра за день
-        avg_wind = round(sum(item['wind']['speed'] for item in today_forecasts) / len(today_forecasts), 1)
+        min_temp = round(item['main']['temp_min'])
+        max_temp = round(item['main']['temp_max'])
+        wind = item['wind']['speed']
+        description = item['weather'][0]['description']
         
-        result += f"📅 **Сегодня**\n"
-        result += f"🌡️ **{min_temp}°C** ... **{max_temp}°C**  "
-        result += f"**|**  {emoji} {most_common_desc.capitalize()}\n"
-        result += f"💨 Ветер: **{avg_wind} м/с**\n"
+        day['min_temp'] = min_temp if day['min_temp'] is None else min(day['min_temp'], min_temp)
+        day['max_temp'] = max_temp if day['max_temp'] is None else max(day['max_temp'], max_temp)
+        day['wind_min'] = wind if day['wind_min'] is None else min(day['wind_min'], wind)
+        day['wind_max'] = wind if day['wind_max'] is None else max(day['wind_max'], wind)
+        day['wind_sum'] += wind
+        day['count'] += 1
+        day['descriptions'][description] = day['descriptions'].get(description, 0) + 1
     
-    # Завтра
-    if tomorrow_forecasts:
-        min_temp = min(round(item['main']['temp_min']) for item in tomorrow_forecasts)
-        max_temp = max(round(item['main']['temp_max']) for item in tomorrow_forecasts)
-        
-        # Берем самое частое описание погоды за день (API уже возвращает на русском)
-        descriptions = [item['weather'][0]['description'] for item in tomorrow_forecasts]
-        most_common_desc = max(set(descriptions), key=descriptions.count)
-        
-        # Добавляем эмодзи к описанию
-        emoji = ""
-        for key, value in WEATHER_EMOJIS.items():
-            if key in most_common_desc.lower():
-                emoji = value
-                break
-        
-        # Средняя скорость ветра за день
-        avg_wind = round(sum(item['wind']['speed'] for item in tomorrow_forecasts) / len(tomorrow_forecasts), 1)
+    result = []
+    for day in days.values():
+        # Самое частое описание погоды за день (при равенстве - то, что встретилось раньше)
+        description = max(day['descriptions'], key=day['descriptions'].get)
+        result.append({
+            'date': day['date'],
+            'min_temp': day['min_temp'],
+            'max_temp': day['max_temp'],
+            'wind_min': day['wind_min'],
+            'wind_max': day['wind_max'],
+            'wind_avg': round(day['wind_sum'] / day['count'], 1),
+            'description': description,
+            'emoji': get_weather_emoji(description),
+            'histogram': day['descriptions']
+        })
+    
+    return {'timezone': tz_offset, 'days': result}
+
+def get_forecast_version(weather_data):
+    """Версия прогноза: метка ставится один раз на загруженный ответ и живет вместе с ним в WEATHER_CACHE и снимке"""
+    version = weather_data.get('_version')
+    if version is None:
+        version = weather_data['_version'] = f'{time.time_ns()}-{next(FORECAST_VERSIONS)}'
+    return version
+
+def get_forecast_aggregates(weather_data):
+    """Агрегаты прогноза по дням (кешируются отдельно от исходных данных)"""
+    key = get_forecast_version(weather_data)
+    aggregates = FORECAST_AGGREGATES.get(key)
+    if aggregates is None:
+        aggregates = aggregate_forecast(weather_data)
+        FORECAST_AGGREGATES.set(key, aggregates)
+    return aggregates
+
+def get_day_label(date, today):
+    """Подпись дня: Сегодня, Завтра или день недели с датой"""
+    if date == today:
+        return "Сегодня"
+    if date == today + timedelta(days=1):
+        return "Завтра"
+    return f"{WEEKDAYS[date.weekday()]}, {date.strftime('%d.%m')}"
+
+def format_days_count(days):
+    """Количество дней с правильным окончанием"""
+    if days % 10 == 1 and days % 100 != 11:
+        return f"{days} день"
+    if days % 10 in (2, 3, 4) and days % 100 not in (12, 13, 14):
+        return f"{days} дня"
+    return f"{days} дней"
+
+def format_weather_for_city(city_name, weather_data, flag, days=WEATHER_DEFAULT_DAYS):
+    """Форматировать данные о погоде для города"""
+    if not weather_data or 'list' not in weather_data:
+        return "❌ Данные недоступны"
+    
+    aggregates = get_forecast_aggregates(weather_data)
+    
+    # "Сегодня" считаем по местному времени города
+    today = (datetime.now(timezone.utc) + timedelta(seconds=aggregates['timezone'])).date()
+    
+    blocks = []
+    for day in aggregates['days']:
+        if day['date'] < today:
+            continue
+        if len(blocks) >= days:
+            break
         
-        result += f"\n📅 **Завтра**\n"
-        result += f"🌡️ **{min_temp}°C** ... **{max_temp}°C**  "
-        result += f"**|**  {emoji}  {most_common_desc.capitalize()} \n"
-        result += f"💨 Ветер: **{avg_wind} м/с**\n"
+        block = f"📅 **{get_day_label(day['date'], today)}**\n"
+        block += f"🌡️ **{day['min_temp']}°C** ... **{day['max_temp']}°C**  "
+        block += f"**|**  {day['emoji']} {day['description'].capitalize()}\n"
+        block += f"💨 Ветер: **{day['wind_avg']} м/с** ({day['wind_min']:g}–{day['wind_max']:g})\n"
+        blocks.append(block)
     
-    return result if result else "❌ Данные недоступны"
+    return "\n".join(blocks) if blocks else "❌ Данные недоступны"
 
 # Twitch API функции
-async def get_twitch_access_token():
-    """Получить токен доступа к Twitch API"""
+async def fetch_twitch_token():
+    """Получить токен доступа к Twitch API (данные с access_token и expires_in)"""
     client_id = os.getenv('TWITCH_CLIENT_ID')
     client_secret = os.getenv('TWITCH_CLIENT_SECRET')
     
     if not client_id or not client_secret:
         return None
     
-    url = 'https://id.twitch.tv/oauth2/token'
+    url = f'{TWITCH_OAUTH_URL}/token'
     params = {
         'client_id': client_id,
         'client_secret': client_secret,
         'grant_type': 'client_credentials'
     }
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, params=params) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data.get('access_token')
+    async with upstream_request('twitch', 'POST', url, params=params) as response:
+        if response.status == 200:
+            return await response.json()
     return None
 
 async def check_twitch_stream(channel_name):
     """Проверить статус стрима на Twitch"""
-    global TWITCH_ACCESS_TOKEN
+    streams = await get_twitch_streams_batch([channel_name])
+    if streams is None:
+        return None
     
-    if not TWITCH_ACCESS_TOKEN:
-        TWITCH_ACCESS_TOKEN = await get_twitch_access_token()
-        if not TWITCH_ACCESS_TOKEN:
-            return None
+    stream_info = streams.get(channel_name)
+    return [stream_info] if stream_info else []
+
+async def get_twitch_streams_batch(logins):
+    """Получить стримы для пачки логинов (до 100): свежие статусы из общего кеша, остальные одним запросом к Helix"""
+    cached = await SHARED_CACHE.get_many('twitch', logins)
+    # В общем кеше оффлайн хранится как пустой словарь
+    streams = {login: stream_info or None for login, stream_info in cached.items()}
+    missing = [login for login in logins if login not in cached]
+    if not missing:
+        return streams
     
-    client_id = os.getenv('TWITCH_CLIENT_ID')
-    headers = {
-        'Client-ID': client_id,
-        'Authorization': f'Bearer {TWITCH_ACCESS_TOKEN}'
-    }
+    fetched = await fetch_twitch_streams_batch(missing)
+    if fetched is None:
+        return streams or None
     
-    url = f'https://api.twitch.tv/helix/streams?user_login={channel_name}'
+    await SHARED_CACHE.set_many('twitch', {login: stream_info or {} for login, stream_info in fetched.items()},
+                                TWITCH_STREAMS_SHARED_TTL)
+    streams.update(fetched)
+    return streams
+
+async def fetch_twitch_streams_batch(logins):
+    """Получить стримы для пачки логинов (до 100) одним запросом к Helix"""
+    client_id = os.getenv('TWITCH_CLIENT_ID')
+    url = f'{TWITCH_API_URL}/streams'
+    params = [('user_login', login) for login in logins]
+    params.append(('first', str(TWITCH_STREAMS_BATCH_SIZE)))
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
+    # Повторяем запрос только если токен истек, и не больше TWITCH_AUTH_RETRIES раз
+    for _ in range(TWITCH_AUTH_RETRIES + 1):
+        token = await TWITCH_TOKENS.get()
+        if not token:
+            return None
+        
+        headers = {
+            'Client-ID': client_id,
+            'Authorization': f'Bearer {token}'
+        }
+        
+        async with upstream_request('twitch', 'GET', url, params=params, headers=headers) as response:
             if response.status == 200:
                 data = await response.json()
-                return data.get('data', [])
+                # Логины без активного стрима считаем оффлайн
+                streams = {login: None for login in logins}
+                for stream_info in data.get('data', []):
+                    streams[stream_info.get('user_login', '').lower()] = stream_info
+                return streams
             elif response.status == 401:  # Токен истек
-                TWITCH_ACCESS_TOKEN = await get_twitch_access_token()
-                return await check_twitch_stream(channel_name)
+                TWITCH_TOKENS.invalidate(token)
+                continue
+            return None
     return None
 
-@tasks.loop(minutes=2)
-async def check_twitch_streams():
-    """Проверять статус всех отслеживаемых стримов каждые 2 минуты"""
-    for guild_id, channels in TWITCH_SUBSCRIPTIONS.items():
-        guild = bot.get_guild(guild_id)
-        if not guild:
+async def get_twitch_streams(logins):
+    """Получить статусы стримов для всех логинов пачками по 100 параллельно"""
+    logins = sorted(set(logins))
+    batches = [logins[i:i + TWITCH_STREAMS_BATCH_SIZE] for i in range(0, len(logins), TWITCH_STREAMS_BATCH_SIZE)]
+    
+    results = await asyncio.gather(*(get_twitch_streams_batch(batch) for batch in batches), return_exceptions=True)
+    
+    # Карта логин -> данные стрима (None - оффлайн). Логинов из неудачных запросов в ней нет
+    streams = {}
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            print(f"Ошибка при проверке стримов {', '.join(batch)}: {result}")
+        elif result:
+            streams.update(result)
+    return streams
+
+async def poll_twitch_streams():
+    """Проверить всех стримеров сразу (обычно проверки распределяет TWITCH_POLLER)"""
+    # Один и тот же стример может отслеживаться на многих серверах - запрашиваем его один раз.
+    # Статусы стримеров с подпиской EventSub приходят сами
+    logins = TWITCH_SUBSCRIPTIONS.logins() - TWITCH_EVENTSUB.covered
+    if not logins:
+        return
+    
+    streams = await get_twitch_streams(logins)
+    await apply_stream_states(streams)
+
+async def apply_stream_states(streams):
+    """Обновить статусы подписок по карте логин -> данные стрима (None - оффлайн) и разослать уведомления"""
+    # Логинов без статуса (ошибка API) в карте нет - их подписки не трогаем до следующей проверки.
+    # Статус общий для всех серверов, а обходим только подписчиков стримера, у которого начался стрим
+    for channel_name, stream_info in streams.items():
+        if not TWITCH_SUBSCRIPTIONS.set_live(channel_name, bool(stream_info), stream_info.get('id') if stream_info else None):
             continue
-            
-        for channel_name, info in channels.items():
+        
+        targets = []
+        for subscription in TWITCH_SUBSCRIPTIONS.followers(channel_name):
             try:
-                stream_data = await check_twitch_stream(channel_name)
-                
-                if stream_data and len(stream_data) > 0:
-                    # Стрим онлайн
-                    if not info['is_live']:
-                        # Стрим только что начался
-                        info['is_live'] = True
-                        
-                        discord_channel = guild.get_channel(info['channel_id'])
-                        if discord_channel:
-                            message = info.get('message', f"Поток {channel_name} потёк! 🔴")
-                            
-                            embed = discord.Embed(
-                                title="🔴 Стрим начался!",
-                                description=message,
-                                color=0x9146FF,
-                                url=f"https://twitch.tv/{channel_name}"
-                            )
-                            
-                            stream_info = stream_data[0]
-                            embed.add_field(name="Канал", value=channel_name, inline=True)
-                            embed.add_field(name="Игра", value=stream_info.get('game_name', 'Не указана'), inline=True)
-                            embed.add_field(name="Зрители", value=stream_info.get('viewer_count', 0), inline=True)
-                            embed.add_field(name="Название", value=stream_info.get('title', 'Без названия'), inline=False)
-                            
-                            await discord_channel.send(embed=embed)
-                else:
-                    # Стрим оффлайн
-                    info['is_live'] = False
-                    
+                guild = bot.get_guild(subscription.guild_id)
+                discord_channel = guild.get_channel(subscription.channel_id) if guild else None
+                if discord_channel:
+                    targets.append((discord_channel, subscription.text))
             except Exception as e:
                 print(f"Ошибка при проверке стрима {channel_name}: {e}")
+        
+        # Отправка идет в фоне - следующая проверка не ждет популярного стримера с сотнями серверов
+        if targets:
+            NOTIFICATIONS.dispatch(channel_name, stream_info, targets)
+
+def build_stream_embed(channel_name, stream_info):
+    """Embed уведомления о начале стрима (без текста сервера)"""
+    embed = discord.Embed(
+        title="🔴 Стрим начался!",
+        color=0x9146FF,
+        url=f"https://twitch.tv/{channel_name}"
+    )
+    
+    embed.add_field(name="Канал", value=channel_name, inline=True)
+    embed.add_field(name="Игра", value=stream_info.get('game_name', 'Не указана'), inline=True)
+    embed.add_field(name="Зрители", value=stream_info.get('viewer_count', 0), inline=True)
+    embed.add_field(name="Название", value=stream_info.get('title', 'Без названия'), inline=False)
+    return embed
 
 @bot.group(name='twitch', invoke_without_command=True)
 async def twitch_group(ctx):
     """Группа команд для управления Twitch уведомлениями"""
     await ctx.send("Используйте `!twitch добавить <канал>`, `!twitch удалить <канал>`, `!twitch список` или `!twitch сообщение <канал> <текст>`")
 
+def default_twitch_message(channel_name):
+    """Стандартный текст уведомления о начале стрима"""
+    return f"Поток {channel_name} потёк! 🔴"
+
 def extract_channel_name(input_text):
     """Извлечь имя канала из ссылки или текста"""
     # Убираем пробелы
@@ -444,13 +3075,11 @@ def extract_channel_name(input_text):
 
 @twitch_group.command(name='добавить', aliases=['add'])
 @commands.has_permissions(administrator=True)
+@admitted
 async def twitch_add(ctx, *, channel_input: str):
     """Добавить Twitch канал для мониторинга"""
     guild_id = ctx.guild.id
     
-    if guild_id not in TWITCH_SUBSCRIPTIONS:
-        TWITCH_SUBSCRIPTIONS[guild_id] = {}
-    
     # Извлекаем имя канала из ссылки или текста
     channel_name = extract_channel_name(channel_input)
     
@@ -464,11 +3093,11 @@ async def twitch_add(ctx, *, channel_input: str):
         await ctx.reply(f"❌ Не удалось найти канал '{channel_name}' на Twitch или проблема с API.")
         return
     
-    TWITCH_SUBSCRIPTIONS[guild_id][channel_name] = {
-        'channel_id': ctx.channel.id,
-        'message': f"Поток {channel_name} потёк! 🔴",
-        'is_live': len(stream_data) > 0  # Текущий статус
-    }
+    # Уже идущий стрим нового стримера не объявляем; у отслеживаемого статус ведет опрос
+    is_live = len(stream_data) > 0 if TWITCH_SUBSCRIPTIONS.stream(channel_name) is None else None
+    subscription = TWITCH_SUBSCRIPTIONS.add(guild_id, channel_name, ctx.channel.id, is_live=is_live)
+    STORE.save_subscription(subscription)
+    TWITCH_EVENTSUB.request_sync()
     
     await ctx.reply(f"✅ Канал '{channel_name}' добавлен для мониторинга в этом канале!\n🔗 https://twitch.tv/{channel_name}")
 
@@ -481,8 +3110,9 @@ async def twitch_remove(ctx, *, channel_input: str):
     # Извлекаем имя канала из ссылки или текста
     channel_name = extract_channel_name(channel_input)
     
-    if guild_id in TWITCH_SUBSCRIPTIONS and channel_name in TWITCH_SUBSCRIPTIONS[guild_id]:
-        del TWITCH_SUBSCRIPTIONS[guild_id][channel_name]
+    if TWITCH_SUBSCRIPTIONS.remove(guild_id, channel_name):
+        STORE.delete_subscription(guild_id, channel_name)
+        TWITCH_EVENTSUB.request_sync()
         await ctx.reply(f"✅ Канал '{channel_name}' удален из мониторинга.")
     else:
         await ctx.reply(f"❌ Канал '{channel_name}' не найден в списке мониторинга.")
@@ -492,7 +3122,8 @@ async def twitch_list(ctx):
     """Показать список отслеживаемых каналов"""
     guild_id = ctx.guild.id
     
-    if guild_id not in TWITCH_SUBSCRIPTIONS or not TWITCH_SUBSCRIPTIONS[guild_id]:
+    subscriptions = TWITCH_SUBSCRIPTIONS.for_guild(guild_id)
+    if not subscriptions:
         await ctx.reply("📋 Нет отслеживаемых каналов.")
         return
     
@@ -501,199 +3132,347 @@ async def twitch_list(ctx):
         color=0x9146FF
     )
     
-    for channel_name, info in TWITCH_SUBSCRIPTIONS[guild_id].items():
-        status = "🔴 В эфире" if info['is_live'] else "⚫ Не в эфире"
-        discord_channel = ctx.guild.get_channel(info['channel_id'])
+    for channel_name, subscription in subscriptions.items():
+        status = "🔴 В эфире" if subscription.is_live else "⚫ Не в эфире"
+        discord_channel = ctx.guild.get_channel(subscription.channel_id)
         channel_mention = discord_channel.mention if discord_channel else "Канал удален"
         
         embed.add_field(
             name=f"{channel_name} {status}",
-            value=f"Канал: {channel_mention}\nСообщение: {info['message']}",
+            value=f"Канал: {channel_mention}\nСообщение: {subscription.text}",
             inline=False
         )
     
     await ctx.reply(embed=embed)
 
-@twitch_group.command(name='сообщение', aliases=['message'])
-@commands.has_permissions(administrator=True)
-async def twitch_message(ctx, channel_input: str, *, message: str):
-    """Настроить кастомное сообщение для канала"""
-    guild_id = ctx.guild.id
+@twitch_group.command(name='сообщение', aliases=['message'])
+@commands.has_permissions(administrator=True)
+async def twitch_message(ctx, channel_input: str, *, message: str):
+    """Настроить кастомное сообщение для канала"""
+    guild_id = ctx.guild.id
+    
+    # Извлекаем имя канала из ссылки или текста
+    channel_name = extract_channel_name(channel_input)
+    
+    subscription = TWITCH_SUBSCRIPTIONS.get(guild_id, channel_name)
+    if subscription is not None:
+        TWITCH_SUBSCRIPTIONS.set_message(subscription, message)
+        STORE.save_subscription(subscription)
+        await ctx.reply(f"✅ Сообщение для канала '{channel_name}' обновлено!")
+    else:
+        await ctx.reply(f"❌ Канал '{channel_name}' не найден в списке мониторинга. Сначала добавьте его командой `!twitch добавить https://twitch.tv/{channel_name}`")
+
+# Криптовалюты API функции
+async def search_coin_id(symbol):
+    """Поиск ID монеты по символу через CoinGecko API"""
+    try:
+        url = f"{COINGECKO_API_URL}/search?query={symbol}"
+        
+        async with upstream_request('coingecko', 'GET', url) as response:
+            if response.status == 200:
+                data = await response.json()
+                coins = data.get('coins', [])
+                
+                # Если нашли монеты, возвращаем ID первой (наиболее релевантной)
+                if coins:
+                    # Сначала ищем точное совпадение по символу
+                    for coin in coins:
+                        if coin.get('symbol', '').lower() == symbol.lower():
+                            return coin.get('id')
+                    
+                    # Если точного совпадения нет, берем первую из результатов
+                    return coins[0].get('id')
+        
+        return None
+    except Exception as e:
+        print(f"Ошибка при поиске ID для {symbol}: {e}")
+        return None
+
+def build_coin_index(coins, ranks):
+    """Построить индекс символ -> ID (при одинаковых тикерах побеждает монета с большей капитализацией)"""
+    index = {}
+    best = {}
+    
+    for coin in coins:
+        symbol = (coin.get('symbol') or '').lower()
+        coin_id = coin.get('id')
+        if not symbol or not coin_id:
+            continue
+        
+        # Детерминированный выбор: место по капитализации, затем более короткий ID, затем по алфавиту
+        key = (ranks.get(coin_id, float('inf')), len(coin_id), coin_id)
+        if symbol not in best or key < best[symbol]:
+            best[symbol] = key
+            index[symbol] = coin_id
+    
+    return index
+
+def load_coin_index():
+    """Загрузить индекс монет с диска"""
+    global COIN_INDEX, COIN_IDS, COIN_INDEX_UPDATED_AT
+    
+    try:
+        with open(COIN_INDEX_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        COIN_INDEX = data.get('symbols', {})
+        COIN_IDS = set(data.get('ids', []))
+        COIN_INDEX_UPDATED_AT = data.get('updated_at', 0)
+        print(f"💰 Индекс монет загружен: {len(COIN_INDEX)} символов")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Ошибка при загрузке индекса монет: {e}")
+
+def save_coin_index():
+    """Сохранить индекс монет на диск"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    data = {'updated_at': COIN_INDEX_UPDATED_AT, 'symbols': COIN_INDEX, 'ids': sorted(COIN_IDS)}
+    
+    # Пишем во временный файл и подменяем, чтобы не оставить битый индекс
+    tmp_file = f'{COIN_INDEX_FILE}.{os.getpid()}.tmp'  # Процессы кластера пишут индекс независимо
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_file, COIN_INDEX_FILE)
+
+async def fetch_coin_list():
+    """Получить полный список монет CoinGecko"""
+    url = f"{COINGECKO_API_URL}/coins/list"
+    
+    async with upstream_request('coingecko', 'GET', url) as response:
+        if response.status == 200:
+            return await response.json()
+        return None
+
+async def fetch_coin_ranks():
+    """Получить места монет по капитализации (ID -> место)"""
+    ranks = {}
+    
+    for page in range(1, COIN_INDEX_RANK_PAGES + 1):
+        url = f"{COINGECKO_API_URL}/coins/markets?vs_currency=usd&order=market_cap_desc&per_page=250&page={page}"
+        async with upstream_request('coingecko', 'GET', url) as response:
+            if response.status != 200:
+                break
+            coins = await response.json()
+            if not coins:
+                break
+            for coin in coins:
+                ranks.setdefault(coin.get('id'), len(ranks) + 1)
+    
+    return ranks
+
+@tasks.loop(hours=COIN_INDEX_REFRESH_HOURS)
+async def refresh_coin_index():
+    """Обновлять индекс монет по расписанию"""
+    global COIN_INDEX, COIN_IDS, COIN_INDEX_UPDATED_AT
+    REQUEST_PRIORITY.set(PRIORITY_BACKGROUND)
+    
+    # Индекс с диска еще свежий - сеть не трогаем
+    if COIN_INDEX and time.time() - COIN_INDEX_UPDATED_AT < COIN_INDEX_REFRESH_HOURS * 3600:
+        return
+    
+    try:
+        coins = await fetch_coin_list()
+        if not coins:
+            return
+        ranks = await fetch_coin_ranks()
+        
+        COIN_INDEX = build_coin_index(coins, ranks)
+        COIN_IDS = {coin['id'] for coin in coins if coin.get('id')}
+        COIN_INDEX_UPDATED_AT = time.time()
+        COIN_SEARCH_CACHE.clear()
+        
+        await asyncio.get_running_loop().run_in_executor(None, save_coin_index)
+        print(f"💰 Индекс монет обновлен: {len(COIN_INDEX)} символов")
+    except Exception as e:
+        print(f"Ошибка при обновлении индекса монет: {e}")
+
+def lookup_coin_id(symbol_lower):
+    """Найти ID монеты локально, без запросов к API"""
+    if symbol_lower in CRYPTO_SYMBOLS:
+        return CRYPTO_SYMBOLS[symbol_lower]
+    if symbol_lower in COIN_INDEX:
+        return COIN_INDEX[symbol_lower]
+    if symbol_lower in COIN_IDS:
+        return symbol_lower
+    return None
+
+async def resolve_coin_id(symbol_lower):
+    """Определить ID монеты CoinGecko по символу"""
+    coin_id = lookup_coin_id(symbol_lower)
     
-    # Извлекаем имя канала из ссылки или текста
-    channel_name = extract_channel_name(channel_input)
+    # Индекс загружен, значит такой монеты нет - сеть не трогаем
+    if coin_id or COIN_INDEX:
+        return coin_id
     
-    if guild_id in TWITCH_SUBSCRIPTIONS and channel_name in TWITCH_SUBSCRIPTIONS[guild_id]:
-        TWITCH_SUBSCRIPTIONS[guild_id][channel_name]['message'] = message
-        await ctx.reply(f"✅ Сообщение для канала '{channel_name}' обновлено!")
+    # Индекса еще нет: ищем через API, запоминая результат (в том числе отрицательный)
+    cached = COIN_SEARCH_CACHE.get(symbol_lower)
+    if cached and cached[1] > time.monotonic():
+        coin_id = cached[0]
     else:
-        await ctx.reply(f"❌ Канал '{channel_name}' не найден в списке мониторинга. Сначала добавьте его командой `!twitch добавить https://twitch.tv/{channel_name}`")
+        coin_id = await search_coin_id(symbol_lower)
+        COIN_SEARCH_CACHE[symbol_lower] = (coin_id, time.monotonic() + COIN_SEARCH_CACHE_TTL)
+    
+    # Если не нашли, пробуем использовать символ как ID
+    return coin_id or symbol_lower
 
-# Криптовалюты API функции
-async def search_coin_id(symbol):
-    """Поиск ID монеты по символу через CoinGecko API"""
+@coalesced('coingecko', lambda coin_ids: (tuple(sorted(set(coin_ids))),))
+async def get_crypto_prices(coin_ids):
+    """Получить цены для нескольких монет одним запросом к CoinGecko"""
+    if not coin_ids:
+        return {}
+    
+    # Цены, которые недавно получил любой экземпляр бота, берем из общего кеша
+    prices = await SHARED_CACHE.get_many('coingecko', coin_ids)
+    missing = [coin_id for coin_id in coin_ids if coin_id not in prices]
+    if not missing:
+        return prices
+    
+    ids = ','.join(missing)
+    url = f"{COINGECKO_API_URL}/simple/price?ids={ids}&vs_currencies=usd&include_24hr_change=true&include_market_cap=true"
+    
     try:
-        url = f"https://api.coingecko.com/api/v3/search?query={symbol}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    coins = data.get('coins', [])
-                    
-                    # Если нашли монеты, возвращаем ID первой (наиболее релевантной)
-                    if coins:
-                        # Сначала ищем точное совпадение по символу
-                        for coin in coins:
-                            if coin.get('symbol', '').lower() == symbol.lower():
-                                return coin.get('id')
-                        
-                        # Если точного совпадения нет, берем первую из результатов
-                        return coins[0].get('id')
-        
-        return None
+        async with upstream_request('coingecko', 'GET', url) as response:
+            if response.status == 200:
+                fetched = await response.json()
+                await SHARED_CACHE.set_many('coingecko', fetched, CRYPTO_TICKER_INTERVAL)
+                prices.update(fetched)
     except Exception as e:
-        print(f"Ошибка при поиске ID для {symbol}: {e}")
-        return None
+        print(f"Ошибка при получении данных для {ids}: {e}")
+    return prices
 
 async def get_crypto_data(symbols):
     """Получить данные о криптовалютах через CoinGecko API"""
     if isinstance(symbols, str):
         symbols = [symbols]
     
-    results = {}
-    symbol_to_id_map = {}  # Для сохранения соответствия символа и ID
+    want_btc_dominance = False
+    want_nasdaq = False
+    coin_symbols = []
     
     for symbol in symbols:
         symbol_lower = symbol.lower()
         
-        # Специальная обработка для BTC.D (Bitcoin Dominance)
+        # Специальная обработка для BTC.D (Bitcoin Dominance) и NASDAQ
         if symbol_lower == 'btc.d' or symbol_lower == 'btcd':
-            btc_dominance = await get_btc_dominance()
-            if btc_dominance:
-                results['btc.d'] = btc_dominance
-                symbol_to_id_map[symbol_lower] = 'btc.d'
-            continue
-        
-        # Специальная обработка для NASDAQ
-        if symbol_lower == 'nasdaq':
-            nasdaq_data = await get_nasdaq_data()
-            if nasdaq_data:
-                results['nasdaq'] = nasdaq_data
-                symbol_to_id_map[symbol_lower] = 'nasdaq'
-            continue
-        
-        # Обычные криптовалюты
-        if symbol_lower in CRYPTO_SYMBOLS:
-            coin_id = CRYPTO_SYMBOLS[symbol_lower]
+            want_btc_dominance = True
+        elif symbol_lower == 'nasdaq':
+            want_nasdaq = True
         else:
-            # Если символ не в нашем словаре, пробуем найти его через API поиска
-            coin_id = await search_coin_id(symbol_lower)
-            if not coin_id:
-                # Если не нашли, пробуем использовать символ как ID
-                coin_id = symbol_lower
-        
-        # Сохраняем соответствие символа и ID
-        symbol_to_id_map[symbol_lower] = coin_id
-        
-        # Получаем данные для одной криптовалюты
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={coin_id}&vs_currencies=usd&include_24hr_change=true&include_market_cap=true"
+            coin_symbols.append(symbol)
+    
+    async def fetch_coins():
+        # Сначала определяем все ID, затем запрашиваем цены одним запросом
+        coin_ids = await asyncio.gather(*(resolve_coin_id(symbol.lower()) for symbol in coin_symbols))
+        ids = [coin_id for coin_id in dict.fromkeys(coin_ids) if coin_id]
+        if want_btc_dominance and 'bitcoin' not in ids:
+            ids.append('bitcoin')  # Изменение BTC.D оценивается по цене BTC - берем ее тем же запросом
+        prices = await get_crypto_prices(ids)
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if coin_id in data:
-                            # Сохраняем данные с оригинальным символом для отображения
-                            results[coin_id] = data[coin_id]
-                            results[coin_id]['original_symbol'] = symbol
-        except Exception as e:
-            print(f"Ошибка при получении данных для {symbol} (ID: {coin_id}): {e}")
+        coins = {}
+        for symbol, coin_id in zip(coin_symbols, coin_ids):
+            if coin_id in prices:
+                # Сохраняем данные с оригинальным символом для отображения
+                coins[coin_id] = dict(prices[coin_id], original_symbol=symbol)
+        return coins, prices.get('bitcoin')
+    
+    async def skip():
+        return None
+    
+    # Монеты, доминация и NASDAQ запрашиваются параллельно
+    (coins, btc_price), dominance, nasdaq_data = await asyncio.gather(
+        fetch_coins(),
+        get_btc_dominance() if want_btc_dominance else skip(),
+        SHARED_CACHE.get_or_fetch('yahoo', 'nasdaq', CRYPTO_TICKER_INTERVAL, get_nasdaq_data) if want_nasdaq else skip()
+    )
+    
+    results = {}
+    if dominance is not None:
+        results['btc.d'] = build_btc_dominance(dominance, btc_price)
+    if nasdaq_data:
+        results['nasdaq'] = nasdaq_data
+    results.update(coins)
     
     return results if results else None
 
+@coalesced('coingecko')
+async def get_global_market_data():
+    """Получить глобальные данные рынка через CoinGecko API"""
+    url = f"{COINGECKO_API_URL}/global"
+    
+    async with upstream_request('coingecko', 'GET', url) as response:
+        if response.status == 200:
+            return await response.json()
+        return None
+
 async def get_btc_dominance():
-    """Получить Bitcoin Dominance с расчетом изменения за 24ч"""
+    """Получить долю BTC в капитализации рынка (общий кеш для всех экземпляров бота)"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # Получаем текущие данные
-            current_url = "https://api.coingecko.com/api/v3/global"
-            async with session.get(current_url) as response:
-                if response.status == 200:
-                    current_data = await response.json()
-                    current_dominance = current_data.get('data', {}).get('market_cap_percentage', {}).get('btc', 0)
-                    
-                    # Получаем данные BTC для расчета приблизительного изменения доминации
-                    btc_url = "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd&include_24hr_change=true"
-                    async with session.get(btc_url) as btc_response:
-                        if btc_response.status == 200:
-                            btc_data = await btc_response.json()
-                            btc_change_24h = btc_data.get('bitcoin', {}).get('usd_24h_change', 0)
-                            
-                            # Приблизительный расчет изменения доминации на основе изменения цены BTC
-                            # Если BTC растет быстрее рынка, доминация увеличивается
-                            # Это упрощенный расчет, но дает представление о тренде
-                            estimated_dominance_change = btc_change_24h * 0.1  # Коэффициент 0.1 для сглаживания
-                            
-                            return {
-                                'usd': current_dominance,
-                                'usd_24h_change': estimated_dominance_change,
-                                'usd_market_cap': 0
-                            }
-                    
-                    # Если не удалось получить данные BTC, возвращаем без изменения
-                    return {
-                        'usd': current_dominance,
-                        'usd_24h_change': 0,
-                        'usd_market_cap': 0
-                    }
+        global_data = await SHARED_CACHE.get_or_fetch('coingecko', 'global', CRYPTO_TICKER_INTERVAL, get_global_market_data)
+        if global_data:
+            return global_data.get('data', {}).get('market_cap_percentage', {}).get('btc', 0)
     except Exception as e:
         print(f"Ошибка при получении Bitcoin Dominance: {e}")
     
     return None
 
+def build_btc_dominance(dominance, btc_price):
+    """Bitcoin Dominance с расчетом изменения за 24ч по цене BTC (None - цены нет)"""
+    # Приблизительный расчет изменения доминации на основе изменения цены BTC
+    # Если BTC растет быстрее рынка, доминация увеличивается
+    # Это упрощенный расчет, но дает представление о тренде
+    btc_change_24h = btc_price.get('usd_24h_change', 0) if btc_price else 0
+    estimated_dominance_change = btc_change_24h * 0.1  # Коэффициент 0.1 для сглаживания
+    
+    return {
+        'usd': dominance,
+        'usd_24h_change': estimated_dominance_change,
+        'usd_market_cap': 0
+    }
+
+@coalesced('yahoo')
 async def get_nasdaq_data():
     """Получить данные NASDAQ через Yahoo Finance API"""
     try:
         # Используем Yahoo Finance API для получения данных NASDAQ
-        url = "https://query1.finance.yahoo.com/v8/finance/chart/%5EIXIC"
+        url = f"{YAHOO_FINANCE_URL}/v8/finance/chart/%5EIXIC"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
+        async with upstream_request('yahoo', 'GET', url) as response:
+            if response.status == 200:
+                data = await response.json()
+                
+                # Извлекаем данные из ответа Yahoo Finance
+                chart = data.get('chart', {})
+                result = chart.get('result', [])
+                
+                if result:
+                    meta = result[0].get('meta', {})
+                    current_price = meta.get('regularMarketPrice', 0)
+                    previous_close = meta.get('previousClose', 0)
                     
-                    # Извлекаем данные из ответа Yahoo Finance
-                    chart = data.get('chart', {})
-                    result = chart.get('result', [])
+                    # Вычисляем изменение за день
+                    if previous_close > 0:
+                        change_24h = ((current_price - previous_close) / previous_close) * 100
+                    else:
+                        change_24h = 0
+                    
+                    return {
+                        'usd': current_price,
+                        'usd_24h_change': change_24h,
+                        'usd_market_cap': 0
+                    }
                     
-                    if result:
-                        meta = result[0].get('meta', {})
-                        current_price = meta.get('regularMarketPrice', 0)
-                        previous_close = meta.get('previousClose', 0)
-                        
-                        # Вычисляем изменение за день
-                        if previous_close > 0:
-                            change_24h = ((current_price - previous_close) / previous_close) * 100
-                        else:
-                            change_24h = 0
-                        
-                        return {
-                            'usd': current_price,
-                            'usd_24h_change': change_24h,
-                            'usd_market_cap': 0
-                        }
-                        
     except Exception as e:
         print(f"Ошибка при получении данных NASDAQ: {e}")
     
-    # Если не удалось получить данные, возвращаем демонстрационные
-    return {
-        'usd': 15420.50,  # Примерное значение NASDAQ
-        'usd_24h_change': 1.25,  # Примерное изменение за день
-        'usd_market_cap': 0
-    }
+    # None не попадает в общий кеш: демонстрационные данные подставляются только при отрисовке
+    return None
+
+# Демонстрационные данные NASDAQ, если Yahoo Finance недоступен
+NASDAQ_DEMO_DATA = {
+    'usd': 15420.50,  # Примерное значение NASDAQ
+    'usd_24h_change': 1.25,  # Примерное изменение за день
+    'usd_market_cap': 0
+}
 
 def get_tradingview_link(symbol):
     """Получить ссылку на TradingView для символа"""
@@ -708,89 +3487,27 @@ def get_tradingview_link(symbol):
         # Для криптовалют используем формат BINANCE:SYMBOLUSDT
         return f"https://www.tradingview.com/symbols/BINANCE-{symbol_upper}USDT/"
 
-def format_crypto_data(crypto_data, requested_symbols):
-    """Форматировать данные о криптовалютах"""
-    if not crypto_data:
-        return "❌ Данные недоступны"
-    
+def get_crypto_symbol_keys(crypto_data):
+    """Символ -> ключ в crypto_data (по символу, с которым данные запросили)"""
+    return {
+        data['original_symbol'].lower(): key
+        for key, data in crypto_data.items()
+        if 'original_symbol' in data
+    }
+
+def format_crypto_symbol(symbol, crypto_data, symbol_keys):
+    """Форматировать данные одного символа (пустая строка, если данных нет)"""
+    symbol_lower = symbol.lower()
     result = ""
     
-    for symbol in requested_symbols:
-        symbol_lower = symbol.lower()
-        
-        # Специальная обработка для BTC.D
-        if symbol_lower == 'btc.d' or symbol_lower == 'btcd':
-            if 'btc.d' in crypto_data:
-                data = crypto_data['btc.d']
-                dominance = data.get('usd', 0)
-                change_24h = data.get('usd_24h_change', 0)
-                
-                # Определяем эмодзи для изменения
-                if change_24h > 0:
-                    change_emoji = "📈"
-                    change_color = "+"
-                elif change_24h < 0:
-                    change_emoji = "📉"
-                    change_color = ""
-                else:
-                    change_emoji = "➡️"
-                    change_color = ""
-                
-                result += f"**BTC.D** 👑 {change_emoji}\n"
-                result += f"📊 Доминация: **{dominance:.2f}%**\n"
-                if change_24h != 0:
-                    result += f"📊 24ч: **{change_color}{change_24h:.2f}%**\n"
-                result += f"💡 Bitcoin доминация на рынке\n"
-                result += f"📈 [TradingView]({get_tradingview_link('btc.d')})\n\n"
-                continue
-        
-        # Специальная обработка для NASDAQ
-        if symbol_lower == 'nasdaq':
-            if 'nasdaq' in crypto_data:
-                data = crypto_data['nasdaq']
-                price = data.get('usd', 0)
-                change_24h = data.get('usd_24h_change', 0)
-                
-                # Определяем эмодзи для изменения цены
-                if change_24h > 0:
-                    change_emoji = "📈"
-                    change_color = "+"
-                elif change_24h < 0:
-                    change_emoji = "📉"
-                    change_color = ""
-                else:
-                    change_emoji = "➡️"
-                    change_color = ""
-                
-                result += f"**NASDAQ** 📊 {change_emoji}\n"
-                result += f"💰 Индекс: **{price:,.2f}**\n"
-                result += f"📊 24ч: **{change_color}{change_24h:.2f}%**\n"
-                result += f"🏛️ Фондовый рынок США\n"
-                result += f"📈 [TradingView]({get_tradingview_link('nasdaq')})\n\n"
-                continue
-        
-        # Обычные криптовалюты
-        coin_id = CRYPTO_SYMBOLS.get(symbol_lower, symbol_lower)
-        
-        # Ищем данные по разным ключам
-        data_key = None
-        if coin_id in crypto_data:
-            data_key = coin_id
-        else:
-            # Ищем по всем ключам в crypto_data
-            for key in crypto_data.keys():
-                if key != 'btc.d' and key != 'nasdaq':
-                    if crypto_data[key].get('original_symbol', '').lower() == symbol_lower:
-                        data_key = key
-                        break
-        
-        if data_key:
-            data = crypto_data[data_key]
-            price = data.get('usd', 0)
+    # Специальная обработка для BTC.D
+    if symbol_lower == 'btc.d' or symbol_lower == 'btcd':
+        if 'btc.d' in crypto_data:
+            data = crypto_data['btc.d']
+            dominance = data.get('usd', 0)
             change_24h = data.get('usd_24h_change', 0)
-            market_cap = data.get('usd_market_cap', 0)
             
-            # Определяем эмодзи для изменения цены
+            # Определяем эмодзи для изменения
             if change_24h > 0:
                 change_emoji = "📈"
                 change_color = "+"
@@ -801,39 +3518,224 @@ def format_crypto_data(crypto_data, requested_symbols):
                 change_emoji = "➡️"
                 change_color = ""
             
-            # Форматирование цены
-            if symbol_lower in ['btc', 'eth']:
-                price_str = f"${price:,.2f}" if price >= 1 else f"${price:.6f}"
-            else:
-                price_str = f"${price:,.4f}" if price >= 1 else f"${price:.8f}"
-            
-            # Форматирование рыночной капитализации
-            if market_cap >= 1_000_000_000:
-                market_cap_str = f"${market_cap/1_000_000_000:.1f}B"
-            elif market_cap >= 1_000_000:
-                market_cap_str = f"${market_cap/1_000_000:.1f}M"
-            elif market_cap > 0:
-                market_cap_str = f"${market_cap:,.0f}"
-            else:
-                market_cap_str = "N/A"
-            
-            result += f"**{symbol.upper()}** {change_emoji}\n"
-            result += f"💰 Цена: **{price_str}**\n"
-            result += f"📊 24ч: **{change_color}{change_24h:.2f}%**\n"
-            if market_cap > 0:
-                result += f"🏦 Кап: **{market_cap_str}**\n"
-            result += f"📈 [TradingView]({get_tradingview_link(symbol)})\n\n"
+            result += f"**BTC.D** 👑 {change_emoji}\n"
+            result += f"📊 Доминация: **{dominance:.2f}%**\n"
+            if change_24h != 0:
+                result += f"📊 24ч: **{change_color}{change_24h:.2f}%**\n"
+            result += f"💡 Bitcoin доминация на рынке\n"
+            result += f"📈 [TradingView]({get_tradingview_link('btc.d')})\n\n"
+            return result
+    
+    # Специальная обработка для NASDAQ (без ответа Yahoo Finance - демонстрационные данные)
+    if symbol_lower == 'nasdaq':
+        data = crypto_data.get('nasdaq', NASDAQ_DEMO_DATA)
+        price = data.get('usd', 0)
+        change_24h = data.get('usd_24h_change', 0)
+        
+        # Определяем эмодзи для изменения цены
+        if change_24h > 0:
+            change_emoji = "📈"
+            change_color = "+"
+        elif change_24h < 0:
+            change_emoji = "📉"
+            change_color = ""
+        else:
+            change_emoji = "➡️"
+            change_color = ""
+        
+        result += f"**NASDAQ** 📊 {change_emoji}\n"
+        result += f"💰 Индекс: **{price:,.2f}**\n"
+        result += f"📊 24ч: **{change_color}{change_24h:.2f}%**\n"
+        result += f"🏛️ Фондовый рынок США\n"
+        result += f"📈 [TradingView]({get_tradingview_link('nasdaq')})\n\n"
+        return result
+    
+    # Обычные криптовалюты
+    coin_id = lookup_coin_id(symbol_lower) or symbol_lower
+    
+    # Ищем данные по ID, затем по символу, с которым их запросили
+    data_key = coin_id if coin_id in crypto_data else symbol_keys.get(symbol_lower)
+    
+    if data_key:
+        data = crypto_data[data_key]
+        price = data.get('usd', 0)
+        change_24h = data.get('usd_24h_change', 0)
+        market_cap = data.get('usd_market_cap', 0)
+        
+        # Определяем эмодзи для изменения цены
+        if change_24h > 0:
+            change_emoji = "📈"
+            change_color = "+"
+        elif change_24h < 0:
+            change_emoji = "📉"
+            change_color = ""
+        else:
+            change_emoji = "➡️"
+            change_color = ""
+        
+        # Форматирование цены
+        if symbol_lower in ['btc', 'eth']:
+            price_str = f"${price:,.2f}" if price >= 1 else f"${price:.6f}"
+        else:
+            price_str = f"${price:,.4f}" if price >= 1 else f"${price:.8f}"
+        
+        # Форматирование рыночной капитализации
+        if market_cap >= 1_000_000_000:
+            market_cap_str = f"${market_cap/1_000_000_000:.1f}B"
+        elif market_cap >= 1_000_000:
+            market_cap_str = f"${market_cap/1_000_000:.1f}M"
+        elif market_cap > 0:
+            market_cap_str = f"${market_cap:,.0f}"
+        else:
+            market_cap_str = "N/A"
+        
+        result += f"**{symbol.upper()}** {change_emoji}\n"
+        result += f"💰 Цена: **{price_str}**\n"
+        result += f"📊 24ч: **{change_color}{change_24h:.2f}%**\n"
+        if market_cap > 0:
+            result += f"🏦 Кап: **{market_cap_str}**\n"
+        result += f"📈 [TradingView]({get_tradingview_link(symbol)})\n\n"
+    
+    return result
+
+def track_crypto_symbols(symbols):
+    """Добавить символы в рабочий набор фонового обновления"""
+    now = time.monotonic()
+    
+    for symbol in symbols:
+        symbol_lower = symbol.lower()
+        if symbol_lower in CRYPTO_DEFAULT_SYMBOLS:
+            continue
+        CRYPTO_TRACKED[symbol_lower] = now
+        CRYPTO_TRACKED.move_to_end(symbol_lower)
+    
+    # Вытесняем давно не запрашиваемые символы
+    while len(CRYPTO_TRACKED) > CRYPTO_TRACKED_MAX:
+        CRYPTO_TRACKED.popitem(last=False)
+
+def get_crypto_working_set():
+    """Символы, которые обновляет фоновая задача"""
+    now = time.monotonic()
     
+    while CRYPTO_TRACKED:
+        symbol, last_requested = next(iter(CRYPTO_TRACKED.items()))
+        if now - last_requested < CRYPTO_TRACKED_IDLE:
+            break
+        CRYPTO_TRACKED.popitem(last=False)
+    
+    return CRYPTO_DEFAULT_SYMBOLS + list(CRYPTO_TRACKED)
+
+def publish_crypto_snapshot(symbols, crypto_data):
+    """Опубликовать новую версию снимка с полученными данными"""
+    global CRYPTO_SNAPSHOT
+    
+    now = time.time()
+    working_set = set(get_crypto_working_set())
+    
+    # Копируем записи, которые еще в рабочем наборе, и добавляем свежие
+    entries = {symbol: entry for symbol, entry in CRYPTO_SNAPSHOT['entries'].items() if symbol in working_set}
+    symbol_keys = get_crypto_symbol_keys(crypto_data)
+    
+    for symbol in symbols:
+        symbol_lower = symbol.lower()
+        
+        if symbol_lower == 'btc.d' or symbol_lower == 'btcd':
+            data_key = 'btc.d'
+        elif symbol_lower == 'nasdaq':
+            data_key = 'nasdaq'
+        else:
+            data_key = lookup_coin_id(symbol_lower)
+            if data_key not in crypto_data:
+                data_key = symbol_keys.get(symbol_lower)
+        
+        if data_key in crypto_data:
+            entries[symbol_lower] = (data_key, crypto_data[data_key], now)
+    
+    CRYPTO_SNAPSHOT = {'version': CRYPTO_SNAPSHOT['version'] + 1, 'updated_at': now, 'entries': entries}
+
+def read_crypto_snapshot(symbols):
+    """Прочитать данные из снимка: (данные в формате get_crypto_data, отсутствующие символы)"""
+    snapshot = CRYPTO_SNAPSHOT
+    now = time.time()
+    
+    crypto_data = {}
+    missing = []
+    for symbol in symbols:
+        entry = snapshot['entries'].get(symbol.lower())
+        if entry and now - entry[2] < CRYPTO_SNAPSHOT_MAX_AGE:
+            data_key, data, _ = entry
+            crypto_data[data_key] = data
+        else:
+            missing.append(symbol)
+    
+    return crypto_data, missing
+
+async def get_market_data(symbols):
+    """Получить котировки из снимка, а отсутствующие - запросить и начать отслеживать"""
+    track_crypto_symbols(symbols)
+    crypto_data, missing = read_crypto_snapshot(symbols)
+    
+    if missing:
+        fetched = await get_crypto_data(missing)
+        if fetched:
+            publish_crypto_snapshot(missing, fetched)
+            crypto_data.update(fetched)
+    
+    return crypto_data or None
+
+@tasks.loop(seconds=CRYPTO_TICKER_INTERVAL)
+async def crypto_ticker():
+    """Обновлять котировки рабочего набора символов в фоне"""
+    REQUEST_PRIORITY.set(PRIORITY_BACKGROUND)
+    
+    # Котировки, восстановленные из снимка после перезапуска, еще свежие - их не запрашиваем
+    now = time.time()
+    entries = CRYPTO_SNAPSHOT['entries']
+    symbols = [symbol for symbol in get_crypto_working_set()
+               if symbol not in entries or now - entries[symbol][2] >= CRYPTO_TICKER_INTERVAL / 2]
+    if not symbols:
+        return
+    
+    try:
+        crypto_data = await get_crypto_data(symbols)
+        if crypto_data:
+            publish_crypto_snapshot(symbols, crypto_data)
+    except Exception as e:
+        print(f"Ошибка при фоновом обновлении котировок: {e}")
+
+def normalize_crypto_symbols(symbols):
+    """Привести символы к нижнему регистру, раскрыть синонимы и убрать повторы (порядок сохраняется)"""
+    normalized = []
+    for symbol in symbols:
+        symbol_lower = symbol.lower()
+        symbol_lower = CRYPTO_SYMBOL_ALIASES.get(symbol_lower, symbol_lower)
+        if symbol_lower not in normalized:
+            normalized.append(symbol_lower)
+    return normalized
+
+def get_crypto_description(symbols, crypto_data):
+    """Текст ответа !крипта из кеша отформатированных блоков по символам"""
+    # Блоки не зависят от порядка символов, поэтому "btc eth" и "eth btc" используют одну запись
+    key = ('крипта', frozenset(symbols), CRYPTO_SNAPSHOT['version'])
+    blocks = RESPONSE_CACHE.get(key)
+    
+    if blocks is None:
+        symbol_keys = get_crypto_symbol_keys(crypto_data)
+        blocks = {symbol: format_crypto_symbol(symbol, crypto_data, symbol_keys) for symbol in symbols}
+        RESPONSE_CACHE.set(key, blocks)
+    
+    result = "".join(blocks[symbol] for symbol in symbols)
     return result.strip() if result else "❌ Данные недоступны"
 
 @bot.command(name='крипта', aliases=['crypto'])
+@admitted
 async def crypto_command(ctx, *symbols):
     """Показать информацию о криптовалютах"""
     try:
         if not symbols:
             # Показать основные криптовалюты и индексы (ваш список)
-            default_symbols = ['btc.d', 'nasdaq', 'btc', 'eth', 'crv']
-            crypto_data = await get_crypto_data(default_symbols)
+            default_symbols = CRYPTO_DEFAULT_SYMBOLS
+            crypto_data = await get_market_data(default_symbols)
             
             if crypto_data:
                 embed = discord.Embed(
@@ -841,8 +3743,7 @@ async def crypto_command(ctx, *symbols):
                     color=0xF7931A
                 )
                 
-                formatted_data = format_crypto_data(crypto_data, default_symbols)
-                embed.description = formatted_data
+                embed.description = get_crypto_description(default_symbols, crypto_data)
                 embed.set_footer(text="Данные предоставлены CoinGecko • Обновляется в реальном времени")
                 
                 await ctx.reply(embed=embed)
@@ -850,7 +3751,8 @@ async def crypto_command(ctx, *symbols):
                 await ctx.reply("❌ Не удалось получить данные о криптовалютах.")
         else:
             # Показать конкретные криптовалюты
-            crypto_data = await get_crypto_data(list(symbols))
+            symbols = normalize_crypto_symbols(symbols)
+            crypto_data = await get_market_data(symbols)
             
             if crypto_data:
                 embed = discord.Embed(
@@ -858,14 +3760,15 @@ async def crypto_command(ctx, *symbols):
                     color=0xF7931A
                 )
                 
-                formatted_data = format_crypto_data(crypto_data, symbols)
-                embed.description = formatted_data
+                embed.description = get_crypto_description(symbols, crypto_data)
                 embed.set_footer(text="Данные предоставлены CoinGecko • Обновляется в реальном времени")
                 
                 await ctx.reply(embed=embed)
             else:
                 await ctx.reply("❌ Не удалось найти указанные криптовалюты. Проверьте символы.")
                 
+    except LoadShedError:
+        pass  # Ответ «занято» отправит контроль допуска
     except Exception as e:
         await ctx.reply("❌ Произошла ошибка при получении данных о криптовалютах.")
         print(f"Ошибка в команде крипта: {e}")
@@ -882,18 +3785,18 @@ async def goodbye(ctx):
 
 def is_channel_allowed(ctx):
     """Проверить, разрешен ли канал для выполнения команд"""
-    guild_id = ctx.guild.id if ctx.guild else None
-    
-    # Если сервер не настроен, разрешаем все каналы
-    if guild_id not in ALLOWED_CHANNELS:
-        return True
+    return is_channel_id_allowed(ctx.guild.id if ctx.guild else None, ctx.channel.id)
+
+def is_channel_id_allowed(guild_id, channel_id):
+    """Проверить канал по ID (без создания контекста команды)"""
+    allowed = ALLOWED_CHANNELS.get(guild_id)
     
-    # Если список пустой, разрешаем все каналы
-    if not ALLOWED_CHANNELS[guild_id]:
+    # Если сервер не настроен или список пустой, разрешаем все каналы
+    if not allowed:
         return True
     
     # Проверяем, есть ли текущий канал в списке разрешенных
-    return ctx.channel.id in ALLOWED_CHANNELS[guild_id]
+    return channel_id in allowed
 
 @bot.group(name='канал', aliases=['channel'], invoke_without_command=True)
 async def channel_group(ctx):
@@ -908,10 +3811,11 @@ async def channel_add(ctx):
     channel_id = ctx.channel.id
     
     if guild_id not in ALLOWED_CHANNELS:
-        ALLOWED_CHANNELS[guild_id] = []
+        ALLOWED_CHANNELS[guild_id] = set()
     
     if channel_id not in ALLOWED_CHANNELS[guild_id]:
-        ALLOWED_CHANNELS[guild_id].append(channel_id)
+        ALLOWED_CHANNELS[guild_id].add(channel_id)
+        STORE.add_allowed_channel(guild_id, channel_id)
         await ctx.reply(f"✅ Канал {ctx.channel.mention} добавлен в список разрешенных для команд бота!")
     else:
         await ctx.reply(f"ℹ️ Канал {ctx.channel.mention} уже находится в списке разрешенных.")
@@ -925,6 +3829,7 @@ async def channel_remove(ctx):
     
     if guild_id in ALLOWED_CHANNELS and channel_id in ALLOWED_CHANNELS[guild_id]:
         ALLOWED_CHANNELS[guild_id].remove(channel_id)
+        STORE.remove_allowed_channel(guild_id, channel_id)
         await ctx.reply(f"✅ Канал {ctx.channel.mention} удален из списка разрешенных.")
     else:
         await ctx.reply(f"ℹ️ Канал {ctx.channel.mention} не находится в списке разрешенных.")
@@ -944,7 +3849,7 @@ async def channel_list(ctx):
     )
     
     channel_mentions = []
-    for channel_id in ALLOWED_CHANNELS[guild_id]:
+    for channel_id in sorted(ALLOWED_CHANNELS[guild_id]):
         channel = ctx.guild.get_channel(channel_id)
         if channel:
             channel_mentions.append(channel.mention)
@@ -963,7 +3868,8 @@ async def channel_reset(ctx):
     guild_id = ctx.guild.id
     
     if guild_id in ALLOWED_CHANNELS:
-        ALLOWED_CHANNELS[guild_id] = []
+        ALLOWED_CHANNELS[guild_id] = set()
+        STORE.reset_allowed_channels(guild_id)
     
     await ctx.reply("✅ Список разрешенных каналов сброшен. Бот теперь работает во всех каналах!")
 
@@ -980,6 +3886,8 @@ async def on_command_error(ctx, error):
     elif isinstance(error, commands.MissingRequiredArgument):
         if is_channel_allowed(ctx):
             await ctx.reply("❌ Не хватает аргументов для команды. Используйте `!помощь` для справки.")
+    elif isinstance(getattr(error, 'original', None), LoadShedError):
+        pass  # Команда не допущена из-за нагрузки - ответ «занято» уже отправлен
     else:
         if is_channel_allowed(ctx):
             await ctx.reply(PHRASES['error'])
@@ -992,33 +3900,438 @@ async def on_message(message):
     if message.author.bot:
         return
     
-    # Проверяем, разрешен ли канал для команд
-    if message.content.startswith('!'):
-        # Создаем контекст для проверки канала
-        ctx = await bot.get_context(message)
-        if not is_channel_allowed(ctx):
-            return  # Игнорируем команды в неразрешенных каналах
+    # Быстрый выход для обычных сообщений: не команда и не упоминание бота
+    is_command = message.content.startswith(bot.command_prefix)
+    is_mention = bot.user.mentioned_in(message)
+    if not is_command and not is_mention:
+        return
     
-    # Обрабатываем команды
-    await bot.process_commands(message)
+    # Игнорируем команды и упоминания в неразрешенных каналах
+    if not is_channel_id_allowed(message.guild.id if message.guild else None, message.channel.id):
+        return
     
-    # Реагируем на упоминания (только в разрешенных каналах)
-    if bot.user.mentioned_in(message):
+    # Обрабатываем команды (контекст создается один раз)
+    if is_command:
         ctx = await bot.get_context(message)
-        if is_channel_allowed(ctx):
-            await message.add_reaction('👋')
+        await bot.invoke(ctx)
+    
+    # Реагируем на упоминания
+    if is_mention:
+        await message.add_reaction('👋')
 
-@bot.command(name='помощь')
-async def help_command(ctx):
-    """Показать справку"""
+def build_help_embed():
+    """Собрать справку по командам"""
     embed = discord.Embed(
         title="📋 Справка по командам",
         description=PHRASES['help'],
         color=0x00ff00
     )
     embed.set_footer(text="Бот создан для общения на русском языке")
+    return embed
+
+@bot.command(name='помощь')
+async def help_command(ctx):
+    """Показать справку"""
+    embed = get_cached_response(('помощь',), build_help_embed)
     await ctx.reply(embed=embed)
 
+def build_snapshot():
+    """Состояние для быстрого перезапуска (только данные, которые дорого или долго получать заново)"""
+    now, now_monotonic = time.time(), time.monotonic()
+    
+    def wall_time(monotonic):
+        return now - (now_monotonic - monotonic)
+    
+    return {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': now,
+        'twitch': {
+            # Стримы, о которых уже разосланы уведомления, - после перезапуска они не объявляются повторно
+            'live': {stream.login: stream.stream_id for stream in TWITCH_SUBSCRIPTIONS.streams.values() if stream.is_live},
+            # Копии: снимок сериализуется в другом потоке, пока бот продолжает работать
+            'poller': dict(TWITCH_POLLER.states),
+            'user_ids': dict(TWITCH_EVENTSUB.user_ids),
+            'token': {'token': TWITCH_TOKENS.token, 'expires_at': TWITCH_TOKENS.expires_at} if TWITCH_TOKENS.token else None,
+        },
+        'weather': [[list(key), wall_time(stored_at), value] for key, (value, stored_at) in WEATHER_CACHE.entries.items()],
+        'crypto': {
+            'entries': CRYPTO_SNAPSHOT['entries'],  # Снимок котировок не меняется после публикации
+            'tracked': {symbol: wall_time(requested_at) for symbol, requested_at in CRYPTO_TRACKED.items()},
+        },
+    }
+
+def restore_snapshot(snapshot):
+    """Восстановить состояние из снимка (подписки уже загружены из базы); счетчики восстановленного"""
+    global CRYPTO_SNAPSHOT
+    
+    now, now_monotonic = time.time(), time.monotonic()
+    restored = {'live': 0, 'weather': 0, 'crypto': 0}
+    
+    def monotonic_time(wall):
+        return now_monotonic - (now - wall)
+    
+    twitch = snapshot.get('twitch', {})
+    for login, stream_id in twitch.get('live', {}).items():
+        stream = TWITCH_SUBSCRIPTIONS.stream(login)
+        if stream is not None:
+            stream.is_live = True
+            stream.stream_id = stream_id
+            restored['live'] += 1
+    
+    # Расписание опроса: когда стримеры обычно начинают. Стримеров, от которых процесс отписался, не берем
+    logins = TWITCH_SUBSCRIPTIONS.logins()
+    TWITCH_POLLER.states.update({login: state for login, state in twitch.get('poller', {}).items() if login in logins})
+    TWITCH_EVENTSUB.user_ids.update(twitch.get('user_ids', {}))
+    
+    token = twitch.get('token')
+    if token and now < token['expires_at'] and not TWITCH_TOKENS.token:
+        TWITCH_TOKENS.token = token['token']
+        TWITCH_TOKENS.expires_at = token['expires_at']
+    
+    max_age = WEATHER_CACHE.ttl + WEATHER_CACHE.stale_ttl
+    for key, stored_at, value in snapshot.get('weather', []):
+        if now - stored_at < max_age:
+            if value and 'list' in value:
+                get_forecast_version(value)  # Снимок прошлой версии бота - без метки
+            WEATHER_CACHE.entries[tuple(key)] = (value, monotonic_time(stored_at))
+            restored['weather'] += 1
+    while len(WEATHER_CACHE.entries) > WEATHER_CACHE.maxsize:
+        WEATHER_CACHE.entries.popitem(last=False)
+    
+    crypto = snapshot.get('crypto', {})
+    entries = {symbol: tuple(entry) for symbol, entry in crypto.get('entries', {}).items()
+               if now - entry[2] < CRYPTO_SNAPSHOT_MAX_AGE}
+    if entries:
+        CRYPTO_SNAPSHOT = {'version': CRYPTO_SNAPSHOT['version'] + 1, 'updated_at': now, 'entries': entries}
+        restored['crypto'] = len(entries)
+    for symbol, requested_at in sorted(crypto.get('tracked', {}).items(), key=lambda item: item[1]):
+        if now - requested_at < CRYPTO_TRACKED_IDLE:
+            CRYPTO_TRACKED[symbol] = monotonic_time(requested_at)
+    
+    return restored
+
+def write_snapshot(snapshot):
+    """Записать снимок на диск (выполняется в отдельном потоке)"""
+    directory = os.path.dirname(SNAPSHOT_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    data = gzip.compress(json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode(), compresslevel=6)
+    
+    # Во временный файл и подмена, чтобы не оставить битый снимок. В снимке токен Twitch - файл только для владельца
+    tmp_file = f'{SNAPSHOT_FILE}.{os.getpid()}.tmp'
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, SNAPSHOT_FILE)
+    return len(data)
+
+def read_snapshot():
+    """Прочитать снимок с диска (None, если его нет)"""
+    try:
+        with open(SNAPSHOT_FILE, 'rb') as f:
+            return json.loads(gzip.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+
+async def load_snapshot():
+    """Восстановить состояние из снимка перед началом опроса"""
+    global SNAPSHOT_LOADED
+    
+    try:
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, read_snapshot)
+        if snapshot is not None and snapshot.get('version') == SNAPSHOT_VERSION:
+            restored = restore_snapshot(snapshot)
+            print(f"♻️ Восстановлено из снимка {time.time() - snapshot['saved_at']:.0f} с назад: "
+                  f"стримов в эфире {restored['live']}, прогнозов {restored['weather']}, котировок {restored['crypto']}")
+    except Exception as e:
+        print(f"Ошибка при чтении снимка состояния: {e}")
+    SNAPSHOT_LOADED = True
+
+async def save_snapshot():
+    """Сохранить снимок состояния на диск"""
+    if not SNAPSHOT_LOADED:
+        return  # Бот не успел восстановиться - не затираем прошлый снимок пустым
+    
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, build_snapshot())
+    except Exception as e:
+        print(f"Ошибка при сохранении снимка состояния: {e}")
+
+@tasks.loop(seconds=SNAPSHOT_INTERVAL)
+async def snapshot_saver():
+    """Сохранять снимок состояния по расписанию (на случай аварийной остановки)"""
+    await save_snapshot()
+
+def collect_bot_metrics():
+    """Показатели компонентов бота для выгрузки метрик"""
+    samples = []
+    for upstream, limiter in RATE_LIMITERS.items():
+        stats = limiter.get_stats()
+        samples.append(('rate_limiter_tokens', {'upstream': upstream}, stats['tokens']))
+        samples.append(('rate_limiter_waiting', {'upstream': upstream}, stats['waiting']))
+        samples.append(('rate_limiter_queued', {'upstream': upstream}, stats['queued']))
+        samples.append(('rate_limiter_wait_seconds', {'upstream': upstream}, round(stats['wait_time'], 3)))
+    
+    for name, cache in (('weather', WEATHER_CACHE), ('forecast', FORECAST_AGGREGATES), ('responses', RESPONSE_CACHE)):
+        for stat, value in cache.get_stats().items():
+            samples.append((f'cache_{stat}', {'cache': name}, value))
+    
+    for upstream, stats in UPSTREAM_FLIGHTS.get_stats().items():
+        samples.append(('coalesced_calls', {'upstream': upstream}, stats['calls']))
+        samples.append(('coalesced_joined', {'upstream': upstream}, stats['coalesced']))
+    
+    for stat, value in GEOCODER.get_stats().items():
+        samples.append((f'geocode_{stat}', {}, value))
+    
+    for namespace, stats in SHARED_CACHE.get_stats().items():
+        for stat, value in stats.items():
+            samples.append((f'shared_cache_{stat}', {'namespace': namespace}, value))
+    
+    admission = ADMISSION.get_stats()
+    for stat in ('active', 'waiting', 'guilds_waiting'):
+        samples.append((f'admission_{stat}', {}, admission[stat]))
+    
+    samples.append(('twitch_subscriptions', {}, len(TWITCH_SUBSCRIPTIONS)))
+    samples.append(('twitch_streamers', {}, len(TWITCH_SUBSCRIPTIONS.streams)))
+    samples.append(('crypto_tracked_symbols', {}, len(CRYPTO_TRACKED)))
+    samples.append(('twitch_eventsub_connected', {}, int(TWITCH_EVENTSUB.session_id is not None)))
+    samples.append(('notifications_pending', {}, NOTIFICATIONS.get_stats()['pending']))
+    poller = TWITCH_POLLER.get_stats()
+    for stat in ('queue_depth', 'overdue', 'inflight', 'stretch', 'timeouts', 'errors'):
+        samples.append((f'twitch_poll_{stat}', {}, poller[stat]))
+    samples.append(('twitch_eventsub_covered', {}, len(TWITCH_EVENTSUB.covered)))
+    return samples
+
+METRICS.add_collector(collect_bot_metrics)
+METRICS.describe('upstream_requests_total', 'Ответы внешних API по статусу')
+METRICS.describe('upstream_errors_total', 'Запросы к внешним API, завершившиеся исключением')
+METRICS.describe('upstream_request_seconds', 'Длительность запроса к внешнему API без ожидания лимита')
+METRICS.describe('command_seconds', 'Длительность выполнения команды')
+METRICS.describe('admission_total', 'Решения контроля допуска команд')
+METRICS.describe('admission_wait_seconds', 'Ожидание слота командой в очереди допуска')
+METRICS.describe('twitch_poll_seconds', 'Длительность запроса пачки стримеров')
+METRICS.describe('notification_delivery_seconds', 'Время от события стрима до отправки уведомления')
+METRICS.describe('twitch_poll_lag_seconds', 'Отставание последней пачки опроса от расписания')
+METRICS.describe('event_loop_utilization', 'Доля времени, которую поток event loop занимал процессор')
+METRICS.describe('event_loop_lag_seconds', 'Задержка пробуждения таймера event loop')
+
+async def monitor_event_loop():
+    """Замерять загрузку event loop и задержку его таймеров"""
+    last, last_cpu = time.monotonic(), time.thread_time()
+    while True:
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        now, now_cpu = time.monotonic(), time.thread_time()
+        elapsed = now - last
+        
+        # Процессорное время потока loop / прошедшее время - доля, когда loop был занят работой
+        METRICS.set('event_loop_utilization', round(min(1.0, (now_cpu - last_cpu) / elapsed), 4))
+        METRICS.observe('event_loop_lag_seconds', max(0.0, elapsed - LOOP_MONITOR_INTERVAL))
+        last, last_cpu = now, now_cpu
+
+async def handle_metrics(request):
+    """GET /metrics для Prometheus"""
+    return web.Response(
+        body=METRICS.render_prometheus().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+async def start_metrics_server():
+    """Запустить HTTP сервер с метриками на METRICS_HOST:METRICS_PORT"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        print(f"Ошибка запуска сервера метрик на порту {METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+def format_duration(seconds):
+    """Длительность для embed: миллисекунды или секунды"""
+    if seconds is None:
+        return "—"
+    return f"{seconds * 1000:.0f} мс" if seconds < 1 else f"{seconds:.1f} с"
+
+def format_latency(histogram):
+    """p50/p95 гистограммы"""
+    if histogram is None or not histogram.count:
+        return "нет данных"
+    return f"p50 {format_duration(histogram.quantile(0.5))}, p95 {format_duration(histogram.quantile(0.95))}"
+
+def build_stats_embed():
+    """Собрать сводку метрик для !статистика"""
+    embed = discord.Embed(title="📊 Статистика бота", color=0x3498db)
+    
+    # Внешние API: ответы по статусам, ошибки и задержки
+    lines = []
+    for upstream in RATE_LIMITERS:
+        statuses = {labels['status']: value for labels, value in METRICS.series('upstream_requests_total') if labels['upstream'] == upstream}
+        failures = sum(value for labels, value in METRICS.series('upstream_errors_total') if labels['upstream'] == upstream)
+        errors = failures + sum(value for status, value in statuses.items() if status >= 500)
+        histogram = METRICS.histogram('upstream_request_seconds', upstream=upstream)
+        lines.append(f"**{upstream}**: {sum(statuses.values())} запр., ошибок {errors}, 429: {statuses.get(429, 0)}\n"
+                     f"{format_latency(histogram)}")
+    embed.add_field(name="🌐 Внешние API", value="\n".join(lines)[:1024], inline=False)
+    
+    # Команды, самые частые сверху
+    commands_stats = sorted(
+        ((dict(labels)['command'], histogram) for (name, labels), histogram in METRICS.histograms.items() if name == 'command_seconds'),
+        key=lambda item: -item[1].count
+    )
+    lines = [f"`!{command}`: {histogram.count}, {format_latency(histogram)}" for command, histogram in commands_stats[:10]]
+    admission = ADMISSION.get_stats()
+    shed = admission['shed_user'] + admission['shed_queue'] + admission['shed_timeout']
+    lines.append(f"допуск: выполняется {admission['active']}, в очереди {admission['waiting']}, "
+                 f"ожидание {format_latency(METRICS.histogram('admission_wait_seconds'))}")
+    lines.append(f"перегрузка: {shed} не допущено, {admission['served_cached']} из кеша, {admission['busy']} «занято»")
+    embed.add_field(name="⌨️ Команды", value="\n".join(lines)[:1024], inline=False)
+    
+    # Кеши
+    lines = []
+    for name, cache in (('погода', WEATHER_CACHE), ('ответы', RESPONSE_CACHE)):
+        stats = cache.get_stats()
+        lines.append(f"{name}: {stats['hit_ratio']:.0%} попаданий, {stats['size']} записей")
+    geocodes = GEOCODER.get_stats()
+    lines.append(f"города: {geocodes['places']} в индексе, {geocodes['lookups']} запросов геокодинга")
+    if SHARED_CACHE.backend is not None:
+        shared = SHARED_CACHE.get_stats().values()
+        hits = sum(stats['hits'] for stats in shared)
+        lookups = hits + sum(stats['misses'] for stats in shared)
+        lines.append(f"общий кеш ({CACHE_BACKEND}): {hits / lookups if lookups else 0:.0%} попаданий, "
+                     f"{sum(stats['errors'] for stats in shared)} ошибок")
+    coalesced = sum(stats['coalesced'] for stats in UPSTREAM_FLIGHTS.get_stats().values())
+    lines.append(f"объединено запросов: {coalesced}")
+    embed.add_field(name="🗃️ Кеши", value="\n".join(lines), inline=True)
+    
+    # Опрос Twitch
+    poller = TWITCH_POLLER.get_stats()
+    lines = [
+        f"в очереди: {poller['queue_depth']}, просрочено: {poller['overdue']}",
+        f"пачек: {poller['batches']}, {format_latency(METRICS.histogram('twitch_poll_seconds'))}",
+        f"отставание: {format_duration(poller['lag'])}, растяжение x{poller['stretch']}",
+        f"EventSub: {len(TWITCH_EVENTSUB.covered)} стрим." if TWITCH_EVENTSUB.session_id else "EventSub: нет соединения",
+        f"уведомлений: {NOTIFICATIONS.stats['sent']}, ошибок {NOTIFICATIONS.stats['failed']}",
+        f"доставка: {format_latency(METRICS.histogram('notification_delivery_seconds'))}",
+    ]
+    embed.add_field(name="🟣 Опрос Twitch", value="\n".join(lines), inline=True)
+    
+    # Event loop
+    utilization = METRICS.gauge('event_loop_utilization')
+    lines = [
+        f"загрузка: {utilization:.0%}" if utilization is not None else "загрузка: —",
+        f"задержка: {format_latency(METRICS.histogram('event_loop_lag_seconds'))}",
+    ]
+    embed.add_field(name="⚙️ Event loop", value="\n".join(lines), inline=True)
+    
+    return embed
+
+@bot.command(name='статистика', aliases=['stats'])
+@commands.has_permissions(administrator=True)
+async def stats_command(ctx):
+    """Показать метрики бота (только для администраторов)"""
+    await ctx.reply(embed=build_stats_embed())
+
+def shard_for_guild(guild_id, shard_count):
+    """Номер шарда, к которому Discord относит сервер"""
+    return (guild_id >> 22) % shard_count
+
+def is_local_guild(guild_id):
+    """Обслуживает ли сервер этот процесс (шарды разнесены по процессам - у каждого своя часть серверов)"""
+    if not SHARD_IDS or not SHARD_COUNT or guild_id is None:
+        return True
+    return shard_for_guild(guild_id, SHARD_COUNT) in SHARD_IDS
+
+def partition_shards(shard_count, processes):
+    """Разбить шарды на непрерывные диапазоны по процессам: [[шарды процесса 0], ...]"""
+    size, extra = divmod(shard_count, processes)
+    partitions = []
+    start = 0
+    for index in range(processes):
+        count = size + (index < extra)
+        partitions.append(list(range(start, start + count)))
+        start += count
+    return [shards for shards in partitions if shards]
+
+async def fetch_recommended_shards(token):
+    """Узнать у Discord рекомендуемое число шардов"""
+    try:
+        async with aiohttp.ClientSession() as session:
+            headers = {'Authorization': f'Bot {token}'}
+            async with session.get(f'{DISCORD_API_URL}/gateway/bot', headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    return data.get('shards')
+                print(f"Ошибка при получении числа шардов: HTTP {response.status}")
+    except Exception as e:
+        print(f"Ошибка при получении числа шардов: {e}")
+    return None
+
+def run_cluster(token, processes=CLUSTER_PROCESSES, shard_count=SHARD_COUNT, command=None):
+    """Запустить шарды в нескольких процессах и перезапускать упавшие.
+    
+    Каждый процесс получает свой диапазон шардов через BOT_SHARD_IDS и держит
+    только серверы этих шардов, поэтому опрос Twitch и уведомления не дублируются.
+    """
+    if shard_count is None:
+        shard_count = asyncio.run(fetch_recommended_shards(token))
+        if not shard_count:
+            print("Ошибка: не удалось определить число шардов, задайте BOT_SHARD_COUNT")
+            return
+    
+    command = command or [sys.executable, os.path.abspath(__file__)]
+    partitions = partition_shards(shard_count, processes)
+    
+    def start(index):
+        env = dict(os.environ,
+                   BOT_SHARD_COUNT=str(shard_count),
+                   BOT_SHARD_IDS=','.join(map(str, partitions[index])),
+                   BOT_CLUSTER_PROCESSES='1',
+                   BOT_CLUSTER_INDEX=str(index))
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(METRICS_PORT + index)  # У каждого процесса свой порт метрик
+        print(f"🚀 Процесс {index}: шарды {partitions[index][0]}-{partitions[index][-1]} из {shard_count}")
+        return subprocess.Popen(command, env=env)
+    
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    
+    signal.signal(signal.SIGTERM, stop)
+    workers = {index: start(index) for index in range(len(partitions))}
+    restarts = {}  # index -> когда перезапустить (monotonic)
+    
+    try:
+        while workers or restarts:
+            time.sleep(1)
+            for index, process in list(workers.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                del workers[index]
+                if code != 0:
+                    print(f"Ошибка: процесс {index} завершился с кодом {code}, перезапуск через {CLUSTER_RESTART_DELAY} с")
+                    restarts[index] = time.monotonic() + CLUSTER_RESTART_DELAY
+            
+            for index, restart_at in list(restarts.items()):
+                if time.monotonic() >= restart_at:
+                    del restarts[index]
+                    workers[index] = start(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGINT - штатная остановка бота с сохранением данных
+        for process in workers.values():
+            process.send_signal(signal.SIGINT)
+        for process in workers.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
 if __name__ == "__main__":
     # Запуск бота
     token = os.getenv('DISCORD_TOKEN')
@@ -1026,6 +4339,9 @@ if __name__ == "__main__":
         print("Ошибка: DISCORD_TOKEN не найден в .env файле!")
     else:
         try:
-            bot.run(token)
+            if CLUSTER_PROCESSES > 1:
+                run_cluster(token)
+            else:
+                bot.run(token)
         except Exception as e:
             print(f"Ошибка запуска бота: {e}")
\ No newline at end of file